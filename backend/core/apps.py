@@ -52,6 +52,7 @@ class CoreConfig(AppConfig):
             import core.celery as celery
             import core.redis as redis
             import core.musiq.musiq as musiq
+            import core.musiq.live_queue as live_queue
             import core.musiq.playback as playback
             import core.settings.basic as basic
             import core.settings.platforms as platforms
@@ -59,6 +60,8 @@ class CoreConfig(AppConfig):
 
             logging.info("starting raveberry")
 
+            # write changes to the queue that were not persisted before the last shutdown
+            live_queue.persist()
             redis.start()
             celery.start()
 
@@ -78,4 +81,6 @@ class CoreConfig(AppConfig):
                 # wake up the listener thread with an instruction to stop the lights worker
                 redis.publish("lights_settings_changed", "stop")
 
+                live_queue.persist()
+
             atexit.register(stop_workers)
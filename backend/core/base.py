@@ -19,7 +19,7 @@ from core import models
 
 from core import user_manager
 from core import redis
-from core.state_handler import send_state
+from core.state_handler import broadcast
 
 
 def _get_random_hashtag() -> str:
@@ -71,12 +71,20 @@ def context(request: WSGIRequest) -> Dict[str, Any]:
     }
 
 
+def volatile_state(_built: Dict[str, Any], _elapsed: float) -> Dict[str, Any]:
+    """Returns the values of the base state that change without an update being sent.
+    Pages extend this dictionary like the state itself."""
+    return {
+        "partymode": user_manager.partymode_enabled(),
+        "users": user_manager.get_count(),
+    }
+
+
 def state_dict() -> Dict[str, Any]:
     """This function constructs a base state dictionary with website wide state.
     Pages sending states extend this state dictionary."""
     return {
-        "partymode": user_manager.partymode_enabled(),
-        "users": user_manager.get_count(),
+        **volatile_state({}, 0),
         "visitors": models.Counter.objects.get_or_create(id=1, defaults={"value": 0})[
             0
         ].value,
@@ -130,6 +138,7 @@ def upgrade_available(_request: WSGIRequest) -> HttpResponse:
     return JsonResponse(False, safe=False)
 
 
-def update_state() -> None:
-    """Sends an update event to all connected clients."""
-    send_state(state_dict())
+def update_state(immediate: bool = False) -> None:
+    """Sends an update event to all connected clients.
+    Updates in quick succession are combined, unless :param immediate: is set."""
+    broadcast("base", state_dict, immediate)
@@ -1,8 +1,8 @@
 """This module contains the celery app."""
 import os
 from distutils.util import strtobool
-from threading import Thread
-from typing import Callable, Any
+from threading import Thread, Timer
+from typing import Callable, Any, Dict, Optional, Tuple
 
 if strtobool(os.environ.get("DJANGO_NO_CELERY", "0")):
     # For debugging, celery's startup is quite slow, especially when reloading on every change.
@@ -18,7 +18,16 @@ if strtobool(os.environ.get("DJANGO_NO_CELERY", "0")):
                 thread = Thread(target=function, args=args, kwargs=kwargs, daemon=True)
                 thread.start()
 
+            def apply_async(
+                args: Tuple = (), kwargs: Optional[Dict] = None, countdown: float = 0
+            ) -> None:
+                """Like delay(), but the thread starts after :param countdown: seconds."""
+                timer = Timer(countdown, function, args=args, kwargs=kwargs)
+                timer.daemon = True
+                timer.start()
+
             function.delay = delay
+            function.apply_async = apply_async
 
             return function
 
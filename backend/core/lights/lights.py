@@ -11,7 +11,12 @@ from django.shortcuts import render
 
 from core import user_manager, base, redis, util
 from core.settings import storage
-from core.state_handler import send_state
+from core.state_handler import broadcast
+
+
+def volatile_state(built: Dict[str, Any], elapsed: float) -> Dict[str, Any]:
+    """Returns the values of the lights state that change without an update."""
+    return base.volatile_state(built, elapsed)
 
 
 def state_dict() -> Dict[str, Any]:
@@ -68,6 +73,7 @@ def index(request: WSGIRequest) -> HttpResponse:
     return render(request, "lights.html", context)
 
 
-def update_state() -> None:
-    """Sends an update event to all connected clients."""
-    send_state(state_dict())
+def update_state(immediate: bool = False) -> None:
+    """Sends an update event to all connected clients.
+    Updates in quick succession are combined, unless :param immediate: is set."""
+    broadcast("lights", state_dict, immediate)
@@ -14,7 +14,7 @@ from typing import Dict, TYPE_CHECKING, TypeVar
 from django.db import connection
 
 from django.conf import settings as conf
-from core import redis
+from core import base, redis
 from core.celery import app
 from core.lights import controller, lights
 from core.lights import leds
@@ -220,12 +220,15 @@ class DeviceManager:
 
     def consumers_changed(self) -> None:
         """Stops the loop if no led is active, starts it otherwise"""
-        if self.disabled_program.consumers == 4:
-            self.loop_active.clear()
-            redis.set("lights_active", False)
-        else:
+        active = self.disabled_program.consumers != 4
+        if active:
             self.loop_active.set()
-            redis.set("lights_active", True)
+        else:
+            self.loop_active.clear()
+        if redis.get("lights_active") != active:
+            redis.set("lights_active", active)
+            # the lights shortcut is part of the base state, shown on every page
+            base.update_state()
 
     def alarm_started(self) -> None:
         """Makes alarm the current program but doesn't update the database."""
@@ -0,0 +1,66 @@
+"""This module deals with the "benchmarkbroadcast" command.
+It measures how long a state update takes to reach many websocket clients."""
+import asyncio
+import time
+from typing import Any
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandParser
+
+
+class Command(BaseCommand):
+    """Class to register the command"""
+
+    help = (
+        "Measures how long it takes until a musiq state update "
+        "reached every connected websocket client."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 500])
+        parser.add_argument("--repetitions", type=int, default=20)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        from core import state_handler
+        from core.musiq import musiq
+        from core.routing import WEBSOCKET_URLPATTERNS
+
+        application = URLRouter(WEBSOCKET_URLPATTERNS)
+        state = musiq.state_dict()
+        repetitions = options["repetitions"]
+
+        async def measure(clients: int) -> float:
+            communicators = [
+                WebsocketCommunicator(application, "/state/musiq/")
+                for _ in range(clients)
+            ]
+            for communicator in communicators:
+                await communicator.connect()
+            try:
+                total = 0.0
+                for _ in range(repetitions):
+                    start = time.perf_counter()
+                    await sync_to_async(state_handler.send_state)(state, "musiq")
+                    await asyncio.gather(
+                        *(
+                            communicator.receive_from(timeout=10)
+                            for communicator in communicators
+                        )
+                    )
+                    total += time.perf_counter() - start
+                return total / repetitions
+            finally:
+                for communicator in communicators:
+                    await communicator.disconnect()
+
+        self.stdout.write(
+            f"serializer: {state_handler.SERIALIZER}, "
+            f"state size: {len(state_handler.serialize(state))} bytes, "
+            f"{repetitions} repetitions"
+        )
+        for clients in options["clients"]:
+            seconds = asyncio.run(measure(clients))
+            self.stdout.write(f"{clients:>5} clients: {seconds * 1000:9.3f} ms")
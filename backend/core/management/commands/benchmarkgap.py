@@ -0,0 +1,100 @@
+"""This module deals with the "benchmarkgap" command.
+It measures the silence between songs on a fake mopidy server."""
+import statistics
+import time
+from threading import Thread
+from typing import TYPE_CHECKING, Any, List
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.test import override_settings
+
+if TYPE_CHECKING:
+    from core.management.fake_mopidy import FakeMopidy
+
+
+class Command(BaseCommand):
+    """Class to register the command"""
+
+    help = (
+        "Plays songs on a fake mopidy server and measures the silence between them, "
+        "with and without gapless playback."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--songs", type=int, default=5)
+        parser.add_argument("--duration", type=float, default=1.0)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        from core.management.fake_mopidy import FakeMopidy
+        from core.models import CurrentSong, QueuedSong
+        from core.musiq import live_queue
+        from core.settings import storage
+
+        if (
+            QueuedSong.objects.exists()
+            or live_queue.count()
+            or CurrentSong.objects.exists()
+        ):
+            raise CommandError("Nothing may be playing or queued to run the benchmark.")
+
+        songs = options["songs"]
+        duration = options["duration"]
+        mopidy = FakeMopidy(track_duration=duration)
+        mopidy.start()
+        gapless_playback = storage.get("gapless_playback")
+        try:
+            with override_settings(MOPIDY_HOST="localhost", MOPIDY_PORT=mopidy.port):
+                self.stdout.write(f"{songs} songs of {duration}s")
+                for gapless in (False, True):
+                    storage.set("gapless_playback", gapless)
+                    gaps = self._play(mopidy, songs, duration)
+                    name = "gapless" if gapless else "sequential"
+                    if not gaps:
+                        self.stdout.write(f"{name:>10}: no transitions")
+                        continue
+                    self.stdout.write(
+                        f"{name:>10}: mean gap {statistics.mean(gaps) * 1000:8.3f} ms, "
+                        f"max gap {max(gaps) * 1000:8.3f} ms, "
+                        f"{mopidy.http_requests / songs:.1f} requests per song"
+                    )
+        finally:
+            storage.set("gapless_playback", gapless_playback)
+            mopidy.stop()
+            QueuedSong.objects.remove_all()
+            CurrentSong.objects.all().delete()
+
+    def _play(
+        self, mopidy: "FakeMopidy", songs: int, duration: float
+    ) -> List[float]:
+        from core import redis
+        from core.models import QueuedSong
+        from core.musiq import playback
+
+        mopidy.reset()
+        redis.set("stop_playback_loop", False)
+        player = playback.Playback()
+        QueuedSong.objects.enqueue_many(
+            [
+                {
+                    "artist": "benchmark",
+                    "title": str(position),
+                    "duration": duration,
+                    "internal_url": f"fake:{position}",
+                    "external_url": f"fake:{position}",
+                    "stream_url": None,
+                }
+                for position in range(songs)
+            ],
+            False,
+        )
+        playback.queue_changed.set()
+        loop = Thread(target=player.loop, daemon=True)
+        loop.start()
+
+        deadline = time.time() + songs * (duration + 2) + 10
+        while mopidy.finished < songs and time.time() < deadline:
+            time.sleep(0.1)
+        playback.stop()
+        loop.join(timeout=10)
+        redis.set("stop_playback_loop", False)
+        return mopidy.gaps
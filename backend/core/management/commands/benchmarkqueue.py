@@ -0,0 +1,87 @@
+"""This module deals with the "benchmarkqueue" command.
+It compares reading the queue from the database with the live queue in redis."""
+import random
+import timeit
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+from django.forms.models import model_to_dict
+
+
+class Command(BaseCommand):
+    """Class to register the command"""
+
+    help = (
+        "Compares selecting the next song and sorting the queue by votes "
+        "in the database with the live queue in redis."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--songs", type=int, default=10000)
+        parser.add_argument("--repetitions", type=int, default=20)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        from core import redis
+        from core.models import QueuedSong
+        from core.musiq import live_queue
+        from core.musiq.song_queue import INDEX_SPACING
+
+        if QueuedSong.objects.exists() or live_queue.count():
+            raise CommandError("The queue needs to be empty to run the benchmark.")
+
+        songs = options["songs"]
+        repetitions = options["repetitions"]
+
+        def database_next() -> None:
+            QueuedSong.objects.confirmed().order_by("-votes", "index").first()
+
+        def database_display() -> None:
+            sorted(
+                (model_to_dict(song) for song in QueuedSong.objects.all()),
+                key=lambda song: (-song["votes"], song["index"]),
+            )
+
+        def live_queue_next() -> None:
+            live_queue.first(ranked=True)
+
+        def live_queue_display() -> None:
+            live_queue.songs(ranked=True)
+
+        try:
+            with transaction.atomic():
+                QueuedSong.objects.bulk_create(
+                    [
+                        QueuedSong(
+                            index=(position + 1) * INDEX_SPACING,
+                            manually_requested=False,
+                            votes=random.randint(-2, 10),
+                            # every tenth song is a placeholder
+                            internal_url=None if position % 10 == 0 else "benchmark",
+                            external_url="benchmark",
+                            artist="benchmark",
+                            title=str(position),
+                            duration=180,
+                        )
+                        for position in range(songs)
+                    ],
+                    batch_size=1000,
+                )
+                live_queue.restore()
+
+                self.stdout.write(f"{songs} queued songs, {repetitions} repetitions")
+                for name, function in (
+                    ("next song (database)", database_next),
+                    ("next song (live queue)", live_queue_next),
+                    ("queue by votes (database)", database_display),
+                    ("queue by votes (live queue)", live_queue_display),
+                ):
+                    seconds = timeit.timeit(function, number=repetitions)
+                    self.stdout.write(
+                        f"{name:>28}: {seconds / repetitions * 1000:9.3f} ms"
+                    )
+                # discard the benchmark songs
+                transaction.set_rollback(True)
+        finally:
+            live_queue.clear()
+            redis.redis_connection.delete(live_queue.DIRTY_KEY)
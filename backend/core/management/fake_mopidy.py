@@ -0,0 +1,340 @@
+"""A minimal stand-in for mopidy, used to benchmark the playback loop without audio output.
+It serves mopidy's JSON-RPC and websocket endpoints on the same port.
+Every track plays for a fixed duration without producing any sound.
+The time between the end of a track and the start of the next one is recorded as a gap."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from websockets.server import ServerProtocol
+
+# a tracklist entry: tracklist id and uri
+Entry = Tuple[int, str]
+
+
+class FakeMopidy:
+    """Runs a fake mopidy server in a background thread."""
+
+    def __init__(self, track_duration: float = 1.0) -> None:
+        self.track_duration = track_duration
+        self.port = 0
+        # seconds between the end of a track and the start of the following one
+        self.gaps: List[float] = []
+        # number of tracks that ended, either by playing until the end or by skipping them
+        self.finished = 0
+        self.rpc_requests = 0
+        # a batch of calls counts as a single http request
+        self.http_requests = 0
+        # number of calls of every method
+        self.calls: Counter[str] = Counter()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: Set[Tuple[ServerProtocol, asyncio.StreamWriter]] = set()
+
+        self._tracklist: List[Entry] = []
+        self._next_tlid = 1
+        self._consume = False
+        self._volume = 100
+        self._state = "stopped"
+        self._current: Optional[Entry] = None
+        # loop time at which the current track would have started without seeking
+        self._started_at = 0.0
+        # position in milliseconds while paused
+        self._paused_at = 0
+        self._end_timer: Optional[asyncio.TimerHandle] = None
+        # loop time at which the last track ended
+        self._ended_at: Optional[float] = None
+
+        self._methods: Dict[str, Callable[..., Any]] = {
+            "core.playback.play": self._play,
+            "core.playback.pause": self._pause,
+            "core.playback.resume": self._resume,
+            "core.playback.stop": self._stop,
+            "core.playback.next": self._next,
+            "core.playback.seek": self._seek,
+            "core.playback.get_state": lambda: self._state,
+            "core.playback.get_time_position": self._get_time_position,
+            "core.playback.get_current_tlid": lambda: self._current_tlid(),
+            "core.playback.get_current_tl_track": lambda: self._tl_track(self._current),
+            "core.tracklist.add": self._add,
+            "core.tracklist.remove": self._remove,
+            "core.tracklist.clear": self._clear,
+            "core.tracklist.set_consume": self._set_consume,
+            "core.tracklist.get_consume": lambda: self._consume,
+            "core.tracklist.get_length": lambda: len(self._tracklist),
+            "core.tracklist.get_tl_tracks": lambda: [
+                self._tl_track(entry) for entry in self._tracklist
+            ],
+            "core.mixer.get_volume": lambda: self._volume,
+            "core.mixer.set_volume": self._set_volume,
+        }
+
+    def start(self) -> None:
+        """Starts the server on a free port."""
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._listen(), self._loop).result()
+
+    def stop(self) -> None:
+        """Stops the server and its thread."""
+
+        async def close() -> None:
+            self._cancel_end()
+            if self._server is not None:
+                self._server.close()
+            for _, writer in list(self._clients):
+                writer.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def reset(self) -> None:
+        """Clears the recorded measurements."""
+
+        async def reset() -> None:
+            self.gaps = []
+            self.finished = 0
+            self.rpc_requests = 0
+            self.http_requests = 0
+            self.calls = Counter()
+            self._ended_at = None
+
+        asyncio.run_coroutine_threadsafe(reset(), self._loop).result()
+
+    async def _listen(self) -> None:
+        self._server = await asyncio.start_server(self._handle, "localhost", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode().split("\r\n")
+                headers = {
+                    name.strip().lower(): value.strip()
+                    for name, value in (
+                        line.split(":", 1) for line in lines[1:] if ":" in line
+                    )
+                }
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self._websocket(head, reader, writer)
+                    return
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.http_requests += 1
+                request = json.loads(body)
+                if isinstance(request, list):
+                    # a batch, its calls are executed in order
+                    result: Any = [self._rpc(call) for call in request]
+                else:
+                    result = self._rpc(request)
+                response = json.dumps(result).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    + f"Content-Length: {len(response)}\r\n\r\n".encode()
+                    + response
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _websocket(
+        self, head: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        protocol = ServerProtocol()
+        protocol.receive_data(head)
+        request = protocol.events_received()[0]
+        protocol.send_response(protocol.accept(request))
+        writer.write(b"".join(protocol.data_to_send()))
+        client = (protocol, writer)
+        self._clients.add(client)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                # answers pings and close frames, incoming messages are ignored
+                protocol.receive_data(data)
+                protocol.events_received()
+                writer.write(b"".join(protocol.data_to_send()))
+        finally:
+            self._clients.discard(client)
+
+    def _emit(self, event: str, **data: Any) -> None:
+        message = json.dumps({"event": event, **data}).encode()
+        for protocol, writer in list(self._clients):
+            protocol.send_text(message)
+            writer.write(b"".join(protocol.data_to_send()))
+
+    def _rpc(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        self.rpc_requests += 1
+        self.calls[request["method"]] += 1
+        method = self._methods[request["method"]]
+        params = request.get("params", [])
+        if isinstance(params, dict):
+            result = method(**params)
+        else:
+            result = method(*params)
+        return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+    def _tl_track(self, entry: Optional[Entry]) -> Optional[Dict[str, Any]]:
+        if entry is None:
+            return None
+        tlid, uri = entry
+        return {
+            "__model__": "TlTrack",
+            "tlid": tlid,
+            "track": {
+                "__model__": "Track",
+                "uri": uri,
+                "length": int(self.track_duration * 1000),
+            },
+        }
+
+    def _current_tlid(self) -> Optional[int]:
+        return None if self._current is None else self._current[0]
+
+    def _set_state(self, state: str) -> None:
+        if state != self._state:
+            self._emit("playback_state_changed", old_state=self._state, new_state=state)
+            self._state = state
+
+    def _cancel_end(self) -> None:
+        if self._end_timer is not None:
+            self._end_timer.cancel()
+            self._end_timer = None
+
+    def _start(self, entry: Entry, position: int = 0) -> None:
+        now = self._loop.time()
+        if self._ended_at is not None:
+            self.gaps.append(now - self._ended_at)
+            self._ended_at = None
+        self._current = entry
+        self._started_at = now - position / 1000
+        self._cancel_end()
+        self._end_timer = self._loop.call_at(
+            self._started_at + self.track_duration, self._finish
+        )
+        self._set_state("playing")
+        self._emit("track_playback_started", tl_track=self._tl_track(entry))
+
+    def _finish(self) -> None:
+        # the current track ended, continue with the next one like mopidy does
+        self._cancel_end()
+        entry = self._current
+        self.finished += 1
+        self._ended_at = self._loop.time()
+        self._emit(
+            "track_playback_ended",
+            tl_track=self._tl_track(entry),
+            time_position=self._get_time_position(),
+        )
+        position = self._tracklist.index(entry) if entry in self._tracklist else -1
+        if self._consume and position >= 0:
+            del self._tracklist[position]
+        else:
+            position += 1
+        if position < len(self._tracklist):
+            self._start(self._tracklist[position])
+        else:
+            self._current = None
+            self._set_state("stopped")
+
+    def _get_time_position(self) -> int:
+        if self._state == "paused":
+            return self._paused_at
+        if self._state == "stopped":
+            return 0
+        return int((self._loop.time() - self._started_at) * 1000)
+
+    def _play(self, tl_track: Any = None, tlid: Optional[int] = None) -> None:
+        if self._state == "paused":
+            self._resume()
+        elif self._state == "stopped" and self._tracklist:
+            self._start(self._current or self._tracklist[0])
+
+    def _pause(self) -> bool:
+        if self._state == "playing":
+            self._paused_at = self._get_time_position()
+            self._cancel_end()
+            self._set_state("paused")
+        return True
+
+    def _resume(self) -> bool:
+        if self._state == "paused" and self._current is not None:
+            self._start(self._current, self._paused_at)
+        return True
+
+    def _stop(self) -> None:
+        self._cancel_end()
+        self._current = None
+        self._set_state("stopped")
+
+    def _next(self) -> None:
+        if self._current is not None:
+            self._finish()
+
+    def _seek(self, time_position: int) -> bool:
+        if self._state == "playing" and self._current is not None:
+            self._started_at = self._loop.time() - time_position / 1000
+            self._cancel_end()
+            self._end_timer = self._loop.call_at(
+                self._started_at + self.track_duration, self._finish
+            )
+        elif self._state == "paused":
+            self._paused_at = time_position
+        return True
+
+    def _add(
+        self,
+        uris: Optional[List[str]] = None,
+        at_position: Optional[int] = None,
+        uri: Optional[str] = None,
+        tracks: Any = None,
+    ) -> List[Dict[str, Any]]:
+        entries = []
+        for track_uri in uris or [uri]:
+            entries.append((self._next_tlid, track_uri))
+            self._next_tlid += 1
+        if at_position is None:
+            at_position = len(self._tracklist)
+        self._tracklist[at_position:at_position] = entries
+        self._emit("tracklist_changed")
+        return [self._tl_track(entry) for entry in entries]
+
+    def _remove(self, criteria: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+        tlids = set(criteria.get("tlid", []))
+        uris = set(criteria.get("uri", []))
+        removed = [
+            entry for entry in self._tracklist if entry[0] in tlids or entry[1] in uris
+        ]
+        for entry in removed:
+            self._tracklist.remove(entry)
+        if self._current in removed:
+            self._stop()
+        self._emit("tracklist_changed")
+        return [self._tl_track(entry) for entry in removed]
+
+    def _clear(self) -> None:
+        if self._current is not None:
+            self._stop()
+        self._tracklist = []
+        self._emit("tracklist_changed")
+
+    def _set_consume(self, value: bool) -> None:
+        self._consume = value
+
+    def _set_volume(self, volume: int) -> bool:
+        self._volume = volume
+        return True
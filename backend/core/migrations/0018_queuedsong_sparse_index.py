@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-17 06:57
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def spread_indices(apps, schema_editor):
+    # queued songs were numbered densely, move them apart so they can be reordered in place.
+    # Matches INDEX_SPACING in core.musiq.song_queue at the time of this migration.
+    QueuedSong = apps.get_model("core", "QueuedSong")
+    QueuedSong.objects.update(index=F("index") * (1 << 16))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0017_archivedquery_core_archivedquery_query_trgm_and_more")
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="queuedsong", name="index", field=models.BigIntegerField()
+        ),
+        migrations.RunPython(spread_indices, migrations.RunPython.noop),
+    ]
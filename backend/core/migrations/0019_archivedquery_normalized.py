@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-17 14:12
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+def normalize_queries(apps, schema_editor):
+    # Matches song_utils.normalize_query at the time of this migration.
+    ArchivedQuery = apps.get_model("core", "ArchivedQuery")
+    queries = list(ArchivedQuery.objects.only("id", "query"))
+    for archived_query in queries:
+        archived_query.normalized = " ".join(
+            unicodedata.normalize("NFKC", archived_query.query).casefold().split()
+        )
+    ArchivedQuery.objects.bulk_update(queries, ["normalized"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("core", "0018_queuedsong_sparse_index")]
+
+    operations = [
+        migrations.AddField(
+            model_name="archivedquery",
+            name="normalized",
+            field=models.CharField(db_index=True, default="", max_length=1000),
+        ),
+        migrations.RunPython(normalize_queries, migrations.RunPython.noop),
+    ]
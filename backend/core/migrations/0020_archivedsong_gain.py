@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0019_archivedquery_normalized"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="archivedsong",
+            name="gain",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
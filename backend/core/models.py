@@ -44,6 +44,8 @@ class ArchivedSong(models.Model):
     duration = models.FloatField()
     counter = models.IntegerField()
     cached = models.BooleanField()
+    # the replaygain track gain in dB, None if the song was not analyzed yet
+    gain = models.FloatField(blank=True, null=True)
 
     def __str__(self) -> str:
         return self.title + " (" + self.url + "): " + str(self.counter)
@@ -117,10 +119,16 @@ class ArchivedQuery(models.Model):
         "ArchivedSong", on_delete=models.CASCADE, related_name="queries"
     )
     query = models.CharField(max_length=1000)
+    # used to look up songs for repeated queries, see song_utils.normalize_query
+    normalized = models.CharField(max_length=1000, db_index=True, default="")
 
     def __str__(self) -> str:
         return self.query
 
+    def save(self, *args, **kwargs) -> None:
+        self.normalized = song_utils.normalize_query(self.query)
+        super().save(*args, **kwargs)
+
     class Meta:
         if connection.vendor == "postgresql":
             indexes = (
@@ -151,7 +159,8 @@ class QueuedSong(models.Model):
     """Stores a song in the song queue so the queue is not lost on server restart."""
 
     id: int
-    index = models.IntegerField()
+    # sparse ordering key, see song_queue.INDEX_SPACING
+    index = models.BigIntegerField()
     manually_requested = models.BooleanField()
     votes = models.IntegerField(default=0)
     internal_url = models.CharField(max_length=2000, blank=True, null=True)
@@ -4,12 +4,11 @@ from __future__ import annotations
 
 import subprocess
 import datetime
-from functools import wraps
-from typing import Callable
+from functools import partial, wraps
+from typing import Callable, Optional
 
 from django.conf import settings as conf
 from django.core.handlers.wsgi import WSGIRequest
-from django.db import transaction
 from django.db.models import F
 from django.http import HttpResponseForbidden
 from django.http.response import HttpResponse, HttpResponseBadRequest
@@ -19,16 +18,19 @@ from mopidyapi import MopidyAPI
 
 import core.models as models
 from core import user_manager, redis
-from core.musiq import playback, musiq
+from core.musiq import playback, musiq, mopidy_gateway
 from core.settings import storage
 
 player: MopidyAPI = None
 
 
-def control(func: Callable) -> Callable:
+def control(func: Optional[Callable] = None, *, immediate: bool = False) -> Callable:
     """A decorator for functions that control the playback.
     Every control changes the views state and returns an empty response.
-    At least mod privilege is required during voting."""
+    At least mod privilege is required during voting.
+    With :param immediate:, the state update is sent without waiting for further changes."""
+    if func is None:
+        return partial(control, immediate=immediate)
 
     def _decorator(request: WSGIRequest) -> HttpResponse:
         if storage.get("voting_enabled") and not user_manager.has_controls(
@@ -36,7 +38,7 @@ def control(func: Callable) -> Callable:
         ):
             return HttpResponseForbidden()
         response = func(request)
-        musiq.update_state()
+        musiq.update_state(immediate=immediate)
         if response is not None:
             return response
         return HttpResponse()
@@ -58,9 +60,7 @@ def start() -> None:
 @control
 def restart(_request: WSGIRequest) -> None:
     """Restarts the current song from the beginning."""
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            player.playback.seek(0)
+    mopidy_gateway.send("core.playback.seek", time_position=0)
     try:
         current_song = models.CurrentSong.objects.get()
         current_song.created = timezone.now()
@@ -72,10 +72,7 @@ def restart(_request: WSGIRequest) -> None:
 @control
 def seek_backward(_request: WSGIRequest) -> None:
     """Jumps back in the current song."""
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            current_position = player.playback.get_time_position()
-            player.playback.seek(current_position - SEEK_DISTANCE * 1000)
+    mopidy_gateway.send("seek_by", offset=-SEEK_DISTANCE * 1000)
     try:
         current_song = models.CurrentSong.objects.get()
         now = timezone.now()
@@ -90,9 +87,7 @@ def seek_backward(_request: WSGIRequest) -> None:
 def play(_request: WSGIRequest) -> None:
     """Resumes the current song if it is paused.
     No-op if already playing."""
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            player.playback.play()
+    mopidy_gateway.send("core.playback.play")
     try:
         # move the creation timestamp into the future for the duration of the pause
         # this ensures that the progress calculation (starting from created) is correct
@@ -111,9 +106,7 @@ def play(_request: WSGIRequest) -> None:
 def pause(_request: WSGIRequest) -> None:
     """Pauses the current song if it is playing.
     No-op if already paused."""
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            player.playback.pause()
+    mopidy_gateway.send("core.playback.pause")
     try:
         current_song = models.CurrentSong.objects.get()
         current_song.last_paused = timezone.now()
@@ -126,10 +119,7 @@ def pause(_request: WSGIRequest) -> None:
 @control
 def seek_forward(_request: WSGIRequest) -> None:
     """Jumps forward in the current song."""
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            current_position = player.playback.get_time_position()
-            player.playback.seek(current_position + SEEK_DISTANCE * 1000)
+    mopidy_gateway.send("seek_by", offset=SEEK_DISTANCE * 1000)
     try:
         current_song = models.CurrentSong.objects.get()
         current_song.created -= datetime.timedelta(seconds=SEEK_DISTANCE)
@@ -138,13 +128,11 @@ def seek_forward(_request: WSGIRequest) -> None:
         pass
 
 
-@control
+@control(immediate=True)
 def skip(_request: WSGIRequest) -> None:
     """Skips the current song and continues with the next one."""
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            redis.set("backup_playing", False)
-            player.playback.next()
+    redis.set("backup_playing", False)
+    mopidy_gateway.send("core.playback.next")
 
 
 @control
@@ -186,9 +174,7 @@ def _set_volume(volume) -> None:
     except (FileNotFoundError, subprocess.CalledProcessError):
         # pulse is not installed or there is no server running.
         # change mopidy's volume
-        with playback.mopidy_command() as allowed:
-            if allowed:
-                player.mixer.set_volume(round(volume * 100))
+        mopidy_gateway.send("core.mixer.set_volume", volume=round(volume * 100))
 
 
 @control
@@ -202,10 +188,23 @@ def set_volume(request: WSGIRequest) -> None:
 
 @control
 def shuffle_all(request: WSGIRequest) -> HttpResponse:
-    """Shuffles the queue. Only admin is permitted to do this."""
+    """Shuffles the queue. Only admin is permitted to do this.
+    Optionally, the first start songs or manually requested songs are not shuffled."""
     if not user_manager.is_admin(request.user):
         return HttpResponseForbidden()
-    playback.queue.shuffle()
+    try:
+        start = int(request.POST.get("start", 0))
+    except ValueError:
+        return HttpResponseBadRequest("start needs to be a number")
+    if start < 0:
+        return HttpResponseBadRequest("start can not be negative")
+    autoplay_only = request.POST.get("autoplayOnly") == "true"
+    # in voting mode, clients show the queue in the order by votes
+    playback.queue.shuffle(
+        start=start,
+        autoplay_only=autoplay_only,
+        ranked=storage.get("voting_enabled"),
+    )
     return HttpResponse()
 
 
@@ -214,10 +213,7 @@ def remove_all(request: WSGIRequest) -> HttpResponse:
     """Empties the queue. Only admin is permitted to do this."""
     if not user_manager.is_admin(request.user):
         return HttpResponseForbidden()
-    with playback.mopidy_command() as allowed:
-        if allowed:
-            with transaction.atomic():
-                playback.queue.all().delete()
+    playback.queue.remove_all()
     return HttpResponse()
 
 
@@ -228,7 +224,10 @@ def prioritize(request: WSGIRequest) -> HttpResponse:
     if key is None:
         return HttpResponseBadRequest()
     ikey = int(key)
-    playback.queue.prioritize(ikey)
+    try:
+        playback.queue.prioritize(ikey)
+    except ValueError:
+        return HttpResponseBadRequest("song does not exist")
     return HttpResponse()
 
 
@@ -243,8 +242,8 @@ def remove(request: WSGIRequest) -> HttpResponse:
         removed = playback.queue.remove(ikey)
         # if we removed a song and it was added by autoplay,
         # we want it to be the new basis for autoplay
-        if not removed.manually_requested:
-            playback.handle_autoplay(removed.external_url or removed.title)
+        if not removed["manually_requested"]:
+            playback.handle_autoplay(removed["external_url"] or removed["title"])
         else:
             playback.handle_autoplay()
     except models.QueuedSong.DoesNotExist:
@@ -296,25 +295,28 @@ def vote(request: WSGIRequest) -> HttpResponse:
     ):
         return HttpResponseBadRequest("nice try")
 
-    models.CurrentSong.objects.filter(queue_key=ikey).update(votes=F("votes") + amount)
     try:
-        current_song = models.CurrentSong.objects.get()
-        if current_song.queue_key == ikey and current_song.votes <= -storage.get(
-            "downvotes_to_kick"
-        ):
-            with playback.mopidy_command() as allowed:
-                if allowed:
-                    player.playback.next()
-    except models.CurrentSong.DoesNotExist:
-        pass
-
-    removed = playback.queue.vote(ikey, amount, -storage.get("downvotes_to_kick"))
-    # if we removed a song by voting, and it was added by autoplay,
-    # we want it to be the new basis for autoplay
-    if removed is not None:
-        if not removed.manually_requested:
-            playback.handle_autoplay(removed.external_url or removed.title)
-        else:
-            playback.handle_autoplay()
-    musiq.update_state()
+        removed = playback.queue.vote(ikey, amount, -storage.get("downvotes_to_kick"))
+        # if we removed a song by voting, and it was added by autoplay,
+        # we want it to be the new basis for autoplay
+        if removed is not None:
+            if not removed["manually_requested"]:
+                playback.handle_autoplay(removed["external_url"] or removed["title"])
+            else:
+                playback.handle_autoplay()
+    except models.QueuedSong.DoesNotExist:
+        # the song is not in the queue, it might be the one that is currently playing
+        models.CurrentSong.objects.filter(queue_key=ikey).update(
+            votes=F("votes") + amount
+        )
+        try:
+            current_song = models.CurrentSong.objects.get()
+            if current_song.queue_key == ikey and current_song.votes <= -storage.get(
+                "downvotes_to_kick"
+            ):
+                mopidy_gateway.send("core.playback.next")
+        except models.CurrentSong.DoesNotExist:
+            pass
+        # votes of the current song are not part of the queue's patches
+        musiq.update_state()
     return HttpResponse()
@@ -0,0 +1,175 @@
+"""This module coordinates the downloads of all processes.
+Every song is only downloaded once at a time: the first process that needs a song
+downloads it, every other process that needs the same song uses its result.
+Only a limited number of songs are downloaded at the same time.
+Songs that are played earlier are downloaded first.
+Downloads that can not start yet do not wait, their caller tries again later,
+so no worker is occupied by waiting."""
+
+from __future__ import annotations
+
+import logging
+import math
+import time
+import uuid
+from typing import Callable, Optional
+
+from core import redis
+from core.musiq import live_queue
+from core.settings import storage
+
+# the key that is set while a download is running, holds the token of the downloading process
+FLIGHT_PREFIX = "download:"
+# holds the result of a download that finished recently, for the requests that waited for it
+RESULT_PREFIX = "download_result:"
+# the longest a download may take before another process takes over, in seconds
+DOWNLOAD_TIMEOUT = 15 * 60
+# downloads that could not start are tried again after this many seconds
+RETRY_DELAY = 2
+# how long the result of a finished download is kept, in seconds
+RESULT_LIFETIME = 10 * RETRY_DELAY
+
+# downloads waiting for a slot, scored by their priority (lower is earlier)
+PENDING_KEY = "downloads:pending"
+# the time every waiting download was last tried, downloads that were given up are removed
+HEARTBEAT_KEY = "downloads:heartbeat"
+# downloads that are running, scored by the time their slot expires
+RUNNING_KEY = "downloads:running"
+
+# the states returned by _start
+WAITING = 0
+STARTED = 1
+RUNNING_ELSEWHERE = 2
+FINISHED = 3
+
+# KEYS: flight key, result key, pending, heartbeat, running
+# ARGV: key, token, priority, concurrency, now, stale, deadline, timeout
+# Starts the download if it has the highest priority of all waiting downloads
+# and a slot is free, otherwise registers it with its current priority.
+# The song that is played next may use an additional slot,
+# so it is not held up by the downloads of a long playlist.
+# Returns the state of the download and the result if it finished recently.
+_start = redis.register_script(
+    """
+local result = redis.call("GET", KEYS[2])
+if result then
+    return {3, tonumber(result)}
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return {2, 0}
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[5], "-inf", ARGV[5])
+for _, key in ipairs(redis.call("ZRANGEBYSCORE", KEYS[4], "-inf", ARGV[6])) do
+    redis.call("ZREM", KEYS[3], key)
+    redis.call("ZREM", KEYS[4], key)
+end
+redis.call("ZADD", KEYS[3], ARGV[3], ARGV[1])
+redis.call("ZADD", KEYS[4], ARGV[5], ARGV[1])
+local concurrency = tonumber(ARGV[4])
+if ARGV[3] == "0" then
+    concurrency = concurrency + 1
+end
+if concurrency > 0 and redis.call("ZCARD", KEYS[5]) >= concurrency then
+    return {0, 0}
+end
+if redis.call("ZRANGE", KEYS[3], 0, 0)[1] ~= ARGV[1] then
+    return {0, 0}
+end
+redis.call("ZREM", KEYS[3], ARGV[1])
+redis.call("ZREM", KEYS[4], ARGV[1])
+redis.call("ZADD", KEYS[5], ARGV[7], ARGV[1])
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[8])
+return {1, 0}
+"""
+)
+
+# KEYS: flight key, result key, running
+# ARGV: key, token, result, result lifetime
+# Ends the download if it is still owned by the given token and stores its result.
+_land = redis.register_script(
+    """
+if redis.call("GET", KEYS[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call("DEL", KEYS[1])
+redis.call("SET", KEYS[2], ARGV[3], "EX", ARGV[4])
+redis.call("ZREM", KEYS[3], ARGV[1])
+return 1
+"""
+)
+
+
+class DownloadDeferred(Exception):
+    """Raised if a download can not start yet, because no slot is free
+    or because another process is downloading the same song.
+    The caller tries again after RETRY_DELAY seconds."""
+
+
+def queue_priority(key: Optional[int]) -> float:
+    """Returns the position of the queued song with the given id.
+    Songs that are not queued are downloaded last."""
+    if key is None:
+        return math.inf
+    position = live_queue.position(key, ranked=storage.get("voting_enabled"))
+    if position is None:
+        return math.inf
+    return position
+
+
+def status() -> str:
+    """Returns the number of running and waiting downloads."""
+    running = redis.redis_connection.zcard(RUNNING_KEY)
+    pending = redis.redis_connection.zcard(PENDING_KEY)
+    return f"{running} / {pending}"
+
+
+def singleflight(
+    key: str,
+    download: Callable[[], bool],
+    priority: Optional[Callable[[], float]] = None,
+) -> bool:
+    """Calls :param download: unless a download with the same :param key: is in progress.
+    Returns whether the download succeeded. If a download with the same key
+    finished recently, its result is returned without downloading again.
+    Only a limited number of downloads run at once, those with a lower :param priority:
+    start first. If the download can not start right away, DownloadDeferred is raised."""
+    token = uuid.uuid4().hex
+    now = time.time()
+    state, result = _start(
+        keys=[
+            FLIGHT_PREFIX + key,
+            RESULT_PREFIX + key,
+            PENDING_KEY,
+            HEARTBEAT_KEY,
+            RUNNING_KEY,
+        ],
+        args=[
+            key,
+            token,
+            priority() if priority else math.inf,
+            storage.get("download_concurrency"),
+            now,
+            # a download that was not tried again for a while was given up
+            now - 5 * RETRY_DELAY,
+            now + DOWNLOAD_TIMEOUT,
+            DOWNLOAD_TIMEOUT,
+        ],
+    )
+    if state == FINISHED:
+        redis.incr("downloads_deduplicated")
+        return bool(result)
+    if state != STARTED:
+        raise DownloadDeferred()
+
+    success = False
+    try:
+        success = download()
+    finally:
+        if not _land(
+            keys=[FLIGHT_PREFIX + key, RESULT_PREFIX + key, RUNNING_KEY],
+            args=[key, token, int(success), RESULT_LIFETIME],
+        ):
+            logging.warning(
+                "download of %s took longer than %ss", key, DOWNLOAD_TIMEOUT
+            )
+    return success
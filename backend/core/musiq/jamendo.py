@@ -11,8 +11,7 @@ import requests
 from django.http.response import HttpResponse
 
 import core.settings.storage as storage
-from core.musiq import song_utils
-from core.musiq import musiq
+from core.musiq import music_provider, song_utils
 from core.musiq.song_provider import SongProvider
 from core.musiq.playlist_provider import PlaylistProvider
 
@@ -197,19 +196,13 @@ class JamendoSongProvider(SongProvider, Jamendo):
             params={"id": self.id, "limit": storage.get("basic.max_playlist_items")},
         )
 
-        for track in result["results"]:
-            external_url = track["shareurl"]
-            musiq.do_request_music(
-                "",
-                external_url,
-                None,
-                False,
-                "jamendo",
-                archive=False,
-                manually_requested=False,
-            )
-
-        return HttpResponse("queueing radio")
+        return music_provider.request_radio(
+            [
+                SongProvider.create(external_url=track["shareurl"])
+                for track in result["results"]
+            ],
+            session_key,
+        )
 
 
 class JamendoPlaylistProvider(PlaylistProvider, Jamendo):
@@ -0,0 +1,769 @@
+"""This module keeps the live song queue in redis.
+The redis representation is authoritative for the order and the votes of queued songs.
+Changes are written to the database asynchronously, so the queue survives a restart."""
+
+from __future__ import annotations
+
+import random
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+from django.db import transaction
+from redis.exceptions import ResponseError
+
+import core.models
+from core import redis, util
+from core.celery import app
+from core.musiq import song_utils
+from core.state_handler import send_state
+
+if TYPE_CHECKING:
+    from core.models import QueuedSong
+
+# sorted set of all queued song ids, scored by their index
+ORDER_KEY = "live_queue:order"
+# sorted set of all queued song ids, scored by votes (descending) and index (ascending)
+RANKED_KEY = "live_queue:ranked"
+# set of song ids whose state in the database is outdated
+DIRTY_KEY = "live_queue:dirty"
+# set while a persistence is scheduled, expires in case the scheduled task got lost
+PERSIST_PENDING_KEY = "live_queue:persist_pending"
+# the longest time a persistence may take, in seconds
+PERSIST_TIMEOUT = 60
+# the same two orders, only containing confirmed songs.
+# The next song to play is always the first entry of one of these.
+CONFIRMED_ORDER_KEY = "live_queue:confirmed_order"
+CONFIRMED_RANKED_KEY = "live_queue:confirmed_ranked"
+# prefix of the hashes that contain the fields of every queued song
+SONG_PREFIX = "live_queue:song:"
+# incremented for every patch that is sent to the clients
+VERSION_KEY = "live_queue:version"
+# every patch is also announced on this channel, e.g. for the playback loop
+CHANGED_CHANNEL = "live_queue:changed"
+
+# Votes and index are combined into one score for the ranked set.
+# Scores are doubles, indices need to stay below VOTE_WEIGHT / 2
+# and votes below 2 ** 12 for the combined score to be exact.
+VOTE_WEIGHT = 1 << 40
+
+FIELDS = (
+    "id",
+    "index",
+    "manually_requested",
+    "votes",
+    "internal_url",
+    "external_url",
+    "stream_url",
+    "artist",
+    "title",
+    "duration",
+)
+
+connection = redis.redis_connection
+
+# Helpers shared by all scripts that modify the queue.
+# KEYS: order, ranked, dirty, confirmed order, confirmed ranked
+# ARGV: prefix, weight, ...
+# Every modified song is marked as dirty.
+# Scripts that mark songs return whether they did, so persistence can be scheduled.
+_HELPERS = """
+local function mark_dirty(id)
+    redis.call("SADD", KEYS[3], id)
+    return 1
+end
+-- stores the index of the song and updates its position in all sorted sets
+local function place(id, index)
+    local key = ARGV[1] .. id
+    redis.call("HSET", key, "index", string.format("%d", index))
+    local song = redis.call("HMGET", key, "votes", "internal_url")
+    local score = -tonumber(song[1]) * tonumber(ARGV[2]) + tonumber(index)
+    redis.call("ZADD", KEYS[1], index, id)
+    redis.call("ZADD", KEYS[2], score, id)
+    if song[2] and song[2] ~= "" then
+        redis.call("ZADD", KEYS[4], index, id)
+        redis.call("ZADD", KEYS[5], score, id)
+    end
+end
+-- removes the song from the queue and returns its fields
+local function take(id)
+    local key = ARGV[1] .. id
+    local song = redis.call("HGETALL", key)
+    redis.call("DEL", key)
+    for i = 1, 5 do
+        if i ~= 3 then
+            redis.call("ZREM", KEYS[i], id)
+        end
+    end
+    return song
+end
+"""
+
+# ARGV: prefix, weight, id, index, spacing, field, value, field, value, ...
+# Appends the song at the end of the queue.
+# The given index is only kept if it is still behind the last song.
+# Returns the index and whether persistence needs to be scheduled.
+_add = redis.register_script(
+    _HELPERS
+    + """
+local id = ARGV[3]
+local index = tonumber(ARGV[4])
+local schedule = 0
+local last = redis.call("ZRANGE", KEYS[1], -1, -1, "WITHSCORES")
+if #last > 0 and tonumber(last[2]) >= index then
+    index = tonumber(last[2]) + tonumber(ARGV[5])
+    schedule = mark_dirty(id)
+end
+local fields = {}
+for i = 6, #ARGV do
+    fields[#fields + 1] = ARGV[i]
+end
+redis.call("HSET", ARGV[1] .. id, unpack(fields))
+place(id, index)
+return {string.format("%d", index), schedule}
+"""
+)
+
+# ARGV: prefix, weight, id, field, value, field, value, ...
+# Updates the fields of the song, if it is still queued.
+_update = redis.register_script(
+    _HELPERS
+    + """
+local id = ARGV[3]
+local key = ARGV[1] .. id
+if redis.call("EXISTS", key) == 0 then
+    return 0
+end
+local fields = {}
+for i = 4, #ARGV do
+    fields[#fields + 1] = ARGV[i]
+end
+redis.call("HSET", key, unpack(fields))
+-- the song might have been confirmed
+place(id, redis.call("HGET", key, "index"))
+return 1
+"""
+)
+
+# ARGV: prefix, weight, id (may be empty), ranked
+# Removes the given song and returns its fields.
+# If no id is given, the first confirmed song is removed,
+# by votes if ranked is "1", otherwise by index.
+_pop = redis.register_script(
+    _HELPERS
+    + """
+local id = ARGV[3]
+if id == "" then
+    local confirmed = ARGV[4] == "1" and KEYS[5] or KEYS[4]
+    id = redis.call("ZRANGE", confirmed, 0, 0)[1]
+    if not id then
+        return false
+    end
+end
+if redis.call("EXISTS", ARGV[1] .. id) == 0 then
+    return false
+end
+local song = take(id)
+table.insert(song, 1, mark_dirty(id))
+return song
+"""
+)
+
+# ARGV: prefix, weight, id, amount, threshold
+# Changes the votes of the song. If they drop to the threshold, the song is removed.
+# Returns the new votes, whether persistence needs to be scheduled
+# and the fields of the song if it was removed.
+_vote = redis.register_script(
+    _HELPERS
+    + """
+local id = ARGV[3]
+local key = ARGV[1] .. id
+if redis.call("EXISTS", key) == 0 then
+    return false
+end
+local votes = redis.call("HINCRBY", key, "votes", ARGV[4])
+local schedule = mark_dirty(id)
+if votes <= tonumber(ARGV[5]) then
+    return {votes, schedule, unpack(take(id))}
+end
+place(id, redis.call("HGET", key, "index"))
+return {votes, schedule}
+"""
+)
+
+# ARGV: prefix, weight, id, prev id, next id, spacing
+# Moves the song between the two given songs. Either neighbour may be empty,
+# meaning the song is moved to the front or the back of the queue.
+# Returns the size of the smaller gap next to the song,
+# whether persistence needs to be scheduled and the new index of the song.
+# A gap of 0 means that there is no room between the neighbours and the queue needs a rebalance.
+_reorder = redis.register_script(
+    _HELPERS
+    + """
+local id, prev, next = ARGV[3], ARGV[4], ARGV[5]
+local spacing = tonumber(ARGV[6])
+local old_index = redis.call("ZSCORE", KEYS[1], id)
+if not old_index then
+    return redis.error_reply("reordered song does not exist")
+end
+local prev_index = prev ~= "" and tonumber(redis.call("ZSCORE", KEYS[1], prev))
+local next_index = next ~= "" and tonumber(redis.call("ZSCORE", KEYS[1], next))
+-- the song that is moved is not considered when checking its new neighbours
+redis.call("ZREM", KEYS[1], id)
+local function fail(message)
+    redis.call("ZADD", KEYS[1], old_index, id)
+    return redis.error_reply(message)
+end
+local first = redis.call("ZRANGE", KEYS[1], 0, 0)[1]
+local last = redis.call("ZRANGE", KEYS[1], -1, -1)[1]
+local index
+if not prev_index and not next_index then
+    if first then
+        return fail("reordered song is not the only one")
+    end
+    index = tonumber(old_index)
+elseif not prev_index then
+    if next ~= first then
+        return fail("given first is not head of the queue")
+    end
+    index = next_index - spacing
+elseif not next_index then
+    if prev ~= last then
+        return fail("given last is not tail of the queue")
+    end
+    index = prev_index + spacing
+else
+    if next_index <= prev_index or redis.call(
+        "ZCOUNT", KEYS[1], "(" .. prev_index, "(" .. next_index
+    ) > 0 then
+        return fail("given pair of songs is not adjacent")
+    end
+    if next_index - prev_index < 2 then
+        redis.call("ZADD", KEYS[1], old_index, id)
+        return {0, 0, 0}
+    end
+    index = math.floor((prev_index + next_index) / 2)
+end
+local gap = spacing
+if prev_index then
+    gap = math.min(gap, index - prev_index)
+end
+if next_index then
+    gap = math.min(gap, next_index - index)
+end
+place(id, index)
+return {gap, mark_dirty(id), string.format("%d", index)}
+"""
+)
+
+# ARGV: prefix, weight, spacing
+# Spreads out the indices of all songs evenly, keeping their order.
+# Returns whether persistence needs to be scheduled and the ids of all songs in order.
+_rebalance = redis.register_script(
+    _HELPERS
+    + """
+local spacing = tonumber(ARGV[3])
+local schedule = 0
+local ids = redis.call("ZRANGE", KEYS[1], 0, -1)
+for position, id in ipairs(ids) do
+    place(id, position * spacing)
+    if mark_dirty(id) == 1 then
+        schedule = 1
+    end
+end
+return {schedule, ids}
+"""
+)
+
+# ARGV: prefix, weight, start, autoplay only, seed, ranked
+# Randomly permutes the indices of all songs after the first start songs among each other.
+# If ranked is "1", start refers to the order by votes, which clients see during voting.
+# Only songs with equal votes exchange their indices, the first songs stay in front.
+# If autoplay only is "1", manually requested songs keep their index as well.
+# Reading and reordering happens in one step, so concurrent changes are not overwritten.
+# Returns whether persistence needs to be scheduled and the moved ids with their new index.
+_shuffle = redis.register_script(
+    _HELPERS
+    + """
+local ranked = ARGV[6] == "1"
+local ids = redis.call("ZRANGE", ranked and KEYS[2] or KEYS[1], tonumber(ARGV[3]), -1)
+local groups = {}
+local order = {}
+for _, id in ipairs(ids) do
+    local song = redis.call("HMGET", ARGV[1] .. id, "manually_requested", "votes", "index")
+    if ARGV[4] ~= "1" or song[1] ~= "1" then
+        local name = ranked and song[2] or ""
+        if not groups[name] then
+            groups[name] = {songs = {}, indices = {}}
+            order[#order + 1] = name
+        end
+        local group = groups[name]
+        group.songs[#group.songs + 1] = id
+        group.indices[#group.indices + 1] = song[3]
+    end
+end
+math.randomseed(tonumber(ARGV[5]))
+local schedule = 0
+local moved = {}
+for _, name in ipairs(order) do
+    local songs = groups[name].songs
+    local indices = groups[name].indices
+    for i = #indices, 2, -1 do
+        local j = math.random(i)
+        indices[i], indices[j] = indices[j], indices[i]
+    end
+    for i, id in ipairs(songs) do
+        place(id, indices[i])
+        moved[#moved + 1] = id
+        moved[#moved + 1] = indices[i]
+        if mark_dirty(id) == 1 then
+            schedule = 1
+        end
+    end
+end
+return {schedule, moved}
+"""
+)
+
+# ARGV: prefix, field, field, ...
+# Returns the given fields of every song in the order of the given sorted set.
+_songs = redis.register_script(
+    """
+local fields = {}
+for i = 2, #ARGV do
+    fields[#fields + 1] = ARGV[i]
+end
+local songs = {}
+for _, id in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
+    songs[#songs + 1] = redis.call("HMGET", ARGV[1] .. id, unpack(fields))
+end
+return songs
+"""
+)
+
+# Returns the ids of all dirty songs and clears the set.
+_take_dirty = redis.register_script(
+    """
+local ids = redis.call("SMEMBERS", KEYS[1])
+redis.call("DEL", KEYS[1])
+return ids
+"""
+)
+
+
+def _keys() -> List[str]:
+    return [ORDER_KEY, RANKED_KEY, DIRTY_KEY, CONFIRMED_ORDER_KEY, CONFIRMED_RANKED_KEY]
+
+
+def _encode(song: "QueuedSong") -> Dict[str, Any]:
+    fields: Dict[str, Any] = {}
+    for field in FIELDS:
+        value = getattr(song, field)
+        if value is None:
+            value = ""
+        elif isinstance(value, bool):
+            value = int(value)
+        fields[field] = value
+    return fields
+
+
+def _flatten(fields: Dict[str, Any]) -> List[Any]:
+    return [item for pair in fields.items() for item in pair]
+
+
+# converts the values stored in redis back into their python types
+_CONVERTERS: Dict[str, Callable[[str], Any]] = {
+    "id": int,
+    "index": int,
+    "votes": int,
+    "duration": float,
+    "manually_requested": lambda value: value == "1",
+    "internal_url": lambda value: value or None,
+    "stream_url": lambda value: value or None,
+}
+
+
+def _decode_values(values: List[str], fields: Sequence[str] = FIELDS) -> Dict[str, Any]:
+    return {
+        field: _CONVERTERS.get(field, str)(value)
+        for field, value in zip(fields, values)
+    }
+
+
+def _decode(flat: List[str]) -> Dict[str, Any]:
+    raw = dict(zip(flat[::2], flat[1::2]))
+    return _decode_values([raw.get(field, "") for field in FIELDS])
+
+
+def _fields(song: "QueuedSong") -> Dict[str, Any]:
+    return {field: getattr(song, field) for field in FIELDS}
+
+
+def _rank(votes: int, index: int) -> int:
+    return -votes * VOTE_WEIGHT + index
+
+
+def _schedule_persist(schedule: int) -> None:
+    # Only one persistence is scheduled at a time,
+    # so a burst of changes is written to the database in one go.
+    # If the scheduled task is lost, e.g. because the transaction was rolled back,
+    # the marker expires and the next change schedules a new one.
+    if schedule and connection.set(PERSIST_PENDING_KEY, 1, nx=True, ex=PERSIST_TIMEOUT):
+        # wait for the surrounding transaction,
+        # songs that were just created need to be visible to the worker
+        transaction.on_commit(_persist.delay)
+
+
+def serialize(song: Dict[str, Any]) -> Dict[str, Any]:
+    """Converts the fields of a queued song into the representation sent to clients.
+    The sparse index is sent as "order", clients sort their queue by it."""
+    song_dict = util.camelize(song)
+    song_dict["order"] = song["index"]
+    song_dict["durationFormatted"] = song_utils.format_seconds(song["duration"])
+    return song_dict
+
+
+def version() -> int:
+    """Returns the version of the queue, the number of the last sent patch."""
+    return int(connection.get(VERSION_KEY) or 0)
+
+
+def _publish(ops: List[Dict[str, Any]]) -> None:
+    # Sends the given operations to all clients as one versioned patch.
+    # The version is incremented after the queue was modified,
+    # so a snapshot might already contain the changes of the following patch.
+    # All operations are idempotent, clients can apply such a patch again.
+    if not ops:
+        return
+    version = connection.incr(VERSION_KEY)
+    send_state({"queuePatch": {"version": version, "ops": ops}}, "musiq")
+    connection.publish(CHANGED_CHANNEL, version)
+
+
+def _publish_on_commit(ops: List[Dict[str, Any]]) -> None:
+    # new songs are only announced once their rows were created,
+    # clients must not see songs whose transaction is rolled back
+    transaction.on_commit(lambda: _publish(ops))
+
+
+def restore() -> None:
+    """Rebuilds the live queue from the database.
+    Called on startup, after redis was flushed."""
+    pipe = connection.pipeline()
+    pipe.delete(*_keys())
+    for song in core.models.QueuedSong.objects.all():
+        key = SONG_PREFIX + str(song.id)
+        order = {str(song.id): song.index}
+        ranked = {str(song.id): _rank(song.votes, song.index)}
+        pipe.delete(key)
+        pipe.hset(key, mapping=_encode(song))
+        pipe.zadd(ORDER_KEY, order)
+        pipe.zadd(RANKED_KEY, ranked)
+        if song.internal_url:
+            pipe.zadd(CONFIRMED_ORDER_KEY, order)
+            pipe.zadd(CONFIRMED_RANKED_KEY, ranked)
+    pipe.execute()
+
+
+def count() -> int:
+    """Returns the number of songs in the queue."""
+    return connection.zcard(ORDER_KEY)
+
+
+def contains(key: int) -> bool:
+    """Returns whether the song with the given id is queued."""
+    return bool(connection.exists(SONG_PREFIX + str(key)))
+
+
+def get(key: int, fields: Sequence[str] = FIELDS) -> Optional[Dict[str, Any]]:
+    """Returns the given fields of the song with the given id or None if it is not queued."""
+    values = connection.hmget(SONG_PREFIX + str(key), fields)
+    if all(value is None for value in values):
+        return None
+    return _decode_values(values, fields)
+
+
+def last_index() -> Optional[int]:
+    """Returns the index of the last song in the queue or None if it is empty."""
+    last = connection.zrange(ORDER_KEY, -1, -1, withscores=True)
+    if not last:
+        return None
+    return int(last[0][1])
+
+
+def songs(ranked: bool = False, fields: Sequence[str] = FIELDS) -> List[Dict[str, Any]]:
+    """Returns the fields of all queued songs in the order of the queue.
+    If :param ranked: is set, the songs are ordered by votes instead.
+    :param fields: restricts the returned fields."""
+    key = RANKED_KEY if ranked else ORDER_KEY
+    return [
+        _decode_values(song, fields)
+        for song in _songs(keys=[key], args=[SONG_PREFIX, *fields])
+    ]
+
+
+def position(key: int, ranked: bool = False) -> Optional[int]:
+    """Returns the position of the song with the given id or None if it is not queued.
+    If :param ranked: is set, the position in the order by votes is returned."""
+    return connection.zrank(RANKED_KEY if ranked else ORDER_KEY, key)
+
+
+def first(ranked: bool = False) -> Optional[int]:
+    """Returns the id of the song that would be played next, without removing it.
+    If :param ranked: is set, the confirmed song with the most votes is returned."""
+    confirmed = connection.zrange(
+        CONFIRMED_RANKED_KEY if ranked else CONFIRMED_ORDER_KEY, 0, 0
+    )
+    return int(confirmed[0]) if confirmed else None
+
+
+def confirmed_ids(ranked: bool = False, count: Optional[int] = None) -> List[int]:
+    """Returns the ids of all songs that are not in the process of being made available.
+    If :param ranked: is set, they are ordered by votes.
+    :param count: restricts the result to the first songs."""
+    return [
+        int(key)
+        for key in connection.zrange(
+            CONFIRMED_RANKED_KEY if ranked else CONFIRMED_ORDER_KEY,
+            0,
+            -1 if count is None else count - 1,
+        )
+    ]
+
+
+def _add_args(song: "QueuedSong") -> List[Any]:
+    from core.musiq.song_queue import INDEX_SPACING
+
+    return [SONG_PREFIX, VOTE_WEIGHT, song.id, song.index, INDEX_SPACING] + _flatten(
+        _encode(song)
+    )
+
+
+def add(song: "QueuedSong") -> int:
+    """Adds the given song to the end of the queue.
+    Returns the index of the song, which changes if another song was appended concurrently."""
+    index, schedule = _add(keys=_keys(), args=_add_args(song))
+    _schedule_persist(schedule)
+    _publish_on_commit(
+        [{"op": "insert", "song": serialize({**_fields(song), "index": int(index)})}]
+    )
+    return int(index)
+
+
+def add_many(songs: List["QueuedSong"]) -> List[int]:
+    """Adds the given songs to the end of the queue in one round trip.
+    Returns the indices of the songs."""
+    pipe = connection.pipeline(transaction=False)
+    for song in songs:
+        _add(keys=_keys(), args=_add_args(song), client=pipe)
+    results = pipe.execute()
+    _schedule_persist(max((schedule for _, schedule in results), default=0))
+    indices = [int(index) for index, _ in results]
+    _publish_on_commit(
+        [
+            {"op": "insert", "song": serialize({**_fields(song), "index": index})}
+            for song, index in zip(songs, indices)
+        ]
+    )
+    return indices
+
+
+def update(song: "QueuedSong", fields: Iterable[str]) -> None:
+    """Updates the given fields of the song in the live queue."""
+    encoded = _encode(song)
+    args = [SONG_PREFIX, VOTE_WEIGHT, song.id]
+    args += _flatten({field: encoded[field] for field in fields})
+    if _update(keys=_keys(), args=args):
+        changes = util.camelize({field: getattr(song, field) for field in fields})
+        if "duration" in fields:
+            changes["durationFormatted"] = song_utils.format_seconds(song.duration)
+        _publish([{"op": "update", "id": song.id, "song": changes}])
+
+
+def discard(keys: Iterable[int]) -> None:
+    """Removes the given songs from the live queue without touching the database.
+    Used for songs that were already deleted from the database."""
+    keys = [str(key) for key in keys]
+    if not keys:
+        return
+    pipe = connection.pipeline()
+    pipe.delete(*[SONG_PREFIX + key for key in keys])
+    for sorted_set in (
+        ORDER_KEY,
+        RANKED_KEY,
+        CONFIRMED_ORDER_KEY,
+        CONFIRMED_RANKED_KEY,
+    ):
+        pipe.zrem(sorted_set, *keys)
+    pipe.execute()
+    _publish([{"op": "remove", "id": int(key)} for key in keys])
+
+
+def clear() -> None:
+    """Removes all songs from the live queue without touching the database."""
+    discard(connection.zrange(ORDER_KEY, 0, -1))
+
+
+def pop(key: Optional[int] = None, ranked: bool = False) -> Optional[Dict[str, Any]]:
+    """Removes the song with the given id from the queue and returns its fields.
+    If no id is given, the first confirmed song is removed.
+    If :param ranked: is set, the confirmed song with the most votes is removed instead.
+    Returns None if no such song exists."""
+    result = _pop(
+        keys=_keys(),
+        args=[SONG_PREFIX, VOTE_WEIGHT, "" if key is None else key, int(ranked)],
+    )
+    if not result:
+        return None
+    schedule, *flat = result
+    _schedule_persist(schedule)
+    song = _decode(flat)
+    _publish([{"op": "remove", "id": song["id"]}])
+    return song
+
+
+def vote(
+    key: int, amount: int, threshold: int
+) -> Optional[Tuple[int, Optional[Dict[str, Any]]]]:
+    """Modify the vote-count of the song specified by :param key: by :param amount: votes.
+    If the song is now at or below the threshold, it is removed.
+    Returns the new vote count and the fields of the removed song (if it was removed).
+    Returns None if the song is not queued."""
+    result = _vote(
+        keys=_keys(), args=[SONG_PREFIX, VOTE_WEIGHT, key, amount, threshold]
+    )
+    if not result:
+        return None
+    votes, schedule, *flat = result
+    _schedule_persist(schedule)
+    if flat:
+        _publish([{"op": "remove", "id": key}])
+        return votes, _decode(flat)
+    _publish([{"op": "votes", "id": key, "votes": votes}])
+    return votes, None
+
+
+def reorder(new_prev_id: Optional[int], element_id: int, new_next_id: Optional[int]):
+    """Moves the song specified by :param element_id:
+    between the two songs :param new_prev_id: and :param new_next_id:.
+    Returns the size of the smaller gap next to the moved song.
+    Raises a ValueError if the given neighbours do not match the current queue."""
+    from core.musiq.song_queue import INDEX_SPACING
+
+    args = [
+        SONG_PREFIX,
+        VOTE_WEIGHT,
+        element_id,
+        "" if new_prev_id is None else new_prev_id,
+        "" if new_next_id is None else new_next_id,
+        INDEX_SPACING,
+    ]
+    try:
+        gap, schedule, index = _reorder(keys=_keys(), args=args)
+        if gap == 0:
+            # there was no room between the two neighbours
+            rebalance()
+            gap, schedule, index = _reorder(keys=_keys(), args=args)
+    except ResponseError as error:
+        raise ValueError(str(error)) from error
+    _schedule_persist(schedule)
+    _publish([{"op": "move", "id": element_id, "order": int(index)}])
+    return gap
+
+
+def prioritize(key: int) -> None:
+    """Moves the song specified by :param key: to the front of the queue."""
+    first = connection.zrange(ORDER_KEY, 0, 0)
+    if not first or first[0] == str(key):
+        if not contains(key):
+            raise ValueError("prioritized song does not exist")
+        return
+    reorder(None, key, int(first[0]))
+
+
+def rebalance() -> None:
+    """Spreads out the indices of all songs evenly, keeping their order."""
+    from core.musiq.song_queue import INDEX_SPACING
+
+    schedule, ids = _rebalance(
+        keys=_keys(), args=[SONG_PREFIX, VOTE_WEIGHT, INDEX_SPACING]
+    )
+    _schedule_persist(schedule)
+    _publish(
+        [
+            {"op": "move", "id": int(key), "order": position * INDEX_SPACING}
+            for position, key in enumerate(ids, start=1)
+        ]
+    )
+
+
+def shuffle(start: int = 0, autoplay_only: bool = False, ranked: bool = False) -> None:
+    """Randomly permutes the indices of all songs after the first :param start: songs.
+    If :param autoplay_only: is set, manually requested songs keep their index as well.
+    If :param ranked: is set, the first songs are counted in the order by votes
+    and only songs with equal votes are shuffled among each other."""
+    schedule, moved = _shuffle(
+        keys=_keys(),
+        args=[
+            SONG_PREFIX,
+            VOTE_WEIGHT,
+            start,
+            int(autoplay_only),
+            random.getrandbits(31),
+            int(ranked),
+        ],
+    )
+    _schedule_persist(schedule)
+    _publish(
+        [
+            {"op": "move", "id": int(key), "order": int(index)}
+            for key, index in zip(moved[::2], moved[1::2])
+        ]
+    )
+
+
+def persist() -> None:
+    """Writes the state of all dirty songs to the database."""
+    with redis.lock(
+        "live_queue_persist_lock",
+        timeout=PERSIST_TIMEOUT,
+        blocking_timeout=PERSIST_TIMEOUT,
+    ):
+        # changes from now on need another persistence
+        connection.delete(PERSIST_PENDING_KEY)
+        dirty = [int(key) for key in _take_dirty(keys=[DIRTY_KEY])]
+        if not dirty:
+            return
+        pipe = connection.pipeline()
+        for key in dirty:
+            pipe.hmget(SONG_PREFIX + str(key), "index", "votes")
+        states = dict(zip(dirty, pipe.execute()))
+
+        removed = [key for key, (index, _) in states.items() if index is None]
+        with transaction.atomic():
+            core.models.QueuedSong.objects.filter(id__in=removed).delete()
+            songs_to_update = list(
+                core.models.QueuedSong.objects.in_bulk(
+                    [key for key in dirty if key not in removed]
+                ).values()
+            )
+            for song in songs_to_update:
+                index, votes = states[song.id]
+                song.index = int(index)
+                song.votes = int(votes)
+            core.models.QueuedSong.objects.bulk_update(
+                songs_to_update, ["index", "votes"]
+            )
+
+
+@app.task
+def _persist() -> None:
+    persist()
@@ -0,0 +1,148 @@
+"""This module determines the loudness of songs so their volume can be normalized.
+The analysis is expensive, so it runs after a song was confirmed, one song at a time
+and with the lowest cpu priority. The resulting gain is stored and never computed again.
+Only downloaded songs are analyzed. Mopidy applies the gain it finds in the tags of a file
+and files of the local library are never modified."""
+
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import mutagen
+import mutagen.mp4
+from django.conf import settings as conf
+from django.db import connection
+
+from core import redis
+from core.celery import app
+from core.models import ArchivedSong
+
+# only one song is analyzed at a time, the timeout frees the lock if a worker dies
+analysis_lock = redis.lock("loudness_lock", timeout=10 * 60)
+# while another song is analyzed, the analysis is tried again after this many seconds
+RETRY_DELAY = 10
+
+# the name of the tag in which mopidy looks for the gain of a song
+GAIN_TAG = "replaygain_track_gain"
+# m4a files store custom tags under this prefix
+MP4_GAIN_TAG = "----:com.apple.iTunes:" + GAIN_TAG
+
+
+def read_gain(path: str) -> Optional[float]:
+    """Returns the gain stored in the tags of the given file, if any."""
+    try:
+        parsed = mutagen.File(path)
+    except mutagen.MutagenError:
+        return None
+    if parsed is None or parsed.tags is None:
+        return None
+    for key in parsed.tags.keys():
+        if not key.lower().endswith(GAIN_TAG):
+            continue
+        value = parsed.tags[key]
+        # depending on the format, the value is a frame, a list of strings or of bytes
+        value = getattr(value, "text", value)
+        if isinstance(value, list):
+            value = value[0]
+        if isinstance(value, bytes):
+            value = value.decode(errors="ignore")
+        match = re.match(r"\s*([-+]?\d+(\.\d+)?)", str(value))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+@contextmanager
+def _copy(path: str) -> Iterator[str]:
+    # Provides a copy of the file that can be modified while the original is playing.
+    # The copy is placed in the song cache, so it can replace a downloaded song atomically,
+    # the directory of a library file might not even be writable.
+    with tempfile.TemporaryDirectory(dir=conf.SONGS_CACHE_DIR) as directory:
+        copy = os.path.join(directory, os.path.basename(path))
+        shutil.copyfile(path, copy)
+        yield copy
+
+
+def _write_gain(path: str, gain: float) -> None:
+    # only downloaded songs are tagged, which are always m4a files
+    with _copy(path) as copy:
+        parsed = mutagen.mp4.MP4(copy)
+        parsed[MP4_GAIN_TAG] = [mutagen.mp4.MP4FreeForm(f"{gain:.2f} dB".encode())]
+        parsed.save()
+        # a player that opened the file keeps reading the old one
+        os.replace(copy, path)
+
+
+def _run_rganalysis(path: str) -> bool:
+    # tags the file with the gain, returns whether rganalysis is installed
+    try:
+        subprocess.call(
+            ["rganalysis", path],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=lambda: os.nice(19),
+        )
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False  # the rganalysis package was not found. Skip normalization
+        raise
+    return True
+
+
+def _compute_gain(path: str) -> Optional[float]:
+    # Analyzes a copy of the file, the original might be playing right now.
+    # The tagged copy replaces the file afterwards.
+    with _copy(path) as copy:
+        if not _run_rganalysis(copy):
+            return None
+        gain = read_gain(copy)
+        if gain is not None:
+            os.replace(copy, path)
+    return gain
+
+
+@app.task
+def analyze(external_url: str, path: str) -> None:
+    """Determines the gain of the song with the given url from its file at the given path.
+    A gain that was already stored is written into the file instead of analyzing it again."""
+    try:
+        if not _analyze(external_url, path):
+            # do not occupy a worker while waiting for the other analysis
+            analyze.apply_async((external_url, path), countdown=RETRY_DELAY)
+    except (OSError, mutagen.MutagenError) as e:
+        # the file might have been removed in the meantime
+        logging.warning("could not analyze loudness of %s: %s", path, e)
+    finally:
+        connection.close()
+
+
+def _analyze(external_url: str, path: str) -> bool:
+    # returns False if the song has to wait because another one is analyzed
+    stored_gain = (
+        ArchivedSong.objects.filter(url=external_url)
+        .values_list("gain", flat=True)
+        .first()
+    )
+    gain = read_gain(path)
+    if gain is None:
+        if stored_gain is not None:
+            # the file was downloaded again, e.g. after it was removed from the cache
+            _write_gain(path, stored_gain)
+            return True
+        if not analysis_lock.acquire(blocking=False):
+            return False
+        try:
+            gain = _compute_gain(path)
+        finally:
+            analysis_lock.release()
+    if gain is not None and gain != stored_gain:
+        ArchivedSong.objects.filter(url=external_url).update(gain=gain)
+    return True
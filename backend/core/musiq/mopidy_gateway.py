@@ -0,0 +1,263 @@
+"""This module contains the single point of access to mopidy's rpc interface.
+Mopidy can not handle parallel inputs, so all commands are executed one after another
+by the thread of the gateway, which is run next to the playback loop.
+Other processes submit their commands through a redis stream without waiting for them."""
+
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from mopidyapi import MopidyAPI
+from mopidyapi.exceptions import MopidyError
+from mopidyapi.parsedata import deserialize_mopidy, serialize_mopidy
+from redis.exceptions import RedisError
+
+from core import redis
+
+# commands of other processes, processed entries are deleted.
+# Entries left over from a previous gateway are discarded when the gateway starts.
+COMMAND_STREAM = "mopidy:commands"
+# the stream is checked for commands in this interval (in seconds) in order to notice a stop
+STREAM_TIMEOUT = 1
+# the method of commands that consist of several calls, sent to mopidy in a single request
+BATCH = "batch"
+# how long mopidy may take to answer a request, in seconds
+# adding a stream to the tracklist makes mopidy resolve it, which takes a few seconds
+REQUEST_TIMEOUT = 15
+# how long a caller waits for its command, including the commands queued before it
+RESULT_TIMEOUT = 2 * REQUEST_TIMEOUT
+# the latencies are written to redis at most this often, in seconds
+LATENCY_INTERVAL = 5
+
+# a mopidy method with its keyword arguments
+Call = Tuple[str, Dict[str, Any]]
+
+
+def _timed_out(reason: str) -> requests.exceptions.ConnectionError:
+    # Mopidy does not respond, callers handle this like a lost connection.
+    # Returns the error that should be raised.
+    from core.musiq import playback
+
+    logging.warning("mopidy timed out: %s", reason)
+    playback.set_playback_error(True)
+    return requests.exceptions.ConnectionError(reason)
+
+
+def send(method: str, **params: Any) -> None:
+    """Submits a command to the gateway and returns without waiting for its execution.
+    :param method: is either the name of a mopidy method or a procedure of the gateway."""
+    redis.redis_connection.xadd(
+        COMMAND_STREAM, {"method": method, "params": json.dumps(params)}
+    )
+
+
+class Command:
+    """A single call that is waiting to be executed."""
+
+    def __init__(
+        self,
+        method: str,
+        params: Any,
+        submitted: float,
+        future: Optional[Future] = None,
+    ) -> None:
+        self.method = method
+        self.params = params
+        # the time the command was submitted, used to measure its latency
+        self.submitted = submitted
+        # the caller waiting for the result, if any
+        self.future = future
+
+
+class Gateway:
+    """Owns the connection to mopidy and executes every command in a single thread.
+    No lock is needed, commands queue up and are sent over the same connection."""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.url = f"http://{host}:{port}/mopidy/rpc"
+        self.session = requests.Session()
+        self.commands: queue.Queue[Optional[Command]] = queue.Queue()
+        self.stopped = False
+        # the latest latency in milliseconds of every method
+        self.latencies: Dict[str, float] = {}
+        self.latencies_written = 0.0
+        # commands that are executed by the gateway with several mopidy calls
+        self.procedures: Dict[str, Callable[..., Any]] = {"seek_by": self._seek_by}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.stream_thread = threading.Thread(target=self._read_stream, daemon=True)
+
+    def start(self) -> None:
+        """Starts executing commands.
+        Commands that were submitted while no gateway was running are discarded,
+        e.g. a skip that was not executed before a restart must not skip another song."""
+        redis.redis_connection.xtrim(COMMAND_STREAM, maxlen=0)
+        self.thread.start()
+        self.stream_thread.start()
+
+    def stop(self) -> None:
+        """Stops after all commands that were submitted so far are executed."""
+        self.stopped = True
+        self.stream_thread.join()
+        self.commands.put(None)
+        self.thread.join()
+        self.session.close()
+        self._write_latencies()
+
+    def submit(self, method: str, *args: Any, **kwargs: Any) -> Future:
+        """Queues the given command. The returned future resolves to its result."""
+        future: Future = Future()
+        params = kwargs if kwargs else list(args)
+        self.commands.put(Command(method, params, time.time(), future))
+        return future
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        """Executes the given command and returns its result."""
+        return self._result_of(method, self.submit(method, *args, **kwargs))
+
+    def call_batch(self, calls: List[Call]) -> List[Any]:
+        """Executes the given calls in order with a single request.
+        Returns their results. Raises an error if one of them failed."""
+        future: Future = Future()
+        self.commands.put(Command(BATCH, calls, time.time(), future))
+        return self._result_of(BATCH, future)
+
+    @staticmethod
+    def _result_of(method: str, future: Future) -> Any:
+        try:
+            return future.result(timeout=RESULT_TIMEOUT)
+        except FutureTimeoutError:
+            raise _timed_out(f"{method} was not executed in time")
+
+    def _read_stream(self) -> None:
+        last_id = "0"
+        while not self.stopped:
+            try:
+                response = redis.redis_connection.xread(
+                    {COMMAND_STREAM: last_id}, block=STREAM_TIMEOUT * 1000
+                )
+            except RedisError:
+                logging.exception("could not read mopidy commands")
+                time.sleep(STREAM_TIMEOUT)
+                continue
+            for _, entries in response:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    # stream ids start with the time of insertion in milliseconds
+                    submitted = int(entry_id.split("-")[0]) / 1000
+                    self.commands.put(
+                        Command(
+                            fields["method"], json.loads(fields["params"]), submitted
+                        )
+                    )
+                redis.redis_connection.xdel(
+                    COMMAND_STREAM, *[entry_id for entry_id, _ in entries]
+                )
+
+    def _run(self) -> None:
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            try:
+                if command.method == BATCH:
+                    result = self._rpc_batch(command.params)
+                elif command.method in self.procedures:
+                    result = self.procedures[command.method](**command.params)
+                else:
+                    result = self._rpc(command.method, command.params)
+            except Exception as e:  # pylint: disable=broad-except
+                # the gateway needs to keep running, errors are passed to the caller
+                if command.future is None:
+                    logging.warning("mopidy command %s failed: %s", command.method, e)
+                else:
+                    command.future.set_exception(e)
+            else:
+                if command.future is not None:
+                    command.future.set_result(result)
+            self.latencies[command.method] = (time.time() - command.submitted) * 1000
+            if time.time() - self.latencies_written > LATENCY_INTERVAL:
+                self._write_latencies()
+
+    def _write_latencies(self) -> None:
+        redis.set("mopidy_latency", self.latencies)
+        self.latencies_written = time.time()
+
+    def _post(self, request: Any) -> Any:
+        try:
+            return self.session.post(
+                self.url, json=request, timeout=REQUEST_TIMEOUT
+            ).json()
+        except json.JSONDecodeError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except requests.exceptions.Timeout as e:
+            raise _timed_out(str(e))
+
+    @staticmethod
+    def _request(request_id: int, method: str, params: Any) -> Dict[str, Any]:
+        request: Dict[str, Any] = {"jsonrpc": "2.0", "id": request_id, "method": method}
+        if params:
+            request["params"] = serialize_mopidy(params)
+        return request
+
+    @staticmethod
+    def _result(response: Dict[str, Any]) -> Any:
+        if "error" in response:
+            raise MopidyError(
+                response["error"].get("data", {}).get("message")
+                or response["error"].get("message")
+            )
+        return deserialize_mopidy(response["result"])
+
+    def _rpc(self, method: str, params: Any) -> Any:
+        return self._result(self._post(self._request(0, method, params)))
+
+    def _rpc_batch(self, calls: List[Call]) -> List[Any]:
+        # Mopidy executes the calls of a batch in order,
+        # but the responses may be returned in any order.
+        responses = self._post(
+            [
+                self._request(request_id, method, params)
+                for request_id, (method, params) in enumerate(calls)
+            ]
+        )
+        if not isinstance(responses, list):
+            # the batch itself was invalid
+            return [self._result(responses)]
+        responses.sort(key=lambda response: response["id"])
+        return [self._result(response) for response in responses]
+
+    def _seek_by(self, offset: int) -> None:
+        # moves the position of the current song by the given amount of milliseconds
+        position = self._rpc("core.playback.get_time_position", [])
+        self._rpc("core.playback.seek", {"time_position": max(position + offset, 0)})
+
+
+class GatewayAPI(MopidyAPI):
+    """A mopidy client whose rpc calls are executed by the given gateway.
+    Events are received directly from mopidy."""
+
+    def __init__(self, gateway: Gateway, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.gateway = gateway
+
+    def rpc_call(self, command: str, *args: Any, **kwargs: Any) -> Any:
+        return self.gateway.call(command, *args, **kwargs)
+
+    def batch(self, *calls: Call) -> List[Any]:
+        """Executes the given calls with a single request and returns their results."""
+        return self.gateway.call_batch(list(calls))
+
+
+def latencies() -> List[str]:
+    """Returns a description of the latest latency of every mopidy method."""
+    return [
+        f"{method.rsplit('.', 1)[-1]}: {latency:.0f} ms"
+        for method, latency in sorted(redis.get("mopidy_latency").items())
+    ]
@@ -2,12 +2,19 @@
 
 from __future__ import annotations
 
-from typing import Optional
+import logging
+from threading import Event
+from typing import List, Optional, TYPE_CHECKING
+
+from django.http.response import HttpResponse
 
 from core.settings import storage
 from core.celery import app
 from core.models import ArchivedSong
-from core.musiq import musiq, playback
+from core.musiq import downloads, musiq, playback, live_queue
+
+if TYPE_CHECKING:
+    from core.musiq.song_provider import SongProvider
 
 
 class ProviderError(Exception):
@@ -74,28 +81,46 @@ class MusicProvider:
         """Updates the placeholder in the song queue with the actual data."""
         raise NotImplementedError()
 
-    def request(
-        self, session_key: str, archive: bool = True, manually_requested: bool = True
-    ) -> None:
-        """Tries to request this resource.
-        Uses the local cache if possible, otherwise tries to retrieve it online."""
+    def check_queue_length(self) -> None:
+        """Raises a ProviderError if the queue is full."""
+        from core.musiq.song_provider import SongProvider
 
-        if 0 < storage.get("max_queue_length") <= playback.queue.count():
+        queue_length = live_queue.count()
+        if isinstance(self, SongProvider) and self.queued_song is not None:
+            # the placeholder of this request is already in the queue
+            queue_length -= 1
+        if 0 < storage.get("max_queue_length") <= queue_length:
             self.error = "Queue limit reached"
             raise ProviderError(self.error)
 
-        enqueue_function = enqueue
-
-        if not self.check_cached():
-            if self.query is not None and storage.get("additional_keywords"):
-                # add the additional keywords from the settings before checking
-                self.query += " " + storage.get("additional_keywords")
-            if not self.check_available():
-                raise ProviderError(self.error)
-
-            # overwrite the enqueue function and make the resource available before calling it
-            enqueue_function = fetch_enqueue
-
+    def resolve(self, cancelled: Optional[Event] = None) -> bool:
+        """Checks whether this resource can be provided.
+        Uses the local cache if possible, otherwise tries to retrieve it online.
+        Returns whether it needs to be fetched before it can be enqueued.
+        Raises a ProviderError if it is not available
+        or if :param cancelled: was set before it was searched online."""
+        if self.check_cached():
+            return False
+        if cancelled is not None and cancelled.is_set():
+            # the resource is not needed anymore, e.g. another provider was chosen
+            self.error = "Search cancelled"
+            raise ProviderError(self.error)
+        if self.query is not None and storage.get("additional_keywords"):
+            # add the additional keywords from the settings before checking
+            self.query += " " + storage.get("additional_keywords")
+        if not self.check_available():
+            raise ProviderError(self.error)
+        return True
+
+    def submit(
+        self,
+        fetch: bool,
+        session_key: str,
+        archive: bool = True,
+        manually_requested: bool = True,
+    ) -> None:
+        """Enqueues the placeholder of this resource and starts the task that enqueues it.
+        If :param fetch: is set, the resource is made available first."""
         from core.musiq.song_provider import SongProvider
 
         if storage.get("new_music_only") and isinstance(self, SongProvider):
@@ -109,8 +134,20 @@ class MusicProvider:
 
         self.enqueue_placeholder(manually_requested)
 
+        # make the resource available before enqueueing it if necessary
+        enqueue_function = fetch_enqueue if fetch else enqueue
         enqueue_function.delay(self, session_key, archive)
 
+    def request(
+        self, session_key: str, archive: bool = True, manually_requested: bool = True
+    ) -> None:
+        """Tries to request this resource."""
+        self.check_queue_length()
+        fetch = self.resolve()
+        self.submit(
+            fetch, session_key, archive=archive, manually_requested=manually_requested
+        )
+
 
 @app.task
 def enqueue(provider: MusicProvider, session_key: str, archive: bool) -> None:
@@ -120,11 +157,161 @@ def enqueue(provider: MusicProvider, session_key: str, archive: bool) -> None:
 
 
 @app.task
-def fetch_enqueue(provider: MusicProvider, session_key: str, archive: bool) -> None:
-    """Fetch and enqueue the music managed by the given provider."""
-    if not provider.make_available():
-        provider.remove_placeholder()
-        musiq.update_state()
+def fetch_enqueue(
+    provider: MusicProvider, session_key: str, archive: bool, fallback: bool = False
+) -> None:
+    """Fetch and enqueue the music managed by the given provider.
+    If the download can not start yet, this task is started again later."""
+    try:
+        if provider.make_available():
+            enqueue(provider, session_key, archive)
+            return
+    except downloads.DownloadDeferred:
+        # do not occupy a worker while waiting for the download
+        fetch_enqueue.apply_async(
+            (provider, session_key, archive, fallback),
+            countdown=downloads.RETRY_DELAY,
+        )
         return
+    except Exception as e:  # pylint: disable=broad-except
+        _give_up(provider, session_key, archive, fallback, error=e)
+        return
+    _give_up(provider, session_key, archive, fallback)
+
+
+def _give_up(
+    provider: MusicProvider,
+    session_key: str,
+    archive: bool,
+    fallback: bool,
+    error: Optional[Exception] = None,
+) -> None:
+    # Removes the placeholder of music that could not be provided.
+    # Providers might raise anything, such an :param error: counts as unavailable music,
+    # the placeholder must not stay in the queue.
+    # If :param fallback: is set, the song is requested from the other platforms first,
+    # like a regular request that tries the next platform.
+    from core.musiq.song_provider import SongProvider
+
+    if error is not None:
+        logging.error(
+            "error while enqueuing %s: %s", provider.query, error, exc_info=error
+        )
+
+    if (
+        fallback
+        and isinstance(provider, SongProvider)
+        # a song that was removed from the queue is not requested again
+        and provider.queued_song is not None
+        and live_queue.contains(provider.queued_song.id)
+    ):
+        successful, _, _ = musiq.do_request_music(
+            session_key,
+            provider.get_external_url(),
+            None,
+            False,
+            provider.type,
+            archive=archive,
+            manually_requested=False,
+            placeholder=provider.queued_song,
+        )
+        if successful:
+            return
+    provider.remove_placeholder()
+    musiq.update_state()
+
+
+def request_radio(providers: List["SongProvider"], session_key: str) -> HttpResponse:
+    """Enqueues the given songs, which were suggested based on the current song.
+    Songs that are not available are searched on the other platforms."""
+    from core.musiq.song_provider import SongProvider
+
+    SongProvider.request_many(
+        providers,
+        session_key,
+        archive=False,
+        manually_requested=False,
+        fallback=True,
+    )
+    return HttpResponse("queueing radio")
+
+
+@app.task
+def fetch_enqueue_many(
+    providers: List["SongProvider"],
+    session_key: str,
+    archive: bool,
+    fallback: bool = False,
+) -> None:
+    """Enqueue the songs managed by the given providers. Their placeholders already exist.
+    Songs without an id are searched first, one after another.
+    Songs that are cached are confirmed silently, the state is sent once they are confirmed.
+    Every other song is made available by its own task, so the download scheduler
+    decides which songs are downloaded first."""
+    for provider in providers:
+        try:
+            if provider.id is None:
+                fetch = _search(provider)
+                if fetch is None:
+                    provider.remove_placeholder()
+                    continue
+                if fetch:
+                    # the song was already checked during the search
+                    fetch_enqueue.delay(provider, session_key, archive, fallback)
+                    continue
+            elif not provider.check_cached():
+                check_fetch_enqueue.delay(provider, session_key, archive, fallback)
+                continue
+            provider.persist(session_key, archive=archive)
+            if provider.confirm():
+                playback.queue_changed.set()
+        except Exception as e:  # pylint: disable=broad-except
+            # a failing song must not keep the remaining songs from being enqueued
+            logging.exception("error while enqueuing %s: %s", provider.query, e)
+            provider.remove_placeholder()
+    musiq.update_state()
+
+
+def _search(provider: "SongProvider") -> Optional[bool]:
+    # Searches the song of a placeholder that was created without an id.
+    # Returns whether the song needs to be fetched or None if it can not be enqueued.
+    assert provider.queued_song
+    if not live_queue.contains(provider.queued_song.id):
+        # the placeholder was removed before the song was searched
+        return None
+    try:
+        fetch = provider.resolve()
+    except ProviderError as e:
+        logging.warning("Error while enqueuing %s: %s", provider.query, e)
+        return None
+    if (
+        storage.get("new_music_only")
+        and ArchivedSong.objects.filter(
+            url=provider.get_external_url(), counter__gt=0
+        ).exists()
+    ):
+        return None
+    try:
+        # show the song that was found
+        provider.enqueue_placeholder(provider.queued_song.manually_requested)
+    except ProviderError:
+        return None
+    return fetch
+
 
-    enqueue(provider, session_key, archive)
+@app.task
+def check_fetch_enqueue(
+    provider: "SongProvider", session_key: str, archive: bool, fallback: bool
+) -> None:
+    """Check whether the song managed by the given provider is available,
+    then fetch and enqueue it. If this fails, the placeholder is removed.
+    If :param fallback: is set, the other platforms are tried first."""
+    try:
+        available = provider.check_available()
+    except Exception as e:  # pylint: disable=broad-except
+        _give_up(provider, session_key, archive, fallback, error=e)
+        return
+    if not available:
+        _give_up(provider, session_key, archive, fallback)
+        return
+    fetch_enqueue(provider, session_key, archive, fallback)
@@ -4,10 +4,14 @@ from __future__ import annotations
 
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Event
 from typing import Any, Dict, Optional, Union, List, Tuple, cast, Type
 
 from django.conf import settings as conf
 from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection
 from django.forms.models import model_to_dict
 from django.http import HttpResponseBadRequest
 from django.http.response import HttpResponse, JsonResponse
@@ -19,15 +23,30 @@ from django.utils import timezone
 import core.musiq.song_utils as song_utils
 import core.settings.storage as storage
 from core import util, base, redis, user_manager
-from core.models import CurrentSong
-from core.models import QueuedSong
+from core.celery import app
+from core.musiq import live_queue
+from core.models import ArchivedSong, CurrentSong, QueuedSong
 from core.musiq.localdrive import LocalSongProvider
 from core.musiq.music_provider import MusicProvider, WrongUrlError, ProviderError
 from core.musiq.song_provider import SongProvider
 from core.musiq.playlist_provider import PlaylistProvider
-from core.state_handler import send_state
+from core.state_handler import broadcast, send_to_session
 
-queue = QueuedSong.objects
+
+# seconds a provider has to find the requested music when racing.
+# Local files are found immediately, searching youtube takes the longest.
+RACE_TIMEOUTS = {
+    "local": 2,
+    "jamendo": 8,
+    "soundcloud": 8,
+    "spotify": 8,
+    "youtube": 15,
+}
+# for providers that have no timeout of their own
+RACE_TIMEOUT = 15
+# Searches of all racing requests share these threads.
+# Searches that did not start yet when their request was decided are not started at all.
+_race_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="race")
 
 
 def start() -> None:
@@ -35,6 +54,8 @@ def start() -> None:
     import core.musiq.playback as playback
 
     controller.start()
+    # redis was flushed on startup, rebuild the queue from the database
+    live_queue.restore()
     playback.start()
 
 
@@ -60,9 +81,11 @@ def do_request_music(
     platform: str,
     archive: bool = True,
     manually_requested: bool = True,
+    placeholder: Optional[QueuedSong] = None,
 ) -> Tuple[bool, str, Optional[int]]:
     """Performs the actual requesting of the music, not an endpoint.
     Enqueues the requested song or playlist into the queue, using appropriate providers.
+    If given, :param placeholder: is used for the requested song instead of a new one.
     Returns a 3-tuple: successful, message, queue_key"""
     providers: List[MusicProvider] = []
 
@@ -113,6 +136,11 @@ def do_request_music(
 
             youtube_provider_class = YoutubeSongProvider
 
+    archived_key = None
+    if key is None and not playlist and query:
+        # songs that were found for this query before are used without searching again
+        archived_key = _archived_song_key(query, platform)
+
     if key is not None:
         # an archived entry was requested.
         # The key determines the Provider
@@ -161,24 +189,46 @@ def do_request_music(
             except WrongUrlError:
                 pass
 
+    # providers before this one do not search, failing to use them is no fallback
+    first_search = 0
+    if archived_key is not None:
+        # if the archived song is not available anymore, the query is searched instead
+        providers.insert(0, music_provider_class.create(query, archived_key))
+        first_search = 1
+
     if not providers:
         return False, "No backend configured to handle your request.", None
 
-    fallback = False
-    for i, provider in enumerate(providers):
+    if placeholder is not None and not playlist:
+        for provider in providers:
+            cast(SongProvider, provider).queued_song = placeholder
+
+    if (
+        storage.get("provider_racing")
+        and len(providers) > 1
+        # in new music only mode, do not allow fallbacks
+        and not storage.get("new_music_only")
+    ):
         try:
-            provider.request(
-                session_key, archive=archive, manually_requested=manually_requested
-            )
-            # the current provider could provide the song, don't try the other ones
-            break
-        except ProviderError:
-            # this provider cannot provide this song, use the next provider
-            # if this was the last provider, show its error
-            # in new music only mode, do not allow fallbacks
-            if storage.get("new_music_only") or i == len(providers) - 1:
-                return False, provider.error, None
-            fallback = True
+            provider = _race(providers, session_key, archive, manually_requested)
+        except ProviderError as e:
+            return False, str(e), None
+    else:
+        for i, provider in enumerate(providers):
+            try:
+                provider.request(
+                    session_key, archive=archive, manually_requested=manually_requested
+                )
+                # the current provider could provide the song, don't try the other ones
+                break
+            except ProviderError:
+                # this provider cannot provide this song, use the next provider
+                # if this was the last provider, show its error
+                # in new music only mode, do not allow fallbacks
+                if (storage.get("new_music_only") and i >= first_search) or i == len(
+                    providers
+                ) - 1:
+                    return False, provider.error, None
     message = provider.ok_message
     queue_key = None
     if not playlist:
@@ -189,16 +239,100 @@ def do_request_music(
             )
             return False, "No placeholder was created", None
         queue_key = queued_song.id
-    if fallback:
+    if providers.index(provider) > first_search:
         message += " (used fallback)"
     return True, message, queue_key
 
 
+def _archived_song_key(query: str, platform: str) -> Optional[int]:
+    """Returns the key of the archived song that the given query led to before.
+    The normalized query needs to match exactly and the song has to be from the given platform.
+    If the query led to several songs, the most popular one is used."""
+    if song_utils.determine_url_type(query) != "unknown":
+        # urls identify their song without a search
+        return None
+    if f"{platform}_enabled" not in storage.defaults:
+        # the platform is given by the client and might not exist
+        return None
+    if not storage.get(f"{platform}_enabled"):
+        return None
+    candidates = [song_utils.normalize_query(query)]
+    if storage.get("additional_keywords"):
+        # queries are archived with the keywords that were added before searching
+        candidates.append(
+            song_utils.normalize_query(query + " " + storage.get("additional_keywords"))
+        )
+    songs = (
+        ArchivedSong.objects.filter(queries__normalized__in=candidates)
+        .order_by("-counter")
+        .values_list("id", "url")
+    )
+    for song_id, url in songs:
+        if song_utils.determine_url_type(url) == platform:
+            return song_id
+    return None
+
+
+def _resolve(provider: MusicProvider, cancelled: Event) -> bool:
+    try:
+        return provider.resolve(cancelled)
+    finally:
+        connection.close()
+
+
+def _race(
+    providers: List[MusicProvider],
+    session_key: str,
+    archive: bool,
+    manually_requested: bool,
+) -> MusicProvider:
+    """Lets all providers search for the requested music at the same time.
+    The music is requested from the first provider in the given order that finds it,
+    as soon as all providers before it failed.
+    Every provider has its own deadline, after which its search is not waited for.
+    Returns the chosen provider.
+    Raises a ProviderError with the error of the last provider if none found it."""
+    providers[0].check_queue_length()
+    # set as soon as the request is decided, the remaining providers do not search anymore
+    cancelled = Event()
+    start = time.time()
+    futures = [
+        _race_executor.submit(_resolve, provider, cancelled) for provider in providers
+    ]
+    try:
+        for provider, future in zip(providers, futures):
+            deadline = start + RACE_TIMEOUTS.get(provider.type, RACE_TIMEOUT)
+            try:
+                fetch = future.result(timeout=max(deadline - time.time(), 0))
+            except ProviderError:
+                continue
+            except FutureTimeoutError:
+                provider.error = "Search timed out"
+                continue
+            provider.submit(
+                fetch,
+                session_key,
+                archive=archive,
+                manually_requested=manually_requested,
+            )
+            return provider
+    finally:
+        # Searches that are already running can not be interrupted,
+        # their results are ignored and they do not fetch anything.
+        cancelled.set()
+        for future in futures:
+            future.cancel()
+    raise ProviderError(providers[-1].error)
+
+
 # accessed by the discord bot
 @csrf_exempt
 @user_manager.tracked
 def request_music(request: WSGIRequest) -> HttpResponse:
-    """Endpoint to request music. Calls internal function."""
+    """Endpoint to request music. Calls internal function.
+    If "background" is set, the music is searched after the response was sent
+    and the result is sent to the requesting session over the websocket.
+    Otherwise, errors are returned with status 400, as the discord bot expects."""
     key = request.POST.get("key")
     query = request.POST.get("query")
     playlist = request.POST.get("playlist") == "true"
@@ -212,6 +346,9 @@ def request_music(request: WSGIRequest) -> HttpResponse:
     if key:
         ikey = int(key)
 
+    if request.POST.get("background") == "true":
+        return _request_in_background(request, query, ikey, playlist, platform)
+
     successful, message, queue_key = do_request_music(
         request.session.session_key, query, ikey, playlist, platform
     )
@@ -224,6 +361,97 @@ def request_music(request: WSGIRequest) -> HttpResponse:
     return JsonResponse({"message": message, "key": queue_key})
 
 
+def _request_in_background(
+    request: WSGIRequest,
+    query: str,
+    key: Optional[int],
+    playlist: bool,
+    platform: str,
+) -> HttpResponse:
+    if 0 < storage.get("max_queue_length") <= live_queue.count():
+        return HttpResponseBadRequest("Queue limit reached")
+
+    # Searching for the song can take several seconds and is done in the background.
+    # A song is shown in the queue right away, its key is returned to the client.
+    # Playlists have no placeholder, no key is returned for them.
+    response: Dict[str, Any] = {"message": "resolving"}
+    queue_key = None
+    if not playlist:
+        placeholder = QueuedSong.objects.enqueue(
+            {
+                "artist": "",
+                "title": query or "resolving",
+                "duration": -1,
+                "internal_url": None,
+                # the url is only known after the song was found
+                "external_url": "",
+                "stream_url": None,
+            },
+            True,
+            votes=1,
+        )
+        queue_key = placeholder.id
+        response["key"] = queue_key
+        if storage.get("ip_checking"):
+            user_manager.try_vote(user_manager.get_client_ip(request), queue_key, 1)
+        update_state()
+
+    resolve_request.delay(
+        request.session.session_key, query, key, playlist, platform, queue_key
+    )
+
+    return JsonResponse(response)
+
+
+@app.task
+def resolve_request(
+    session_key: str,
+    query: str,
+    key: Optional[int],
+    playlist: bool,
+    platform: str,
+    placeholder_id: Optional[int],
+) -> None:
+    """Performs a request that was received by request_music.
+    The result is sent to the requesting session."""
+    placeholder = None
+    if placeholder_id is not None:
+        # the live queue is authoritative, the database might not know about a removal yet
+        fields = live_queue.get(placeholder_id)
+        if fields is None:
+            # the song was removed before it was found
+            return
+        placeholder = QueuedSong(**fields)
+
+    try:
+        successful, message, queue_key = do_request_music(
+            session_key, query, key, playlist, platform, placeholder=placeholder
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        # an unexpected error is handled like an unsuccessful request
+        logging.exception("error while requesting %s: %s", query, e)
+        successful, message, queue_key = False, "Could not request music", None
+    if not successful and placeholder is not None:
+        try:
+            QueuedSong.objects.remove(placeholder.id)
+        except QueuedSong.DoesNotExist:
+            # the placeholder was already removed
+            pass
+        update_state()
+
+    send_to_session(
+        session_key,
+        {
+            "requestResult": {
+                "successful": successful,
+                "message": message,
+                "query": query,
+                "key": queue_key,
+            }
+        },
+    )
+
+
 @user_manager.tracked
 def request_radio(request: WSGIRequest) -> HttpResponse:
     """Endpoint to request radio for the current song."""
@@ -239,6 +467,11 @@ def index(request: WSGIRequest) -> HttpResponse:
     """Renders the /musiq page."""
     from core import urls
 
+    # The results of requests are sent to the websocket group of the requesting session.
+    # A websocket only joins this group if the session exists when it connects,
+    # so first-time visitors need a session before the page opens its websocket.
+    if not request.session.session_key:
+        request.session.save()
     context = base.context(request)
     context["urls"] = urls.musiq_paths
     context["additional_keywords"] = storage.get("additional_keywords")
@@ -254,7 +487,10 @@ def index(request: WSGIRequest) -> HttpResponse:
     return render(request, "musiq.html", context)
 
 
-def state_dict() -> Dict[str, Any]:
+def state_dict(include_queue: bool = True) -> Dict[str, Any]:
+    """Returns the state of the musiq page.
+    If :param include_queue: is not set, the song queue is omitted.
+    Clients keep their queue up to date with the patches sent by the live queue."""
     state = base.state_dict()
 
     musiq_state = {}
@@ -286,24 +522,24 @@ def state_dict() -> Dict[str, Any]:
         musiq_state["paused"] = True
         musiq_state["progress"] = 0
 
-    song_queue = []
-    total_time = 0
-    all_songs = queue.all()
-    if storage.get("voting_enabled"):
-        all_songs = all_songs.order_by("-votes", "index")
-    for song in all_songs:
-        song_dict = model_to_dict(song)
-        song_dict = util.camelize(song_dict)
-        song_dict["durationFormatted"] = song_utils.format_seconds(
-            song_dict["duration"]
-        )
-        song_queue.append(song_dict)
-        if song_dict["duration"] < 0:
-            # skip duration of placeholders
-            continue
-        total_time += song_dict["duration"]
-    musiq_state["totalTimeFormatted"] = song_utils.format_seconds(total_time)
-    musiq_state["songQueue"] = song_queue
+    # the version is read first, a newer patch might already be contained in the queue
+    musiq_state["queueVersion"] = live_queue.version()
+    if include_queue:
+        song_queue = []
+        total_time = 0
+        # in voting mode, the queue is shown in the order in which the songs will be played
+        voting = storage.get("voting_enabled")
+        for position, song in enumerate(live_queue.songs(ranked=voting), start=1):
+            song_dict = live_queue.serialize(song)
+            # the stored index is a sparse ordering key, clients see the position in the queue
+            song_dict["index"] = position
+            song_queue.append(song_dict)
+            if song_dict["duration"] < 0:
+                # skip duration of placeholders
+                continue
+            total_time += song_dict["duration"]
+        musiq_state["totalTimeFormatted"] = song_utils.format_seconds(total_time)
+        musiq_state["songQueue"] = song_queue
 
     if state["alarm"]:
         musiq_state["currentSong"] = {
@@ -333,6 +569,35 @@ def state_dict() -> Dict[str, Any]:
     return state
 
 
-def update_state() -> None:
-    """Sends an update event to all connected clients."""
-    send_state(state_dict())
+def build_volatile(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the progress of the current song in the given state
+    and how many percent it advances per second.
+    A snapshot of the state stores them, so its progress can be advanced later."""
+    musiq_state = state["musiq"]
+    current_song = musiq_state["currentSong"]
+    rate = 0.0
+    if (
+        current_song is not None
+        and not musiq_state["paused"]
+        # the alarm and the backup stream have no progress
+        and current_song["queueKey"] != -1
+    ):
+        rate = 100 / current_song["duration"]
+    return {"progress": musiq_state["progress"], "rate": rate}
+
+
+def volatile_state(built: Dict[str, Any], elapsed: float) -> Dict[str, Any]:
+    """Returns the values of the musiq state that change without an update being sent.
+    The progress of the current song is advanced by the :param elapsed: seconds
+    since the values in :param built: were returned by build_volatile."""
+    return {
+        **base.volatile_state(built, elapsed),
+        "musiq": {"progress": built["progress"] + built["rate"] * elapsed},
+    }
+
+
+def update_state(immediate: bool = False) -> None:
+    """Sends an update event to all connected clients.
+    Updates in quick succession are combined, unless :param immediate: is set.
+    Changes to the queue are sent separately as patches."""
+    broadcast("musiq", lambda: state_dict(include_queue=False), immediate)
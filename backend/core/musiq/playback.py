@@ -7,24 +7,23 @@ import logging
 import os
 import random
 import time
-from contextlib import contextmanager
 from threading import Event
-from typing import Iterator, Optional
+from typing import Any, Dict, Optional, Tuple
 
 import requests
 
 from core.celery import app
 from django.conf import settings as conf
-from django.db import transaction, connection
+from django.db import connection
 from django.utils import timezone
-from mopidyapi.client import MopidyAPI
 from mopidyapi.exceptions import MopidyError
 
 from core import redis
 import core.models as models
 from core import user_manager
 from core.lights import controller as lights_controller
-from core.musiq import musiq, controller
+from core.musiq import musiq, controller, live_queue, prefetch
+from core.musiq.mopidy_gateway import Gateway, GatewayAPI
 from core.settings import storage, settings
 
 queue_changed = redis.Event("queue_changed")
@@ -32,8 +31,12 @@ buzzer_stopped = redis.Event("buzzer_stopped")
 
 queue = models.QueuedSong.objects
 
-# this lock is released when restarting mopidy (which happens in another Thread)
-player_lock = redis.lock("player_lock", thread_local=False)
+# A message on this channel wakes up the playback loop while it waits for a song to end.
+# It then checks whether it should stop or play an alarm.
+CONTROL_CHANNEL = "playback_control"
+# The end of a song is signaled by mopidy's events.
+# Mopidy is only polled in this interval in case an event got lost, e.g. because it crashed.
+LIVENESS_INTERVAL = 2
 
 
 def start() -> None:
@@ -60,50 +63,105 @@ class Playback:
     """Class containing all playback related methods."""
 
     def __init__(self):
+        # all mopidy commands are executed by the gateway, including those of other processes
+        self.gateway = Gateway(conf.MOPIDY_HOST, conf.MOPIDY_PORT)
+        self.gateway.start()
         # the celery worker needs its own player instance.
         # if we use a module-wide instance, methods can be used,
         # but events do not register correctly (probably due to thread boundary)
         if conf.TESTING:
             # to reduce the amount of created mopidy connections,
-            # use the controller's instance during testing
+            # use the controller's websocket during testing
             # this works because everything is run in a single process
-            self.player = controller.player
+            self.player = GatewayAPI(
+                self.gateway,
+                host=conf.MOPIDY_HOST,
+                port=conf.MOPIDY_PORT,
+                use_websocket=False,
+            )
+            self.player.on_event = controller.player.on_event
         else:
-            self.player: MopidyAPI = MopidyAPI(
-                host=conf.MOPIDY_HOST, port=conf.MOPIDY_PORT
+            self.player = GatewayAPI(
+                self.gateway, host=conf.MOPIDY_HOST, port=conf.MOPIDY_PORT
             )
         self.playback_started = Event()
+        # set whenever the loop waiting for the end of a song should check something
+        self.wakeup = Event()
+        # set by mopidy's events, mopidy's state needs to be checked
+        self.playback_changed = Event()
+        # set when the queue changed, the song that is added ahead needs to be checked
+        self.lookahead_outdated = Event()
+        # when the last song ended according to mopidy's events
+        self.playback_ended: Optional[float] = None
+        # the tracklist id of the current song in mopidy
+        self.current_tlid: Optional[int] = None
+        # the queue key and tracklist id of the song that was added after the current one
+        self.lookahead: Optional[Tuple[int, int]] = None
         redis.set("playing", False)
 
         queue.delete_placeholders()
 
-        with mopidy_command(important=True):
-            self.player.playback.stop()
-            self.player.tracklist.clear()
-            # make songs disappear from tracklist after being played
-            self.player.tracklist.set_consume(True)
+        self.player.playback.stop()
+        self.player.tracklist.clear()
+        # make songs disappear from tracklist after being played
+        self.player.tracklist.set_consume(True)
 
         @self.player.on_event("track_playback_started")
         def _on_playback_started(_event) -> None:
             self.playback_started.set()
 
+        @self.player.on_event("track_playback_ended")
+        def _on_playback_ended(_event) -> None:
+            self.playback_ended = time.time()
+            self.playback_changed.set()
+            self.wakeup.set()
+
+        @self.player.on_event("playback_state_changed")
+        def _on_playback_state_changed(event) -> None:
+            if event.new_state == "stopped" and self.playback_ended is None:
+                self.playback_ended = time.time()
+            self.playback_changed.set()
+            self.wakeup.set()
+
+        def _on_queue_changed(_message) -> None:
+            # the song that is played next might have changed
+            self.lookahead_outdated.set()
+            self.wakeup.set()
+
+        self.control = redis.pubsub(ignore_subscribe_messages=True)
+        self.control.subscribe(
+            **{
+                CONTROL_CHANNEL: lambda _: self.wakeup.set(),
+                live_queue.CHANGED_CHANNEL: _on_queue_changed,
+            }
+        )
+        self.control_thread = self.control.run_in_thread(sleep_time=1, daemon=True)
+
     def play_alarm(self, interrupt=False) -> None:
         """Play the alarm sound. If specified, interrupts the currently playing song."""
         redis.set("alarm_playing", True)
         lights_controller.alarm_started()
         self.playback_started.clear()
-
-        with mopidy_command(important=True):
-            # interrupt the current song if its playing
-            if interrupt:
-                self.player.tracklist.clear()
-            self.player.tracklist.add(
-                uris=[
-                    "file://"
-                    + os.path.join(conf.BASE_DIR, "resources/sounds/alarm.m4a")
-                ]
+        self.playback_ended = None
+
+        calls = []
+        # interrupt the current song if its playing
+        if interrupt:
+            calls.append(("core.tracklist.clear", {}))
+            self.lookahead = None
+        calls.append(
+            (
+                "core.tracklist.add",
+                {
+                    "uris": [
+                        "file://"
+                        + os.path.join(conf.BASE_DIR, "resources/sounds/alarm.m4a")
+                    ]
+                },
             )
-            self.player.playback.play()
+        )
+        calls.append(("core.playback.play", {}))
+        self.player.batch(*calls)
         self.playback_started.wait(timeout=1)
 
         musiq.update_state()
@@ -119,20 +177,16 @@ class Playback:
     def wait_until_song_end(self) -> bool:
         """Wait until the song is over.
         Returns True when finished without errors, False otherwise."""
-        # This is the event based approach. Unfortunately too error-prone.
-        # If mopidy crashes/restarts for example, no track_playback_ended event is sent
-        # playback_ended.wait()
+        # Relying on mopidy's events alone is too error-prone.
+        # If mopidy crashes/restarts for example, no track_playback_ended event is sent.
+        # Thus, every event is only a hint to check mopidy's state,
+        # which is also done periodically without one.
+        # Changes to the queue do not affect mopidy's state and only update the lookahead.
         error = False
+        next_check = time.time() + LIVENESS_INTERVAL
         while True:
-            with mopidy_command() as allowed:
-                if allowed:
-                    try:
-                        if self.player.playback.get_state() == "stopped":
-                            break
-                    except (requests.exceptions.ConnectionError, MopidyError):
-                        # error during state get, skip until reconnected
-                        error = True
-            time.sleep(0.1)
+            self.wakeup.wait(timeout=max(next_check - time.time(), 0))
+            self.wakeup.clear()
             if redis.get("stop_playback_loop"):
                 # in order to stop the playback thread, return False, making the main loop restart.
                 # it will check this variable again and terminate itself.
@@ -154,8 +208,95 @@ class Playback:
                 current_song.save()
 
                 return False
+            checked = False
+            if self.playback_changed.is_set() or time.time() >= next_check:
+                self.playback_changed.clear()
+                next_check = time.time() + LIVENESS_INTERVAL
+                try:
+                    if self.player.playback.get_state() == "stopped":
+                        break
+                    if (
+                        self.lookahead is not None
+                        and self.player.playback.get_current_tlid()
+                        != self.current_tlid
+                    ):
+                        # mopidy continued with the song that was added ahead
+                        break
+                except (requests.exceptions.ConnectionError, MopidyError):
+                    # error during state get, skip until reconnected
+                    error = True
+                # the event belonged to something else, e.g. clearing the tracklist
+                self.playback_ended = None
+                checked = True
+            if checked or self.lookahead_outdated.is_set():
+                self.lookahead_outdated.clear()
+                self._update_lookahead()
+        self._report_song_end()
         return not error
 
+    def _report_song_end(self) -> None:
+        # Stores how long it took to notice that the song ended.
+        # Without an event, the end is estimated from the song's duration.
+        ended = self.playback_ended
+        if ended is None:
+            try:
+                current_song = models.CurrentSong.objects.get()
+            except models.CurrentSong.DoesNotExist:
+                return
+            ended = current_song.created.timestamp() + current_song.duration
+        redis.set("song_end_latency", max(time.time() - ended, 0.0))
+
+    def _next_song_id(self) -> Optional[int]:
+        # Returns the key of the song that will be played after the current one.
+        if storage.get("voting_enabled"):
+            return live_queue.first(ranked=True)
+        if storage.get("shuffle"):
+            confirmed = live_queue.confirmed_ids()
+            # stick to a random choice as long as the song is available
+            if self.lookahead is not None and self.lookahead[0] in confirmed:
+                return self.lookahead[0]
+            return random.choice(confirmed) if confirmed else None
+        return live_queue.first()
+
+    def _update_lookahead(self) -> None:
+        # Makes sure that the song that is played next is in mopidy's tracklist
+        # after the current song. Mopidy then starts it without a gap.
+        if redis.get("alarm_playing"):
+            return
+        next_id = None
+        if storage.get("gapless_playback"):
+            next_id = self._next_song_id()
+        if self.lookahead is not None and self.lookahead[0] == next_id:
+            return
+        next_song = None
+        if next_id is not None:
+            next_song = live_queue.get(next_id, ("internal_url",))
+        try:
+            if self.lookahead is not None:
+                self.player.tracklist.remove(criteria={"tlid": [self.lookahead[1]]})
+                self.lookahead = None
+            if next_song is None or next_song["internal_url"] == "alarm":
+                return
+            tl_tracks = self.player.tracklist.add(uris=[next_song["internal_url"]])
+            if tl_tracks:
+                self.lookahead = (next_id, tl_tracks[0].tlid)
+        except (requests.exceptions.ConnectionError, MopidyError):
+            self.lookahead = None
+
+    def _started_lookahead(self) -> Optional[int]:
+        # Returns the key of the song that was added ahead if mopidy is playing it by now.
+        if self.lookahead is None:
+            return None
+        song_id, tlid = self.lookahead
+        self.lookahead = None
+        try:
+            if self.player.playback.get_current_tlid() != tlid:
+                return None
+        except (requests.exceptions.ConnectionError, MopidyError):
+            return None
+        self.current_tlid = tlid
+        return song_id
+
     def loop(self) -> None:
         """The main loop of the player.
         Takes a song from the queue and plays it until it is finished."""
@@ -165,7 +306,10 @@ class Playback:
                 break
 
             catch_up = None
+            # whether mopidy already started the song by itself
+            started = False
             self.playback_started.clear()
+            self.playback_ended = None
 
             if models.CurrentSong.objects.exists():
                 # recover interrupted song from database
@@ -186,7 +330,7 @@ class Playback:
                 if catch_up > current_song.duration * 1000:
                     catch_up = -1
             else:
-                if queue.count() == 0:
+                if live_queue.count() == 0:
                     queue_changed.wait()
                     queue_changed.clear()
 
@@ -195,17 +339,26 @@ class Playback:
                     continue
 
                 # select the next song depending on settings
-                song: Optional[models.QueuedSong]
-                if storage.get("voting_enabled"):
-                    with transaction.atomic():
-                        song = queue.confirmed().order_by("-votes", "index")[0]
-                        song_id = song.id
-                        queue.remove(song.id)
+                song: Optional[Dict[str, Any]]
+                lookahead_id = self._started_lookahead()
+                if lookahead_id is not None:
+                    # the song that was added ahead was chosen the same way
+                    try:
+                        song_id = lookahead_id
+                        song = queue.remove(song_id)
+                        started = True
+                    except models.QueuedSong.DoesNotExist:
+                        song = None
+                elif storage.get("voting_enabled"):
+                    # the confirmed song with the most votes
+                    song_id, song = queue.dequeue(ranked=True)
                 elif storage.get("shuffle"):
-                    confirmed = queue.confirmed()
-                    index = random.randint(0, confirmed.count() - 1)
-                    song_id = confirmed[index].id
-                    song = queue.remove(song_id)
+                    confirmed = live_queue.confirmed_ids()
+                    try:
+                        song_id = random.choice(confirmed)
+                        song = queue.remove(song_id)
+                    except (IndexError, models.QueuedSong.DoesNotExist):
+                        song = None
                 else:
                     # move the first song in the queue into the current song
                     song_id, song = queue.dequeue()
@@ -216,7 +369,7 @@ class Playback:
                     logging.warning("dequeued on empty list")
                     continue
 
-                if song.internal_url == "alarm":
+                if song["internal_url"] == "alarm":
                     self.play_alarm()
                     continue
 
@@ -224,16 +377,18 @@ class Playback:
                 # when the dequeued song starts playing, the backup stream playback is stopped
                 redis.set("backup_playing", False)
 
+                prefetch.record_playback(song["internal_url"])
+
                 current_song = models.CurrentSong.objects.create(
                     queue_key=song_id,
-                    manually_requested=song.manually_requested,
-                    votes=song.votes,
-                    internal_url=song.internal_url,
-                    external_url=song.external_url,
-                    stream_url=song.stream_url,
-                    artist=song.artist,
-                    title=song.title,
-                    duration=song.duration,
+                    manually_requested=song["manually_requested"],
+                    votes=song["votes"],
+                    internal_url=song["internal_url"],
+                    external_url=song["external_url"],
+                    stream_url=song["stream_url"],
+                    artist=song["artist"],
+                    title=song["title"],
+                    duration=song["duration"],
                 )
 
                 handle_autoplay()
@@ -259,20 +414,30 @@ class Playback:
                 ):
                     pass
 
-            with mopidy_command(important=True):
-                # after a restart consume may be set to False again, so make sure it is on
-                self.player.tracklist.clear()
-                self.player.tracklist.set_consume(True)
-                self.player.tracklist.add(uris=[current_song.internal_url])
-                # temporarily mute mopidy in case we need to seek but mopidy does not react directly
-                # this allows us to seek first and then unmute, preventing audible skips
-                volume = self.player.mixer.get_volume()
+            if started:
+                # mopidy continued with the song that was added ahead
+                set_playback_error(False)
+            else:
+                # The song is started with a single request to mopidy.
+                # Mopidy executes the calls of a batch in order.
+                calls = [
+                    ("core.tracklist.clear", {}),
+                    # after a restart consume may be set to False again, so make sure it is on
+                    ("core.tracklist.set_consume", {"value": True}),
+                    ("core.tracklist.add", {"uris": [current_song.internal_url]}),
+                    ("core.mixer.get_volume", {}),
+                ]
                 if catch_up is not None and catch_up >= 0:
-                    self.player.mixer.set_volume(0)
+                    # temporarily mute mopidy in case we need to seek but mopidy does not react directly
+                    # this allows us to seek first and then unmute, preventing audible skips
+                    calls.append(("core.mixer.set_volume", {"volume": 0}))
                 # mopidy can only seek when the song is playing
                 # also we do not continue without the playing state properly set.
                 # otherwise waiting might exit before the song started
-                self.player.playback.play()
+                calls.append(("core.playback.play", {}))
+                self.lookahead = None
+                _, _, tl_tracks, volume, *_ = self.player.batch(*calls)
+                self.current_tlid = tl_tracks[0].tlid if tl_tracks else None
                 if not self.playback_started.wait(timeout=1):
                     # mopidy did not acknowledge that it started the song
                     # to make sure it is not in an error state,
@@ -286,10 +451,11 @@ class Playback:
                     continue
                 set_playback_error(False)
                 if catch_up is not None and catch_up >= 0:
-                    self.player.playback.seek(catch_up)
+                    calls = [("core.playback.seek", {"time_position": catch_up})]
                     if storage.get("paused"):
-                        self.player.playback.pause()
-                    self.player.mixer.set_volume(volume)
+                        calls.append(("core.playback.pause", {}))
+                    calls.append(("core.mixer.set_volume", {"volume": volume}))
+                    self.player.batch(*calls)
             redis.set("playing", True)
 
             # needs some more testing but could prevent "eating the queue" bug
@@ -304,7 +470,9 @@ class Playback:
             #    # recover the current song by restarting the loop
             #    continue
 
-            musiq.update_state()
+            # clients synchronize their progress with the new song
+            musiq.update_state(immediate=True)
+            self._update_lookahead()
 
             # don't wait for the song to end if catch_up is negative (=the song should be skipped)
             if catch_up is None or catch_up >= 0:
@@ -340,9 +508,11 @@ class Playback:
             if user_manager.partymode_enabled() and random.random() < storage.get(
                 "alarm_probability"
             ):
-                self.play_alarm()
+                # if the next song already started, it is interrupted
+                # and played from the beginning after the alarm
+                self.play_alarm(interrupt=self.lookahead is not None)
 
-            if not queue.exists() and storage.get("backup_stream"):
+            if live_queue.count() == 0 and storage.get("backup_stream"):
                 redis.set("backup_playing", True)
                 # play backup stream
                 self.player.tracklist.add(uris=[storage.get("backup_stream")])
@@ -350,11 +520,19 @@ class Playback:
 
             musiq.update_state()
 
+        # the thread closes the subscription when it exits
+        self.control_thread.stop()
+        self.control_thread.join()
+        self.gateway.stop()
+
 
 @app.task
 def _loop() -> None:
+    prefetcher = prefetch.Prefetcher()
+    prefetcher.start()
     playback = Playback()
     playback.loop()
+    prefetcher.stop()
     connection.close()
 
 
@@ -399,6 +577,7 @@ def trigger_alarm() -> None:
         # if a song is currently playing, inform the loop waiting for the song to end
         # about this alarm. It will interrupt the current song and play the alarm
         redis.set("alarm_requested", True)
+        redis.publish(CONTROL_CHANNEL, "alarm")
     else:
         # insert a special queue song to wake up the main loop and make it play the alarm
         queue.enqueue(musiq.get_alarm_metadata(), True)
@@ -409,7 +588,7 @@ def handle_autoplay(url: Optional[str] = None) -> None:
     """Checks whether to add a song by autoplay and does so if necessary.
     :param url: if given, this url is used to find the next autoplayed song.
     Otherwise, the current song is used."""
-    if storage.get("autoplay") and models.QueuedSong.objects.count() == 0:
+    if storage.get("autoplay") and live_queue.count() == 0:
         if url is None:
             # if no url was specified, use the one of the current song
             try:
@@ -443,29 +622,8 @@ def handle_autoplay(url: Optional[str] = None) -> None:
             )
 
 
-@contextmanager
-def mopidy_command(important: bool = False) -> Iterator[bool]:
-    """A context that should be used around every mopidy command used.
-    Makes sure that commands occur sequentially, as mopidy can not handle parallel inputs.
-    Use it like this:
-    with mopidy_command() as allowed:
-        if allowed:
-            # mopidy command
-    :param important: If True, wait until the lock is released.
-    If not, return 'False' after a timeout."""
-    timeout = 3
-    if important:
-        timeout = None
-    if player_lock.acquire(blocking_timeout=timeout):
-        yield True
-        player_lock.release()
-    else:
-        logging.warning("mopidy command could not be executed")
-        set_playback_error(True)
-        yield False
-
-
 def stop() -> None:
     """Stops the playback main loop, only used for tests."""
     redis.set("stop_playback_loop", True)
+    redis.publish(CONTROL_CHANNEL, "stop")
     queue_changed.set()
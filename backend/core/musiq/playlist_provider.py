@@ -1,9 +1,7 @@
 """This module contains the base class of all playlist providers."""
 import logging
-import time
 from typing import Optional, Type, List
 
-from django.conf import settings
 from django.db import transaction
 from django.db.models.expressions import F
 
@@ -15,7 +13,7 @@ from core.models import (
     RequestLog,
 )
 from core.musiq import song_utils
-from core.musiq.music_provider import MusicProvider, ProviderError
+from core.musiq.music_provider import MusicProvider
 from core.musiq.song_provider import SongProvider
 
 
@@ -183,14 +181,12 @@ class PlaylistProvider(MusicProvider):
             )
 
     def enqueue(self) -> None:
-        for index, external_url in enumerate(self.urls):
-            if index == storage.get("max_playlist_items"):
-                break
+        song_providers = []
+        for external_url in self.urls[: storage.get("max_playlist_items")]:
             # request every url in the playlist as their own url
             try:
-                song_provider = SongProvider.create(external_url=external_url)
-                song_provider.request("", archive=False, manually_requested=False)
-            except (ProviderError, NotImplementedError) as e:
+                song_providers.append(SongProvider.create(external_url=external_url))
+            except NotImplementedError as e:
                 logging.warning(
                     "Error while enqueuing url %s to playlist %s: %s",
                     external_url,
@@ -198,9 +194,6 @@ class PlaylistProvider(MusicProvider):
                     self.id,
                 )
                 logging.exception(e)
-                continue
-
-            if settings.DEBUG:
-                # the sqlite database has problems if songs are pushed very fast
-                # while a new song is taken from the queue. Add a delay to mitigate.
-                time.sleep(1)
+        SongProvider.request_many(
+            song_providers, "", archive=False, manually_requested=False
+        )
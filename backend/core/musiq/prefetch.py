@@ -0,0 +1,147 @@
+"""This module makes sure that the songs at the front of the queue are on disk
+by the time they are played, e.g. after their files were removed from the cache."""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+from django.db import connection
+
+from core import redis
+from core.musiq import downloads, live_queue, song_utils
+from core.settings import storage
+
+# The queue is checked after every change.
+# Files can also disappear without a change, so it is checked in this interval as well.
+INTERVAL = 30
+
+
+def _download_path(internal_url: Optional[str]) -> Optional[str]:
+    # Returns the path of the file if the song is played from a downloaded file.
+    # Downloads are stored directly in the cache directory,
+    # files of the local library are in a subdirectory and can not be downloaded again.
+    if not internal_url or not internal_url.startswith("file://"):
+        return None
+    path = internal_url[len("file://") :]
+    if os.path.dirname(path) != song_utils.get_path(""):
+        return None
+    return path
+
+
+def _missing(song: Dict[str, Any]) -> bool:
+    path = _download_path(song["internal_url"])
+    return path is not None and not os.path.isfile(path)
+
+
+def record_playback(internal_url: str) -> None:
+    """Counts whether the file of a downloaded song that starts playing was available."""
+    path = _download_path(internal_url)
+    if path is None:
+        return
+    if os.path.isfile(path):
+        redis.incr("prefetch_hits")
+    else:
+        redis.incr("prefetch_misses")
+
+
+class Prefetcher:
+    """Watches the upcoming songs and downloads those whose file is missing.
+    Songs closer to the front of the queue are downloaded first."""
+
+    def __init__(self) -> None:
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.lock = threading.Lock()
+        # ids of the songs that are currently downloaded
+        self.active: Set[int] = set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.control = redis.pubsub(ignore_subscribe_messages=True)
+        self.control.subscribe(
+            **{live_queue.CHANGED_CHANNEL: lambda _: self.wakeup.set()}
+        )
+        self.control_thread = None
+
+    def start(self) -> None:
+        """Starts watching the queue."""
+        self.control_thread = self.control.run_in_thread(sleep_time=1, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stops watching the queue. Running downloads are finished in the background."""
+        self.stopped = True
+        self.wakeup.set()
+        self.control_thread.stop()
+        self.control_thread.join()
+        self.thread.join()
+
+    def _upcoming(self) -> List[Dict[str, Any]]:
+        # the songs that will be played next, in the order they will be played in
+        count = storage.get("prefetch_songs")
+        if count <= 0:
+            return []
+        keys = live_queue.confirmed_ids(
+            ranked=storage.get("voting_enabled"), count=count
+        )
+        songs = []
+        for key in keys:
+            song = live_queue.get(key, ("id", "internal_url", "external_url"))
+            if song is not None:
+                songs.append(song)
+        return songs
+
+    def _run(self) -> None:
+        while not self.stopped:
+            with self.lock:
+                candidates = [
+                    song
+                    for song in self._upcoming()
+                    if song["id"] not in self.active and _missing(song)
+                ]
+                # Prefetches take their slots from the download scheduler like any download.
+                # No more songs are started than can be downloaded at the same time.
+                # Without a limit on downloads, at most prefetch_songs are fetched.
+                concurrency = storage.get("download_concurrency")
+                if concurrency <= 0:
+                    concurrency = storage.get("prefetch_songs")
+                candidates = candidates[: max(concurrency - len(self.active), 0)]
+                for song in candidates:
+                    self.active.add(song["id"])
+                    threading.Thread(
+                        target=self._fetch, args=(song,), daemon=True
+                    ).start()
+            self.wakeup.wait(timeout=INTERVAL)
+            self.wakeup.clear()
+        connection.close()
+
+    def _fetch(self, song: Dict[str, Any]) -> None:
+        from core.musiq.song_provider import SongProvider
+
+        deferred = False
+        try:
+            provider = SongProvider.create(external_url=song["external_url"])
+            # the download is scheduled by the position of the song in the queue
+            provider.queue_key = song["id"]
+            if provider.make_available():
+                redis.incr("prefetch_downloads")
+            else:
+                logging.warning("could not prefetch %s", song["external_url"])
+        except downloads.DownloadDeferred:
+            deferred = True
+        except Exception as e:  # pylint: disable=broad-except
+            # the prefetcher needs to keep running, whatever the download raised
+            logging.exception("error while prefetching %s: %s", song["external_url"], e)
+        finally:
+            with self.lock:
+                self.active.discard(song["id"])
+            if deferred:
+                # the download could not start yet, check the song again later
+                timer = threading.Timer(downloads.RETRY_DELAY, self.wakeup.set)
+                timer.daemon = True
+                timer.start()
+            else:
+                # a slot is free for the next song
+                self.wakeup.set()
+            connection.close()
@@ -0,0 +1,149 @@
+"""This module keeps the size of the downloaded songs within the configured limit."""
+
+from __future__ import annotations
+
+import logging
+import math
+import os
+import time
+from typing import Dict, Iterator, List, Set, Tuple
+
+from django.conf import settings as conf
+from django.db import connection
+from django.db.models import Max
+
+from core import redis
+from core.celery import app
+from core.models import ArchivedSong, CurrentSong
+from core.musiq import live_queue
+from core.settings import storage
+
+# only one process evicts songs at a time, the timeout frees the lock if a worker dies
+cache_lock = redis.lock("song_cache_lock", timeout=10 * 60)
+
+# Files that were written recently might belong to a song that is about to be enqueued.
+GRACE_PERIOD = 10 * 60
+# A song that was played twice as often as another one is kept as long
+# as if it was played this many seconds later.
+POPULARITY_WEIGHT = 24 * 60 * 60
+# Songs are looked up in chunks of this many urls,
+# sqlite limits the number of variables in a query.
+QUERY_CHUNK_SIZE = 500
+
+
+def _canonical(path: str) -> str:
+    # The same file can be referred to by different paths,
+    # e.g. relative to the cache directory, with a "~" or through a symlink.
+    path = os.path.join(conf.SONGS_CACHE_DIR, os.path.expanduser(path))
+    return os.path.realpath(path)
+
+
+def _cached_files() -> Dict[str, Tuple[int, float]]:
+    # maps the canonical paths of all downloaded songs to their size and modification time
+    files = {}
+    with os.scandir(conf.SONGS_CACHE_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or not entry.name.endswith(
+                ".m4a"
+            ):
+                continue
+            stat = entry.stat()
+            files[_canonical(entry.path)] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def _protected_paths() -> Set[str]:
+    # songs that are queued or playing must not be removed
+    urls = [song["internal_url"] for song in live_queue.songs(fields=("internal_url",))]
+    urls += CurrentSong.objects.values_list("internal_url", flat=True)
+    return {
+        _canonical(url[len("file://") :])
+        for url in urls
+        if url and url.startswith("file://")
+    }
+
+
+def _external_url(path: str) -> str:
+    # downloaded songs are named after their youtube id
+    video_id = os.path.splitext(os.path.basename(path))[0]
+    return "https://www.youtube.com/watch?v=" + video_id
+
+
+def _chunks(urls: List[str]) -> Iterator[List[str]]:
+    for start in range(0, len(urls), QUERY_CHUNK_SIZE):
+        yield urls[start : start + QUERY_CHUNK_SIZE]
+
+
+def _scores(paths: List[str], modified: Dict[str, float]) -> Dict[str, float]:
+    # Songs with lower scores are removed first.
+    # The score is the time the song was last used, moved into the future for popular songs.
+    urls = {_external_url(path): path for path in paths}
+    songs = []
+    for chunk in _chunks(list(urls.keys())):
+        songs += (
+            ArchivedSong.objects.filter(url__in=chunk)
+            .annotate(last_played=Max("playlog__created"))
+            .values_list("url", "counter", "last_played")
+        )
+    scores = {path: modified[path] for path in paths}
+    for url, counter, last_played in songs:
+        path = urls[url]
+        last_used = modified[path]
+        if last_played is not None:
+            last_used = max(last_used, last_played.timestamp())
+        scores[path] = last_used + POPULARITY_WEIGHT * math.log2(1 + max(counter, 0))
+    return scores
+
+
+@app.task
+def evict() -> None:
+    """Removes the least valuable songs from the cache until it fits the size limit.
+    Updates the cached flags of the removed songs."""
+    if not cache_lock.acquire(blocking=False):
+        # another process is already evicting
+        return
+    try:
+        _evict()
+    finally:
+        cache_lock.release()
+        connection.close()
+
+
+def _evict() -> None:
+    files = _cached_files()
+    total = sum(size for size, _ in files.values())
+    limit = storage.get("max_cache_size") * 1024 * 1024
+    if limit <= 0 or total <= limit:
+        redis.set("song_cache_size", total)
+        return
+
+    now = time.time()
+    protected = _protected_paths()
+    candidates = [
+        path
+        for path, (_, modified) in files.items()
+        if path not in protected and modified < now - GRACE_PERIOD
+    ]
+    scores = _scores(
+        candidates, {path: modified for path, (_, modified) in files.items()}
+    )
+    evicted = []
+    for path in sorted(candidates, key=lambda path: scores[path]):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= files[path][0]
+        evicted.append(path)
+
+    if evicted:
+        for chunk in _chunks([_external_url(path) for path in evicted]):
+            ArchivedSong.objects.filter(url__in=chunk).update(cached=False)
+        redis.incr("song_cache_evictions", len(evicted))
+        redis.incr("song_cache_evicted_bytes", sum(files[path][0] for path in evicted))
+        logging.info("removed %d songs from the cache", len(evicted))
+    if total > limit:
+        logging.warning("song cache exceeds its limit, all remaining songs are in use")
+    redis.set("song_cache_size", total)
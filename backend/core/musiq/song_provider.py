@@ -1,7 +1,7 @@
 """This module contains the base class of all song providers."""
 
 import logging
-from typing import Optional, Type, TYPE_CHECKING
+from typing import List, Optional, Type, TYPE_CHECKING
 
 from django.db import transaction
 from django.db.models.expressions import F
@@ -10,8 +10,13 @@ from django.http.response import HttpResponse
 import core.settings.storage as storage
 from core.models import ArchivedSong, QueuedSong, ArchivedQuery, RequestLog
 from core.musiq import song_utils as song_utils, playback
-from core.musiq import musiq
-from core.musiq.music_provider import MusicProvider, WrongUrlError
+from core.musiq import musiq, live_queue
+from core.musiq.music_provider import (
+    MusicProvider,
+    ProviderError,
+    WrongUrlError,
+    fetch_enqueue_many,
+)
 
 if TYPE_CHECKING:
     from core.musiq.song_utils import Metadata
@@ -83,6 +88,9 @@ class SongProvider(MusicProvider):
         super().__init__(query, key)
         self.ok_message = "song queued"
         self.queued_song: Optional[QueuedSong] = None
+        # the id of the queued song that is made available if it has no placeholder,
+        # e.g. when its file is downloaded again
+        self.queue_key: Optional[int] = None
 
         if query:
             url_type = song_utils.determine_url_type(query)
@@ -94,6 +102,12 @@ class SongProvider(MusicProvider):
     def _get_path(self) -> str:
         raise NotImplementedError()
 
+    def get_queue_key(self) -> Optional[int]:
+        """Returns the id of the queued song that this provider makes available, if any."""
+        if self.queued_song is not None:
+            return self.queued_song.id
+        return self.queue_key
+
     def get_internal_url(self) -> str:
         """Returns the internal url based on this object's id."""
         raise NotImplementedError()
@@ -139,24 +153,54 @@ class SongProvider(MusicProvider):
         logging.error("Can not extract id because neither key nor query are known")
         return None
 
-    def enqueue_placeholder(self, manually_requested) -> None:
-        metadata: Metadata = {
+    def _placeholder_metadata(self) -> "Metadata":
+        # the url of a song without an id is only known after it was searched
+        external_url = "" if self.id is None else self.get_external_url()
+        return {
             "artist": "",
-            "title": self.query or self.get_external_url(),
+            "title": self.query or external_url or "resolving",
             "duration": -1,
             "internal_url": None,
-            "external_url": self.get_external_url(),
+            "external_url": external_url,
             "stream_url": None,
             "cached": False,
         }
+
+    def enqueue_placeholder(self, manually_requested) -> None:
+        if self.queued_song is not None:
+            # a placeholder was created when the request was received, show what was found
+            metadata = self._placeholder_metadata()
+            self.queued_song.title = metadata["title"]
+            self.queued_song.external_url = metadata["external_url"]
+            if not self._update_placeholder(["title", "external_url"]):
+                self.error = "Song was removed from the queue"
+                raise ProviderError(self.error)
+            return
         initial_votes = 1 if manually_requested else 0
         self.queued_song = playback.queue.enqueue(
-            metadata, manually_requested, votes=initial_votes
+            self._placeholder_metadata(), manually_requested, votes=initial_votes
+        )
+
+    def _update_placeholder(self, fields: List[str]) -> bool:
+        # The placeholder might have been removed from the live queue at any time,
+        # and its row deleted by the next persistence. Only existing rows are updated.
+        # Returns False if the placeholder was already removed.
+        assert self.queued_song
+        updated = QueuedSong.objects.filter(id=self.queued_song.id).update(
+            **{field: getattr(self.queued_song, field) for field in fields}
         )
+        if not updated:
+            return False
+        live_queue.update(self.queued_song, fields)
+        return True
 
     def remove_placeholder(self) -> None:
         assert self.queued_song
-        self.queued_song.delete()
+        try:
+            playback.queue.remove(self.queued_song.id)
+        except QueuedSong.DoesNotExist:
+            # the placeholder was already removed
+            pass
 
     def check_cached(self) -> bool:
         raise NotImplementedError()
@@ -208,10 +252,18 @@ class SongProvider(MusicProvider):
             RequestLog.objects.create(song=archived_song, session_key=session_key)
 
     def enqueue(self) -> None:
+        if not self.confirm():
+            return
+        musiq.update_state()
+        playback.queue_changed.set()
+
+    def confirm(self) -> bool:
+        """Replaces the placeholder in the song queue with the actual data.
+        Returns False if the placeholder was already removed."""
         assert self.queued_song
-        if not playback.queue.filter(id=self.queued_song.id).exists():
+        if not live_queue.contains(self.queued_song.id):
             # this song was already deleted, do not enqueue
-            return
+            return False
 
         metadata = self.get_metadata()
 
@@ -222,19 +274,16 @@ class SongProvider(MusicProvider):
         self.queued_song.external_url = metadata["external_url"]
         self.queued_song.stream_url = metadata["stream_url"]
         # make sure not to overwrite the index as it may have changed in the meantime
-        self.queued_song.save(
-            update_fields=[
-                "artist",
-                "title",
-                "duration",
-                "internal_url",
-                "external_url",
-                "stream_url",
-            ]
-        )
-
-        musiq.update_state()
-        playback.queue_changed.set()
+        fields = [
+            "artist",
+            "title",
+            "duration",
+            "internal_url",
+            "external_url",
+            "stream_url",
+        ]
+        # the song can still be removed while its metadata is written
+        return self._update_placeholder(fields)
 
     def get_suggestion(self) -> str:
         """Returns the external url of a suggested song based on this one."""
@@ -247,3 +296,54 @@ class SongProvider(MusicProvider):
     def request_radio(self, session_key) -> HttpResponse:
         """Enqueues a playlist of songs based on this one."""
         raise NotImplementedError()
+
+    @staticmethod
+    def request_many(
+        providers: List["SongProvider"],
+        session_key: str,
+        archive: bool = True,
+        manually_requested: bool = True,
+        fallback: bool = False,
+    ) -> None:
+        """Requests all given songs at once.
+        The placeholders for all songs are created with a single query,
+        a single task confirms the cached songs and starts the downloads of the others.
+        Songs without an id are searched by that task, so the caller is not blocked.
+        If :param fallback: is set, songs that can not be provided are searched
+        on the other platforms, like a regular request."""
+        if storage.get("new_music_only"):
+            # songs without an id are checked after they were found
+            played_urls = set(
+                ArchivedSong.objects.filter(
+                    url__in=[
+                        provider.get_external_url()
+                        for provider in providers
+                        if provider.id is not None
+                    ],
+                    counter__gt=0,
+                ).values_list("url", flat=True)
+            )
+            providers = [
+                provider
+                for provider in providers
+                if provider.id is None
+                or provider.get_external_url() not in played_urls
+            ]
+
+        max_queue_length = storage.get("max_queue_length")
+        if max_queue_length > 0:
+            providers = providers[: max(max_queue_length - live_queue.count(), 0)]
+        if not providers:
+            return
+
+        initial_votes = 1 if manually_requested else 0
+        queued_songs = playback.queue.enqueue_many(
+            [provider._placeholder_metadata() for provider in providers],
+            manually_requested,
+            votes=initial_votes,
+        )
+        for provider, queued_song in zip(providers, queued_songs):
+            provider.queued_song = queued_song
+        musiq.update_state()
+
+        fetch_enqueue_many.delay(providers, session_key, archive, fallback)
@@ -2,23 +2,38 @@
 
 from __future__ import annotations
 
-import random
-from typing import Optional, Tuple, TYPE_CHECKING
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
 
 from django.db import models
 from django.db import transaction
-from django.db.models import F, QuerySet
+from django.db.models import QuerySet
 
 import core.models
+from core.celery import app
+from core.musiq import live_queue
 
 if TYPE_CHECKING:
     from core.models import QueuedSong
     from core.musiq.song_utils import Metadata
 
+# The index of a song is a sparse ordering key, consecutive songs are INDEX_SPACING apart.
+# This way, a song can be moved into the gap between two others by changing only its own row,
+# instead of shifting the index of every song in between.
+# Only when a gap is exhausted all indices are spread out again.
+INDEX_SPACING = 1 << 16
+# if a gap gets smaller than this after a move, a rebalance is scheduled in the background
+MIN_GAP = 16
+# Indices are combined with votes into a single score in the live queue (see live_queue.VOTE_WEIGHT).
+# If songs are only appended and never played for a long time,
+# indices grow beyond this and the queue is spread out again.
+MAX_INDEX = 1 << 38
+
 
 class SongQueue(models.Manager):
     """This is the manager for the QueuedSong model.
-    Handles all operations on the queue."""
+    Handles all operations on the queue.
+    The order and the votes of queued songs are kept in redis (see live_queue)
+    and written to the database in the background."""
 
     @transaction.atomic
     def confirmed(self) -> QuerySet[QueuedSong]:
@@ -29,15 +44,18 @@ class SongQueue(models.Manager):
     @transaction.atomic
     def delete_placeholders(self) -> None:
         """Deletes all songs from the queue that are not confirmed."""
-        self.filter(internal_url=None).delete()
+        placeholders = self.filter(internal_url=None)
+        keys = list(placeholders.values_list("id", flat=True))
+        placeholders.delete()
+        live_queue.discard(keys)
 
     @transaction.atomic
     def enqueue(
         self, metadata: "Metadata", manually_requested: bool, votes=0
     ) -> QueuedSong:
         """Creates a new song at the end of the queue and returns it."""
-        last = self.last()
-        index = 1 if last is None else last.index + 1
+        last_index = live_queue.last_index()
+        index = INDEX_SPACING if last_index is None else last_index + INDEX_SPACING
         song = self.create(
             index=index,
             votes=votes,
@@ -49,137 +67,108 @@ class SongQueue(models.Manager):
             external_url=metadata["external_url"],
             stream_url=metadata["stream_url"],
         )
+        # another song might have been appended in the meantime
+        song.index = live_queue.add(song)
+        if song.index > MAX_INDEX:
+            transaction.on_commit(_rebalance.delay)
         return song
 
     @transaction.atomic
-    def dequeue(self) -> Tuple[int, Optional["QueuedSong"]]:
-        """Removes the first completed song from the queue and returns its id and the object."""
-        song = self.confirmed().first()
-        if song is None:
+    def enqueue_many(
+        self, metadatas: List["Metadata"], manually_requested: bool, votes=0
+    ) -> List[QueuedSong]:
+        """Creates new songs at the end of the queue in the given order and returns them.
+        All songs are inserted with a single query."""
+        last_index = live_queue.last_index()
+        first_index = (
+            INDEX_SPACING if last_index is None else last_index + INDEX_SPACING
+        )
+        songs = self.bulk_create(
+            [
+                self.model(
+                    index=first_index + position * INDEX_SPACING,
+                    votes=votes,
+                    manually_requested=manually_requested,
+                    artist=metadata["artist"],
+                    title=metadata["title"],
+                    duration=metadata["duration"],
+                    internal_url=metadata["internal_url"],
+                    external_url=metadata["external_url"],
+                    stream_url=metadata["stream_url"],
+                )
+                for position, metadata in enumerate(metadatas)
+            ]
+        )
+        for song, index in zip(songs, live_queue.add_many(songs)):
+            song.index = index
+        if songs and songs[-1].index > MAX_INDEX:
+            transaction.on_commit(_rebalance.delay)
+        return songs
+
+    def dequeue(self, ranked: bool = False) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """Removes the first completed song from the queue and returns its id and its fields.
+        If :param ranked: is set, the completed song with the most votes is removed instead.
+        The database row of the song is deleted asynchronously by the next persistence."""
+        fields = live_queue.pop(ranked=ranked)
+        if fields is None:
             return -1, None
-        song_id = song.id
-        song.delete()
-        self.filter(index__gt=song.index).update(index=F("index") - 1)
-        return song_id, song
+        return fields["id"], fields
 
-    @transaction.atomic
     def prioritize(self, key: int) -> None:
         """Moves the song specified by :param key: to the front of the queue."""
-        to_prioritize = self.get(id=key)
-        first = self.first()
-        if to_prioritize == first:
-            return
-
-        self.filter(index__lt=to_prioritize.index).update(index=F("index") + 1)
-        to_prioritize.index = 1
-        to_prioritize.save()
-
-    @transaction.atomic
-    def remove(self, key: int) -> "QueuedSong":
-        """Removes the song specified by :param key: from the queue and returns it."""
-        to_remove = self.get(id=key)
-        to_remove.delete()
-        self.filter(index__gt=to_remove.index).update(index=F("index") - 1)
-        return to_remove
+        live_queue.prioritize(key)
+
+    def remove(self, key: int) -> Dict[str, Any]:
+        """Removes the song specified by :param key: from the queue and returns its fields.
+        The database row of the song is deleted asynchronously by the next persistence."""
+        fields = live_queue.pop(key)
+        if fields is None:
+            raise core.models.QueuedSong.DoesNotExist
+        return fields
+
+    def remove_all(self) -> None:
+        """Removes every song from the queue."""
+        with transaction.atomic():
+            self.all().delete()
+            live_queue.clear()
 
-    @transaction.atomic
     def reorder(
         self, new_prev_id: Optional[int], element_id: int, new_next_id: Optional[int]
     ) -> None:
         """Moves the song specified by :param element_id:
         between the two songs :param new_prev_id: and :param new_next_id:."""
-
-        try:
-            new_prev = self.get(id=new_prev_id)
-        except core.models.QueuedSong.DoesNotExist:
-            new_prev = None
-        try:
-            to_reorder = self.get(id=element_id)
-        except core.models.QueuedSong.DoesNotExist:
-            raise ValueError("reordered song does not exist")
-        try:
-            new_next = self.get(id=new_next_id)
-        except core.models.QueuedSong.DoesNotExist:
-            new_next = None
-
-        first = self.first()
-        last = self.last()
-        # check validity of request
-        if new_prev is None and new_next is None:
-            # to_reorder has to be the only element in the queue
-            if first != to_reorder or last != to_reorder:
-                raise ValueError("reordered song is not the only one")
-        if new_prev is None and new_next is not None:
-            # new_next has to be the first element
-            if new_next != first:
-                raise ValueError("given first is not head of the queue")
-        if new_prev is not None and new_next is None:
-            # new_prev has to be the last element
-            if new_prev != last:
-                raise ValueError("given last is not tail of the queue")
-        if new_prev is not None and new_next is not None:
-            # new_prev and new_next have to be adjacent
-            if new_next.index != new_prev.index + 1:
-                raise ValueError("given pair of songs is not adjacent")
-
-        try:
-            old_prev = self.get(index=to_reorder.index - 1)
-        except core.models.QueuedSong.DoesNotExist:
-            old_prev = None
-        try:
-            old_next = self.get(index=to_reorder.index + 1)
-        except core.models.QueuedSong.DoesNotExist:
-            old_next = None
-
-        # update indices
-        moving_up = True
-        if new_prev is not None:
-            if new_prev.index > to_reorder.index:
-                moving_up = False
-        elif new_next is not None:
-            if new_next.index > to_reorder.index:
-                moving_up = False
-
-        to_update = self.all()
-        if moving_up:
-            if old_prev is not None:
-                to_update = to_update.filter(index__lte=old_prev.index)
-            new_index = 1
-            if new_next is not None:
-                new_index = new_next.index
-                to_update = to_update.filter(index__gte=new_next.index)
-            to_update.update(index=F("index") + 1)
-        else:
-            new_index = 1
-            if new_prev is not None:
-                new_index = new_prev.index
-                to_update = to_update.filter(index__lte=new_prev.index)
-            if old_next is not None:
-                to_update = to_update.filter(index__gte=old_next.index)
-            to_update.update(index=F("index") - 1)
-
-        to_reorder.index = new_index
-        to_reorder.save()
-
-    @transaction.atomic
-    def shuffle(self) -> None:
-        """Assigns a random index to every song in the queue."""
-        indices = list(range(1, self.count() + 1))
-        random.shuffle(indices)
-        for song, index in zip(self.all(), indices):
-            song.index = index
-            song.save()
-
-    @transaction.atomic
-    def vote(self, key: int, amount: int, threshold: int) -> Optional["QueuedSong"]:
+        gap = live_queue.reorder(new_prev_id, element_id, new_next_id)
+        if gap < MIN_GAP:
+            # the next move into this gap might require a rebalance.
+            # Do it now while nobody is waiting for it.
+            transaction.on_commit(_rebalance.delay)
+
+    def rebalance(self) -> None:
+        """Spreads out the indices of all songs evenly, keeping their order."""
+        live_queue.rebalance()
+
+    def shuffle(
+        self, start: int = 0, autoplay_only: bool = False, ranked: bool = False
+    ) -> None:
+        """Randomly reorders the songs in the queue.
+        The first :param start: songs keep their position.
+        If :param autoplay_only: is set, manually requested songs keep their position as well.
+        If :param ranked: is set, positions refer to the order by votes.
+        Only the indices of the shuffled songs are permuted among each other."""
+        live_queue.shuffle(start, autoplay_only, ranked)
+
+    def vote(self, key: int, amount: int, threshold: int) -> Optional[Dict[str, Any]]:
         """Modify the vote-count of the song specified by :param key: by :param amount: votes.
-        If the song is now below the threshold, remove and return it."""
-        self.filter(id=key).update(votes=F("votes") + amount)
-        try:
-            song = self.get(id=key)
-            if song.votes <= threshold:
-                song.delete()
-                return song
-        except core.models.QueuedSong.DoesNotExist:
-            pass
-        return None
+        If the song is now below the threshold, remove it and return its fields.
+        The database row of a removed song is deleted asynchronously by the next persistence.
+        Raises QueuedSong.DoesNotExist if the song is not queued."""
+        result = live_queue.vote(key, amount, threshold)
+        if result is None:
+            raise core.models.QueuedSong.DoesNotExist
+        _, removed = result
+        return removed
+
+
+@app.task
+def _rebalance() -> None:
+    core.models.QueuedSong.objects.rebalance()
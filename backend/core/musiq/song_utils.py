@@ -2,6 +2,7 @@
 
 import os
 import re
+import unicodedata
 from typing import TYPE_CHECKING, Optional
 
 import mutagen.easymp4
@@ -114,6 +115,12 @@ def get_metadata(path: str) -> "Metadata":
     return metadata
 
 
+def normalize_query(query: str) -> str:
+    """Returns the form of the given query that is used to recognize repeated queries.
+    Case, unicode representation and whitespace are ignored."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
 def is_forbidden(s: str) -> bool:
     """Returns whether the given string should be filtered according to the forbidden keywords."""
     # We can't access the variable in settings/basic.py
@@ -9,7 +9,7 @@ import soundcloud
 from bs4 import BeautifulSoup
 from django.http.response import HttpResponse
 
-from core.musiq import song_utils, musiq
+from core.musiq import music_provider, song_utils
 from core.musiq.song_provider import SongProvider
 from core.musiq.playlist_provider import PlaylistProvider
 
@@ -145,18 +145,10 @@ class SoundcloudSongProvider(SongProvider, Soundcloud):
     def request_radio(self, session_key: str) -> HttpResponse:
         urls = self._get_related_urls()
 
-        for external_url in urls:
-            musiq.do_request_music(
-                "",
-                external_url,
-                None,
-                False,
-                "soundcloud",
-                archive=False,
-                manually_requested=False,
-            )
-
-        return HttpResponse("queueing radio")
+        return music_provider.request_radio(
+            [SongProvider.create(external_url=external_url) for external_url in urls],
+            session_key,
+        )
 
 
 class SoundcloudPlaylistProvider(PlaylistProvider, Soundcloud):
@@ -8,7 +8,7 @@ from urllib.parse import urlparse
 from django.http.response import HttpResponse
 
 import core.settings.storage as storage
-from core.musiq import song_utils, musiq
+from core.musiq import music_provider, song_utils
 from core.musiq.song_provider import SongProvider
 from core.musiq.playlist_provider import PlaylistProvider
 from core.musiq.spotify_web import OAuthClient
@@ -196,19 +196,13 @@ class SpotifySongProvider(SongProvider, Spotify):
             },
         )
 
-        for track in result["tracks"]:
-            external_url = track["external_urls"]["spotify"]
-            musiq.do_request_music(
-                "",
-                external_url,
-                None,
-                False,
-                "spotify",
-                archive=False,
-                manually_requested=False,
-            )
-
-        return HttpResponse("queueing radio")
+        return music_provider.request_radio(
+            [
+                SongProvider.create(external_url=track["external_urls"]["spotify"])
+                for track in result["tracks"]
+            ],
+            session_key,
+        )
 
 
 class SpotifyPlaylistProvider(PlaylistProvider, Spotify):
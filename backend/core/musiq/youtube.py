@@ -2,13 +2,16 @@
 
 from __future__ import annotations
 
-import errno
+import atexit
 import json
 import logging
 import os
+import pathlib
 import pickle
+import queue
 import shutil
-import subprocess
+import threading
+import time
 from contextlib import contextmanager
 from typing import Any, Dict, List, Optional, TYPE_CHECKING, Iterator, cast
 from urllib.parse import parse_qs
@@ -17,44 +20,189 @@ from urllib.parse import urlparse
 import requests
 import yt_dlp
 from django.conf import settings
+from django.db import connection
 from django.http.response import HttpResponse
 
 import core.musiq.song_utils as song_utils
 import core.settings.storage as storage
-from core.models import ArchivedSong
-from core.musiq import musiq
+from core import redis
+from core.celery import app
+from core.models import ArchivedSong, QueuedSong
+from core.musiq import downloads, live_queue, loudness, musiq, song_cache
 from core.musiq.song_provider import SongProvider
 from core.musiq.playlist_provider import PlaylistProvider
 
 if TYPE_CHECKING:
     from core.musiq.song_utils import Metadata
 
-
-@contextmanager
-def youtube_session() -> Iterator[requests.Session]:
-    """This context opens a requests session and loads the youtube cookies file."""
-
-    pickle_file = os.path.join(settings.BASE_DIR, "config/youtube_cookies.pickle")
-    session = requests.session()
+# the information extracted by yt-dlp is stored here, one file per video id
+INFO_CACHE_DIR = os.path.join(settings.BASE_DIR, "config/youtube_info")
+# Cached information contains the urls of the media, which expire after some hours.
+# It is not used anymore shortly before its urls expire, so a download can still finish.
+INFO_EXPIRY_MARGIN = 10 * 60
+# how long information is cached whose urls do not state their expiry
+INFO_DEFAULT_LIFETIME = 60 * 60
+# Entries of videos that were not requested again are removed at most this often.
+# The key is set while the removal is not due yet.
+INFO_CLEANUP_INTERVAL = 60 * 60
+INFO_CLEANUP_KEY = "youtube_info_cleanup"
+
+
+COOKIES_FILE = os.path.join(settings.BASE_DIR, "config/youtube_cookies.pickle")
+# how many idle sessions are kept open for reuse
+SESSION_POOL_SIZE = 4
+# changed cookies are written to disk after this many seconds
+COOKIES_SAVE_DELAY = 60
+
+# All sessions of this process share their cookies.
+# The jar is created when the first session is needed and only accessed under the lock.
+# Every session changes its own jar while it is used,
+# it is synchronized with the shared one when the session is taken and returned.
+_cookies: Optional[requests.cookies.RequestsCookieJar] = None
+_cookies_lock = threading.Lock()
+_cookies_save_timer: Optional[threading.Timer] = None
+_idle_sessions: "queue.LifoQueue[requests.Session]" = queue.LifoQueue()
+
+
+def _load_cookies() -> requests.cookies.RequestsCookieJar:
+    cookies = requests.cookies.RequestsCookieJar()
     # Have yt-dlp deal with consent cookies etc to setup a valid session
     extractor = yt_dlp.extractor.youtube.YoutubeIE()
     extractor._downloader = yt_dlp.YoutubeDL()
     extractor.initialize()
-    session.cookies.update(extractor._downloader.cookiejar)
+    cookies.update(extractor._downloader.cookiejar)
 
     try:
-        if os.path.getsize(pickle_file) > 0:
-            with open(pickle_file, "rb") as f:
-                session.cookies.update(pickle.load(f))
+        if os.path.getsize(COOKIES_FILE) > 0:
+            with open(COOKIES_FILE, "rb") as f:
+                cookies.update(pickle.load(f))
     except FileNotFoundError:
         pass
-
+    return cookies
+
+
+def _save_cookies() -> None:
+    global _cookies_save_timer
+    with _cookies_lock:
+        _cookies_save_timer = None
+        if _cookies is None:
+            return
+        data = pickle.dumps(_cookies)
+    with open(COOKIES_FILE, "wb") as f:
+        f.write(data)
+
+
+def _create_session() -> requests.Session:
+    global _cookies
+    with _cookies_lock:
+        if _cookies is None:
+            _cookies = _load_cookies()
+            # cookies that were not written yet are saved when the process exits
+            atexit.register(_save_cookies)
+    session = requests.session()
     headers = {"User-Agent": yt_dlp.utils.random_user_agent()}
     session.headers.update(headers)
-    yield session
+    return session
+
+
+@contextmanager
+def youtube_session() -> Iterator[requests.Session]:
+    """This context provides a requests session with the youtube cookies.
+    Sessions are reused, so their connections are kept alive between requests.
+    The cookies are written to disk shortly after they were used."""
+    global _cookies_save_timer
+    try:
+        session = _idle_sessions.get_nowait()
+    except queue.Empty:
+        session = _create_session()
+    with _cookies_lock:
+        assert _cookies is not None
+        session.cookies.update(_cookies)
 
-    with open(pickle_file, "wb") as f:
-        pickle.dump(session.cookies, f)
+    try:
+        yield session
+    finally:
+        with _cookies_lock:
+            assert _cookies is not None
+            _cookies.update(session.cookies)
+            if _cookies_save_timer is None:
+                _cookies_save_timer = threading.Timer(COOKIES_SAVE_DELAY, _save_cookies)
+                _cookies_save_timer.daemon = True
+                _cookies_save_timer.start()
+        if _idle_sessions.qsize() < SESSION_POOL_SIZE:
+            _idle_sessions.put(session)
+        else:
+            session.close()
+
+
+def _info_path(video_id: str) -> str:
+    return os.path.join(INFO_CACHE_DIR, video_id + ".json")
+
+
+def _info_expiry(info: Dict[str, Any]) -> float:
+    # media urls contain the time of their expiry as a parameter
+    expiries = []
+    for media_format in info.get("formats") or [info]:
+        url = media_format.get("url")
+        if not url:
+            continue
+        expire = parse_qs(urlparse(url).query).get("expire")
+        if expire and expire[0].isdigit():
+            expiries.append(int(expire[0]))
+    if not expiries:
+        return time.time() + INFO_DEFAULT_LIFETIME
+    return min(expiries) - INFO_EXPIRY_MARGIN
+
+
+def load_info(video_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the cached information of the given video if it is still valid."""
+    path = _info_path(video_id)
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if entry["expires"] < time.time():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    return entry["info"]
+
+
+def _remove_old_info() -> None:
+    # removes the entries of videos that were not requested again,
+    # media urls expire after some hours, so day old entries are certainly expired
+    now = time.time()
+    with os.scandir(INFO_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime + INFO_DEFAULT_LIFETIME * 24 < now:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def store_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Caches the information that yt-dlp extracted for a video.
+    Returns the information in the form that is cached."""
+    info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    # subtitles are not needed and make up most of the information
+    info.pop("subtitles", None)
+    info.pop("automatic_captions", None)
+    pathlib.Path(INFO_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    if redis.redis_connection.set(
+        INFO_CLEANUP_KEY, 1, nx=True, ex=INFO_CLEANUP_INTERVAL
+    ):
+        _remove_old_info()
+    path = _info_path(info["id"])
+    # write to a temporary file first so concurrent readers never see partial entries
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump({"expires": _info_expiry(info), "info": info}, f)
+    os.replace(temporary_path, path)
+    return info
 
 
 class YoutubeDLLogger:
@@ -157,13 +305,26 @@ class YoutubeSongProvider(SongProvider, Youtube):
         super().__init__(query, key)
         self.info_dict: Dict[str, Any] = {}
         self.ydl_opts = Youtube.get_ydl_opts()
+        # whether the song is played from its stream until its file is downloaded
+        self.streaming = False
 
     def check_cached(self) -> bool:
         if not self.id:
             return False
         return os.path.isfile(self._get_path())
 
+    def resolve(self, cancelled: Optional[threading.Event] = None) -> bool:
+        fetch = super().resolve(cancelled)
+        redis.incr("song_cache_misses" if fetch else "song_cache_hits")
+        return fetch
+
     def check_available(self) -> bool:
+        if self.id:
+            # the video is already known, e.g. from an archived query
+            info = load_info(self.id)
+            if info is not None:
+                self.info_dict = info
+                return self.check_not_too_large(info.get("filesize"))
 
         # directly use the search extractors entry function so we can process each result
         # as soon as it's available instead of waiting for all of them
@@ -173,9 +334,14 @@ class YoutubeSongProvider(SongProvider, Youtube):
         for entry in extractor._search_results(self.query):
             if song_utils.is_forbidden(entry["title"]):
                 continue
+            info = load_info(entry["id"])
+            if info is not None:
+                self.info_dict = info
+                break
             try:
                 with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                    self.info_dict = ydl.extract_info(entry["id"], download=False)
+                    info = ydl.extract_info(entry["id"], download=False)
+                self.info_dict = store_info(info)
                 break
             except (yt_dlp.utils.ExtractorError, yt_dlp.utils.DownloadError) as e:
                 logging.warning("error during availability check for %s:", entry["id"])
@@ -186,15 +352,24 @@ class YoutubeSongProvider(SongProvider, Youtube):
 
         self.id = self.info_dict["id"]
 
-        return self.check_not_too_large(self.info_dict["filesize"])
+        return self.check_not_too_large(self.info_dict.get("filesize"))
 
     def _download(self) -> bool:
         error = None
         location = None
 
         try:
+            # reuse the information from the availability check if it is still valid
+            info = load_info(self.id) if self.id else None
             with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                ydl.download([self.get_external_url()])
+                if info is None:
+                    ydl.download([self.get_external_url()])
+                else:
+                    try:
+                        ydl.process_ie_result(info, download=True)
+                    except yt_dlp.utils.DownloadError:
+                        # the media urls might have expired early, extract them again
+                        ydl.download([self.get_external_url()])
 
             location = self._get_path()
             base = os.path.splitext(location)[0]
@@ -204,19 +379,6 @@ class YoutubeSongProvider(SongProvider, Youtube):
             except FileNotFoundError:
                 logging.info("tried to delete %s but does not exist", thumbnail)
 
-            try:
-                # tag the file with replaygain to perform volume normalization
-                subprocess.call(
-                    ["rganalysis", location],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    pass  # the rganalysis package was not found. Skip normalization
-                else:
-                    raise
-
         except yt_dlp.utils.DownloadError as e:
             error = e
 
@@ -225,18 +387,84 @@ class YoutubeSongProvider(SongProvider, Youtube):
             logging.error("location: %s", location)
             logging.error(error)
             return False
+
+        ArchivedSong.objects.filter(url=self.get_external_url()).update(cached=True)
+        # make room for the new file
+        song_cache.evict.delay()
+        # tag the file with replaygain to perform volume normalization,
+        # the song can already be played in the meantime
+        loudness.analyze.delay(self.get_external_url(), location)
         return True
 
+    def _stream_url(self) -> Optional[str]:
+        # the url of the audio that yt-dlp selected, if it is still valid
+        info = load_info(self.id) if self.id else None
+        if info is None:
+            return None
+        self.info_dict = info
+        return info.get("url")
+
     def make_available(self) -> bool:
-        if not os.path.isfile(self._get_path()):
-            musiq.update_state()
-            # only download the file if it was not already downloaded
-            return self._download()
+        if os.path.isfile(self._get_path()):
+            return True
+        if (
+            storage.get("stream_first")
+            and self.queued_song is not None
+            and self._stream_url()
+        ):
+            # the requested song is played from its stream right away,
+            # its file is downloaded after it was confirmed
+            self.streaming = True
+            return True
+        return self._fetch()
+
+    def _fetch(self) -> bool:
+        # Only download the file if it was not already downloaded,
+        # concurrent requests for the same video use the same download.
+        # Raises DownloadDeferred if the download can not start yet.
+        return downloads.singleflight(
+            self.id,
+            self._download_missing,
+            priority=lambda: downloads.queue_priority(self.get_queue_key()),
+        )
+
+    def _download_missing(self) -> bool:
+        if os.path.isfile(self._get_path()):
+            return True
+        musiq.update_state()
+        return self._download()
+
+    def confirm(self) -> bool:
+        if not super().confirm():
+            return False
+        if self.streaming:
+            replace_stream.delay(self)
         return True
 
+    def _stream_metadata(self) -> "Metadata":
+        # The same tags that are written into the file when it is downloaded.
+        # The stream url expires, it is only used to play the queued song.
+        # Everything that is archived refers to the watch url.
+        info = self.info_dict
+        stream_url = cast(str, info["url"])
+        return {
+            "artist": info.get("artist")
+            or info.get("creator")
+            or info.get("uploader")
+            or "",
+            "title": info.get("track") or info.get("title") or self.get_external_url(),
+            "duration": info.get("duration") or -1,
+            "internal_url": stream_url,
+            "external_url": self.get_external_url(),
+            "stream_url": stream_url,
+            "cached": False,
+        }
+
     def get_metadata(self) -> "Metadata":
         if not self.id:
             raise ValueError()
+        if self.streaming:
+            return self._stream_metadata()
         try:
             archived_song = ArchivedSong.objects.get(url=self.get_external_url())
             metadata = archived_song.get_metadata()
@@ -298,6 +526,39 @@ class YoutubeSongProvider(SongProvider, Youtube):
         return HttpResponse("queueing radio (might take some time)")
 
 
+@app.task
+def replace_stream(provider: YoutubeSongProvider) -> None:
+    """Downloads a song that was confirmed with its stream.
+    If it was not played yet, it is played from the downloaded file instead."""
+    try:
+        _replace_stream(provider)
+    finally:
+        connection.close()
+
+
+def _replace_stream(provider: YoutubeSongProvider) -> None:
+    provider.streaming = False
+    try:
+        fetched = provider._fetch()
+    except downloads.DownloadDeferred:
+        replace_stream.apply_async((provider,), countdown=downloads.RETRY_DELAY)
+        return
+    if not fetched:
+        # the song is still played from its stream
+        logging.warning("could not download streamed song %s", provider.id)
+        return
+    queued_song = provider.queued_song
+    assert queued_song
+    queued_song.internal_url = provider.get_internal_url()
+    queued_song.stream_url = None
+    fields = ["internal_url", "stream_url"]
+    QueuedSong.objects.filter(id=queued_song.id).update(
+        internal_url=queued_song.internal_url, stream_url=None
+    )
+    # has no effect if the song already started playing
+    live_queue.update(queued_song, fields)
+
+
 class YoutubePlaylistProvider(PlaylistProvider, Youtube):
     """This class handles Youtube Playlists."""
 
@@ -7,11 +7,20 @@ from django.conf import settings as conf
 from redis import Redis
 
 # locks:
-# player_lock:  controlling mopidy api accesses
 # lights_lock:  ensures lights settings are not changed during device updates
+# song_cache_lock: ensures only one process removes songs from the cache
+# download:<id>: held while a song is downloaded, so it is only downloaded once
 
 # channels
 # lights_settings_changed
+# playback_control: wakes up the playback loop while it waits for the end of a song
+# live_queue:changed: announces every change of the queue
+
+# expiring keys
+# download_result:<id>: the result of a recent download for the requests that tried again
+
+# streams
+# mopidy:commands: commands for mopidy that are executed by the playback worker
 
 # values:
 # maps key to default and type of value
@@ -23,6 +32,17 @@ defaults = {
     "alarm_playing": False,
     "alarm_requested": False,
     "backup_playing": False,
+    "song_end_latency": 0.0,
+    "mopidy_latency": {},
+    "prefetch_hits": 0,
+    "prefetch_misses": 0,
+    "prefetch_downloads": 0,
+    "song_cache_size": 0,
+    "song_cache_hits": 0,
+    "song_cache_misses": 0,
+    "song_cache_evictions": 0,
+    "song_cache_evicted_bytes": 0,
+    "downloads_deduplicated": 0,
     # lights
     "lights_active": False,
     "ring_initialized": False,
@@ -47,6 +67,9 @@ defaults = {
     "active_requests": 0,
     "last_user_count_update": 0.0,
     "last_requests": {},
+    # state handler
+    "broadcasts_sent": 0,
+    "broadcasts_saved": 0,
 }
 
 redis_connection = Redis(
@@ -64,6 +87,7 @@ publish = redis_connection.publish
 transaction = redis_connection.transaction
 incr = redis_connection.incr
 decr = redis_connection.decr
+register_script = redis_connection.register_script
 
 
 def get(key: str) -> Union[bool, int, float, str, List, Dict, Tuple]:
@@ -3,4 +3,7 @@
 from django.urls import path
 from core import state_handler
 
-WEBSOCKET_URLPATTERNS = [path("state/", state_handler.StateConsumer.as_asgi())]
+WEBSOCKET_URLPATTERNS = [
+    path("state/<str:page>/", state_handler.StateConsumer.as_asgi()),
+    path("state/", state_handler.StateConsumer.as_asgi()),
+]
@@ -9,7 +9,7 @@ from django.core.handlers.wsgi import WSGIRequest
 from core import user_manager, redis
 from core.settings import storage
 from core.settings.settings import control
-from core.musiq import playback
+from core.musiq import playback, song_cache
 
 
 def start() -> None:
@@ -48,6 +48,13 @@ def set_new_music_only(request: WSGIRequest) -> None:
     storage.set("new_music_only", enabled)
 
 
+@control
+def set_provider_racing(request: WSGIRequest) -> None:
+    """Enables or disables asking all music providers at once for a requested song."""
+    enabled = request.POST.get("value") == "true"
+    storage.set("provider_racing", enabled)
+
+
 @control
 def set_logging_enabled(request: WSGIRequest) -> None:
     """Enables or disables logging of requests and play logs based on the given value."""
@@ -135,6 +142,28 @@ def set_max_download_size(request: WSGIRequest) -> None:
     storage.set("max_download_size", value)
 
 
+@control
+def set_max_cache_size(request: WSGIRequest) -> None:
+    """Sets the maximum amount of MB that downloaded songs may occupy on disk."""
+    value = float(request.POST.get("value"))  # type: ignore
+    storage.set("max_cache_size", value)
+    song_cache.evict.delay()
+
+
+@control
+def set_download_concurrency(request: WSGIRequest) -> None:
+    """Sets the number of songs that are downloaded at the same time."""
+    value = int(request.POST.get("value"))  # type: ignore
+    storage.set("download_concurrency", value)
+
+
+@control
+def set_stream_first(request: WSGIRequest) -> None:
+    """Enables or disables playing songs from their stream until their file is downloaded."""
+    enabled = request.POST.get("value") == "true"
+    storage.set("stream_first", enabled)
+
+
 @control
 def set_max_playlist_items(request: WSGIRequest) -> None:
     """Sets the maximum number of songs that are downloaded from a playlist."""
@@ -149,6 +178,27 @@ def set_max_queue_length(request: WSGIRequest) -> None:
     storage.set("max_queue_length", value)
 
 
+@control
+def set_gapless_playback(request: WSGIRequest) -> None:
+    """Enables or disables adding the next song to the player while the current one is playing."""
+    enabled = request.POST.get("value") == "true"
+    storage.set("gapless_playback", enabled)
+
+
+@control
+def set_prefetch_songs(request: WSGIRequest) -> None:
+    """Sets the number of upcoming songs whose files are kept on disk."""
+    value = int(request.POST.get("value"))  # type: ignore
+    storage.set("prefetch_songs", value)
+
+
+@control
+def set_broadcast_window(request: WSGIRequest) -> None:
+    """Sets the time in milliseconds in which state updates are combined."""
+    value = int(request.POST.get("value"))  # type: ignore
+    storage.set("broadcast_window", value)
+
+
 @control
 def set_additional_keywords(request: WSGIRequest):
     """Sets the keywords to filter out of results."""
@@ -18,8 +18,9 @@ from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
 
 from core import user_manager, base, redis, celery
+from core.musiq import downloads, mopidy_gateway
 from core.settings.storage import get
-from core.state_handler import send_state
+from core.state_handler import broadcast
 
 
 def control(
@@ -39,12 +40,44 @@ def control(
     return wraps(func)(_decorator)
 
 
+def _statistics() -> Dict[str, Any]:
+    # counters that change with every song or request, no update is sent for them
+    statistics = {}
+    cache_size = redis.get("song_cache_size") / 1024 / 1024
+    statistics["songCacheSize"] = f"{cache_size:.0f} MB"
+    hits = redis.get("song_cache_hits")
+    misses = redis.get("song_cache_misses")
+    statistics["songCacheHitRate"] = (
+        f"{hits / (hits + misses) * 100:.0f}%" if hits + misses else "-"
+    )
+    statistics["songCacheEvictions"] = redis.get("song_cache_evictions")
+    statistics["downloadStatus"] = downloads.status()
+    hits = redis.get("prefetch_hits")
+    misses = redis.get("prefetch_misses")
+    statistics["prefetchHitRate"] = (
+        f"{hits / (hits + misses) * 100:.0f}%" if hits + misses else "-"
+    )
+    statistics["prefetchMisses"] = misses
+    statistics["prefetchDownloads"] = redis.get("prefetch_downloads")
+    statistics["broadcastsSent"] = redis.get("broadcasts_sent")
+    statistics["broadcastsSaved"] = redis.get("broadcasts_saved")
+    statistics["mopidyLatency"] = ", ".join(mopidy_gateway.latencies())
+    statistics["songEndLatency"] = f"{redis.get('song_end_latency') * 1000:.0f}"
+    return statistics
+
+
+def volatile_state(built: Dict[str, Any], elapsed: float) -> Dict[str, Any]:
+    """Returns the statistics of the settings state, which change without an update."""
+    return {**base.volatile_state(built, elapsed), "settings": _statistics()}
+
+
 def state_dict() -> Dict[str, Any]:
     state = base.state_dict()
 
     settings_state = {}
     settings_state["votingEnabled"] = get("voting_enabled")
     settings_state["newMusicOnly"] = get("new_music_only")
+    settings_state["providerRacing"] = get("provider_racing")
     settings_state["loggingEnabled"] = get("logging_enabled")
     settings_state["embedStream"] = get("embed_stream")
     settings_state["dynamicEmbeddedStream"] = get("dynamic_embedded_stream")
@@ -56,10 +89,17 @@ def state_dict() -> Dict[str, Any]:
     settings_state["buzzerCooldown"] = get("buzzer_cooldown")
     settings_state["downvotesToKick"] = get("downvotes_to_kick")
     settings_state["maxDownloadSize"] = get("max_download_size")
+    settings_state["maxCacheSize"] = get("max_cache_size")
+    settings_state["downloadConcurrency"] = get("download_concurrency")
+    settings_state["streamFirst"] = get("stream_first")
     settings_state["additionalKeywords"] = get("additional_keywords")
     settings_state["forbiddenKeywords"] = get("forbidden_keywords")
     settings_state["maxPlaylistItems"] = get("max_playlist_items")
     settings_state["maxQueueLength"] = get("max_queue_length")
+    settings_state["gaplessPlayback"] = get("gapless_playback")
+    settings_state["prefetchSongs"] = get("prefetch_songs")
+    settings_state["broadcastWindow"] = get("broadcast_window")
+    settings_state.update(_statistics())
     settings_state["hasInternet"] = redis.get("has_internet")
 
     settings_state["youtubeEnabled"] = get("youtube_enabled")
@@ -143,6 +183,7 @@ def index(request: WSGIRequest) -> HttpResponse:
     return render(request, "settings.html", context)
 
 
-def update_state() -> None:
-    """Sends an update event to all connected clients."""
-    send_state(state_dict())
+def update_state(immediate: bool = False) -> None:
+    """Sends an update event to all connected clients.
+    Updates in quick succession are combined, unless :param immediate: is set."""
+    broadcast("settings", state_dict, immediate)
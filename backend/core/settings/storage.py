@@ -13,6 +13,7 @@ defaults = {
     "voting_enabled": False,
     "ip_checking": False,
     "new_music_only": False,
+    "provider_racing": False,
     "logging_enabled": True,
     "hashtags_active": True,
     "embed_stream": False,
@@ -24,8 +25,14 @@ defaults = {
     "buzzer_cooldown": 60.0,
     "downvotes_to_kick": 2,
     "max_download_size": 0.0,
+    "max_cache_size": 0.0,
+    "download_concurrency": 2,
+    "stream_first": False,
     "max_playlist_items": 10,
     "max_queue_length": 0,
+    "broadcast_window": 50,
+    "gapless_playback": False,
+    "prefetch_songs": 5,
     "additional_keywords": "",
     "forbidden_keywords": "",
     # platforms
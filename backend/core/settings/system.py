@@ -10,24 +10,17 @@ import sys
 from typing import Dict, Optional, Tuple
 
 import cachetools.func
-import redis.exceptions
 import requests
 from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import HttpResponse, HttpResponseBadRequest
 
-from core.musiq.playback import player_lock
 from core.settings import storage
 from core.settings.settings import control
 
 
 def _restart_mopidy() -> None:
     subprocess.call(["sudo", "/usr/local/sbin/raveberry/restart_mopidy"])
-    try:
-        player_lock.release()
-    except redis.exceptions.LockError:
-        # the lock was already released
-        pass
 
 
 def update_mopidy_config(output: str) -> None:
@@ -1,39 +1,261 @@
 """This module handles realtime communication via websockets."""
 import json
-from typing import Dict, Any
+import threading
+import time
+from types import ModuleType
+from typing import Callable, Dict, Any, Iterator, List, Tuple
 
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
 from django.core.handlers.wsgi import WSGIRequest
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.http import HttpResponse
 
+from core import redis
+from core.settings import storage
 
-def send_state(state: Dict[str, Any]) -> None:
-    """Sends the given dictionary as a state update to all connected clients."""
-    data = {"type": "state_update", "state": state}
+# incremented once for every change of a state that is sent to the clients
+VERSION_KEY = "state:version"
+# prefix of the snapshots of every page, followed by the module name.
+# A snapshot is a hash of the version it was built for, the time of the build,
+# the serialized state and the values that its volatile state is derived from.
+# It is replaced as soon as a newer version is requested.
+SNAPSHOT_PREFIX = "state:snapshot:"
+# Volatile values change without an update being sent, e.g. the number of users.
+# A snapshot contains this marker followed by their path instead of the values.
+VOLATILE_MARKER = "\x00volatile:"
+# exists while a broadcast of a page is scheduled, followed by the page name
+PENDING_PREFIX = "state:pending:"
+# Every client receives the base state, which is shown on all pages.
+# The state of a page is only sent to the clients that display it.
+TOPICS = ("base", "musiq", "lights", "settings")
+
+
+try:
+    # orjson is considerably faster, use it if it is installed
+    import orjson
+
+    SERIALIZER = "orjson"
+
+    def serialize(state: Any) -> str:
+        """Converts the given state into the json string that is sent to clients."""
+        return orjson.dumps(state, default=DjangoJSONEncoder().default).decode()
+
+except ModuleNotFoundError:
+    SERIALIZER = "json"
+
+    def serialize(state: Any) -> str:
+        """Converts the given state into the json string that is sent to clients."""
+        return json.dumps(state, cls=DjangoJSONEncoder)
+
+
+def _group(topic: str) -> str:
+    return f"state-{topic}"
+
+
+def _session_group(session_key: str) -> str:
+    return f"session-{session_key}"
+
+
+# KEYS: version, snapshot
+# Returns the current version, and the time of the build, the state
+# and the volatile values of the snapshot if it was built for the current version.
+_load_snapshot = redis.register_script(
+    """
+local version = redis.call("GET", KEYS[1]) or "0"
+local snapshot = redis.call("HMGET", KEYS[2], "version", "built", "data", "volatile")
+if snapshot[1] ~= version then
+    return {version}
+end
+return {version, snapshot[2], snapshot[3], snapshot[4]}
+"""
+)
+
+# KEYS: version, snapshot
+# ARGV: version, built, data, volatile
+# Stores the snapshot, unless the state changed while it was built.
+_store_snapshot = redis.register_script(
+    """
+if (redis.call("GET", KEYS[1]) or "0") ~= ARGV[1] then
+    return 0
+end
+redis.call("HSET", KEYS[2], "version", ARGV[1], "built", ARGV[2])
+redis.call("HSET", KEYS[2], "data", ARGV[3], "volatile", ARGV[4])
+return 1
+"""
+)
+
+
+def _invalidate() -> None:
+    # starts a new version, snapshots of older versions are not served anymore
+    redis.incr(VERSION_KEY)
+
+
+def _send(state: Dict[str, Any], topic: str) -> None:
+    # The state is serialized only once, every client receives the same text.
+    data = {"type": "state_update", "text": serialize(state)}
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(_group(topic), data)
+
+
+def send_state(state: Dict[str, Any], topic: str) -> None:
+    """Sends the given dictionary as a state update to all clients subscribed to :param topic:.
+    Cached snapshots of all pages are invalidated."""
+    _invalidate()
+    _send(state, topic)
+
+
+def send_to_session(session_key: str, state: Dict[str, Any]) -> None:
+    """Sends the given dictionary to the clients of the given session only."""
+    data = {"type": "state_update", "text": serialize(state)}
     channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)("state", data)
+    async_to_sync(channel_layer.group_send)(_session_group(session_key), data)
+
+
+# the function that builds the state of every page, as given with its latest update
+_builders: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def _broadcast_pending(page: str) -> None:
+    # The marker is removed before the state is built,
+    # so every update requested afterwards schedules a new broadcast.
+    redis.redis_connection.delete(f"{PENDING_PREFIX}{page}")
+    redis.incr("broadcasts_sent")
+    try:
+        # the version was already incremented when the update was requested
+        _send(_builders[page](), page)
+    finally:
+        connection.close()
+
+
+def broadcast(
+    page: str, build: Callable[[], Dict[str, Any]], immediate: bool = False
+) -> None:
+    """Sends the state returned by :param build: to the clients of the given page.
+    All updates of a page that are requested within the broadcast window
+    are combined into a single broadcast at the end of the window.
+    If :param immediate: is set, the state is sent without delay."""
+    # polls are answered with the new state right away
+    _invalidate()
+    _builders[page] = build
+    window = storage.get("broadcast_window")
+    if immediate or window <= 0:
+        redis.incr("broadcasts_sent")
+        _send(build(), page)
+        return
+    # The marker expires by itself in case the scheduling process dies.
+    # If it expires too early, the update is sent twice instead of being lost.
+    if not redis.redis_connection.set(
+        f"{PENDING_PREFIX}{page}", "", nx=True, px=window * 2
+    ):
+        # a broadcast is already scheduled and will contain this update
+        redis.incr("broadcasts_saved")
+        return
+    # a pending broadcast must not keep the process alive
+    timer = threading.Timer(window / 1000, _broadcast_pending, args=(page,))
+    timer.daemon = True
+    timer.start()
+
+
+def _leaves(
+    values: Dict[str, Any], path: Tuple[str, ...] = ()
+) -> Iterator[Tuple[Tuple[str, ...], Any]]:
+    # yields the path and the value of every entry that is not a dictionary itself
+    for key, value in values.items():
+        if isinstance(value, dict):
+            yield from _leaves(value, path + (key,))
+        else:
+            yield path + (key,), value
 
 
-def get_state(_request: WSGIRequest, module) -> JsonResponse:
+def _marker(path: Tuple[str, ...]) -> str:
+    return VOLATILE_MARKER + ".".join(path)
+
+
+def _fill(data: str, volatile: Dict[str, Any]) -> str:
+    # the markers are replaced in the serialized state, it does not need to be parsed
+    for path, value in _leaves(volatile):
+        data = data.replace(serialize(_marker(path)), serialize(value), 1)
+    return data
+
+
+def _build(module: ModuleType) -> Tuple[str, Dict[str, Any]]:
+    # Returns the serialized state of the module with markers instead of volatile values
+    # and the values that the volatile state is derived from.
     state = module.state_dict()
-    return JsonResponse(state)
+    build_volatile = getattr(module, "build_volatile", None)
+    built = {} if build_volatile is None else build_volatile(state)
+    for path, _ in _leaves(module.volatile_state(built, 0)):
+        parent = state
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = _marker(path)
+    return serialize(state), built
+
+
+def snapshot(module: ModuleType) -> str:
+    """Returns the serialized state of the given page module.
+    The state is only built once for every version and then served from redis.
+    Values that change without an update being sent, e.g. the number of users,
+    are returned by the volatile_state function of the module and filled in every time.
+    If the module defines build_volatile, its result is stored with the snapshot
+    and passed to volatile_state with the time that passed since the build."""
+    key = f"{SNAPSHOT_PREFIX}{module.__name__}"
+    version, *cached = _load_snapshot(keys=[VERSION_KEY, key])
+    if not cached:
+        data, built = _build(module)
+        # If the state changed while it was built, it might be outdated.
+        # It is still served for this request, but not stored for the following ones.
+        _store_snapshot(
+            keys=[VERSION_KEY, key],
+            args=[version, time.time(), data, serialize(built)],
+        )
+        return _fill(data, module.volatile_state(built, 0))
+    built_at, data, built = cached
+    elapsed = time.time() - float(built_at)
+    return _fill(data, module.volatile_state(json.loads(built), elapsed))
+
+
+def get_state(_request: WSGIRequest, module) -> HttpResponse:
+    return HttpResponse(snapshot(module), content_type="application/json")
+
+
+class StateConsumer(AsyncWebsocketConsumer):
+    """Handles connections with websocket clients.
+    Clients connect to the url of their page and receive the state updates of that page.
+    Clients that do not specify a page receive every update.
+    Messages for a single session, e.g. the result of a request, are sent to all its clients.
+    States arrive already serialized and are forwarded without blocking a thread per client."""
 
+    def _groups(self) -> List[str]:
+        groups = [_group(topic) for topic in self._topics()]
+        session = self.scope.get("session")
+        if session is not None and session.session_key:
+            groups.append(_session_group(session.session_key))
+        return groups
 
-class StateConsumer(WebsocketConsumer):
-    """Handles connections with websocket clients."""
+    def _topics(self) -> List[str]:
+        page = self.scope["url_route"]["kwargs"].get("page")
+        if page is None:
+            return list(TOPICS)
+        if page in TOPICS and page != "base":
+            return ["base", page]
+        return ["base"]
 
-    def connect(self) -> None:
-        async_to_sync(self.channel_layer.group_add)("state", self.channel_name)
-        self.accept()
+    async def connect(self) -> None:
+        for group in self._groups():
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept()
 
-    def disconnect(self, code: int) -> None:
-        async_to_sync(self.channel_layer.group_discard)("state", self.channel_name)
+    async def disconnect(self, code: int) -> None:
+        for group in self._groups():
+            await self.channel_layer.group_discard(group, self.channel_name)
 
-    def receive(self, text_data: str = None, bytes_data: bytes = None) -> None:
+    async def receive(self, text_data: str = None, bytes_data: bytes = None) -> None:
         pass
 
-    def state_update(self, event: Dict[str, Any]):
+    async def state_update(self, event: Dict[str, Any]) -> None:
         """Receives a message from the room group and sends it back to the websocket."""
-        self.send(text_data=json.dumps(event["state"]))
+        await self.send(text_data=event["text"])
@@ -166,7 +166,13 @@ BROKER_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}"
 CELERY_IMPORTS = [
     "core.lights.worker",
     "core.musiq.playback",
+    "core.musiq.musiq",
+    "core.musiq.song_cache",
+    "core.musiq.loudness",
+    "core.musiq.youtube",
     "core.musiq.music_provider",
+    "core.musiq.song_queue",
+    "core.musiq.live_queue",
     "core.settings.library",
     "core.settings.sound",
 ]
@@ -2,6 +2,8 @@ import json
 
 from django.urls import reverse
 
+from core.musiq.localdrive import LocalSongProvider
+from core.musiq.song_provider import SongProvider
 from tests.music_test import MusicTest
 
 
@@ -109,3 +111,25 @@ class LocaldriveTests(MusicTest):
             and all(song["internalUrl"] for song in state["musiq"]["songQueue"]),
             timeout=3,
         )
+
+    def test_request_many(self):
+        urls = [
+            "local_library/ogg/file_example_OOG_1MG.ogg",
+            "local_library/ogg/file_example_OOG_2MG.ogg",
+            "local_library/mp3/file_example_MP3_1MG.mp3",
+        ]
+        providers = [SongProvider.create(external_url=url) for url in urls]
+        # songs without an id are searched by the task that enqueues the songs
+        providers.insert(1, LocalSongProvider("missing song", None))
+        SongProvider.request_many(providers, "", archive=False, manually_requested=False)
+        state = self._poll_musiq_state(
+            lambda state: state["musiq"]["currentSong"]
+            and len(state["musiq"]["songQueue"]) == 2
+            and all(song["internalUrl"] for song in state["musiq"]["songQueue"]),
+            timeout=3,
+        )
+        # the song that was not found is removed, the others keep their order
+        self.assertEqual(state["musiq"]["currentSong"]["externalUrl"], urls[0])
+        self.assertEqual(
+            [song["externalUrl"] for song in state["musiq"]["songQueue"]], urls[1:]
+        )
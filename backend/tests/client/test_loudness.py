@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import mutagen
+from django.conf import settings as conf
+from django.test import TransactionTestCase
+
+from core import redis
+from core.models import ArchivedSong
+from core.musiq import loudness
+
+EXTERNAL_URL = "https://www.youtube.com/watch?v=loudness"
+
+
+def _fake_rganalysis(path):
+    # tags the file like rganalysis would
+    loudness._write_gain(path, -4.5)
+    return True
+
+
+class LoudnessTests(TransactionTestCase):
+    def setUp(self):
+        redis.start()
+        self.directory = tempfile.TemporaryDirectory(dir=conf.SONGS_CACHE_DIR)
+        self.path = os.path.join(self.directory.name, "song.m4a")
+        shutil.copyfile(
+            os.path.join(conf.BASE_DIR, "resources/sounds/alarm.m4a"), self.path
+        )
+        # the alarm is already tagged, start with a song that was not analyzed yet
+        mutagen.File(self.path).delete()
+        ArchivedSong.objects.create(
+            url=EXTERNAL_URL,
+            artist="test",
+            title="test",
+            duration=1,
+            counter=0,
+            cached=True,
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _stored_gain(self):
+        return ArchivedSong.objects.get(url=EXTERNAL_URL).gain
+
+    def test_read_gain(self):
+        self.assertIsNone(loudness.read_gain(self.path))
+        loudness._write_gain(self.path, -3.25)
+        self.assertEqual(loudness.read_gain(self.path), -3.25)
+
+        # files that can not be parsed have no gain
+        with open(self.path, "w") as f:
+            f.write("no audio")
+        self.assertIsNone(loudness.read_gain(self.path))
+
+    def test_compute_gain(self):
+        with mock.patch.object(loudness, "_run_rganalysis", _fake_rganalysis):
+            self.assertEqual(loudness._compute_gain(self.path), -4.5)
+        # the tagged copy replaced the file
+        self.assertEqual(loudness.read_gain(self.path), -4.5)
+
+    def test_compute_gain_without_rganalysis(self):
+        with mock.patch.object(loudness, "_run_rganalysis", return_value=False):
+            self.assertIsNone(loudness._compute_gain(self.path))
+        self.assertIsNone(loudness.read_gain(self.path))
+
+    def test_retry(self):
+        with mock.patch.object(
+            loudness, "_run_rganalysis", _fake_rganalysis
+        ), mock.patch.object(loudness.analyze, "apply_async") as apply_async:
+            # while another song is analyzed, the analysis is scheduled again
+            loudness.analysis_lock.acquire()
+            try:
+                loudness.analyze(EXTERNAL_URL, self.path)
+            finally:
+                loudness.analysis_lock.release()
+            apply_async.assert_called_once_with(
+                (EXTERNAL_URL, self.path), countdown=loudness.RETRY_DELAY
+            )
+            self.assertIsNone(self._stored_gain())
+
+            loudness.analyze(EXTERNAL_URL, self.path)
+            apply_async.assert_called_once()
+        self.assertEqual(self._stored_gain(), -4.5)
+
+    def test_stored_gain(self):
+        ArchivedSong.objects.filter(url=EXTERNAL_URL).update(gain=-2.0)
+        # a song that was downloaded again is tagged without analyzing it
+        with mock.patch.object(loudness, "_run_rganalysis") as run_rganalysis:
+            loudness.analyze(EXTERNAL_URL, self.path)
+        run_rganalysis.assert_not_called()
+        self.assertEqual(loudness.read_gain(self.path), -2.0)
@@ -0,0 +1,217 @@
+import time
+from threading import Thread
+from unittest import mock
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from core import redis
+from core.management.fake_mopidy import FakeMopidy
+from core.musiq import live_queue, mopidy_gateway, playback, prefetch
+from core.musiq.mopidy_gateway import Gateway
+from core.settings import storage
+from tests import util
+
+
+class GatewayTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mopidy = FakeMopidy()
+        cls.mopidy.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mopidy.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.mopidy.reset()
+        self.gateway = Gateway("localhost", self.mopidy.port)
+        self.gateway.start()
+
+    def tearDown(self):
+        self.gateway.stop()
+
+    def _poll_volume(self, volume, timeout=2):
+        deadline = time.time() + timeout
+        while self.gateway.call("core.mixer.get_volume") != volume:
+            if time.time() > deadline:
+                self.fail(f"volume was not set to {volume}")
+            time.sleep(0.1)
+
+    def test_call(self):
+        self.assertTrue(self.gateway.call("core.mixer.set_volume", volume=42))
+        self.assertEqual(self.gateway.call("core.mixer.get_volume"), 42)
+
+    def test_batch(self):
+        # all calls of a batch are sent to mopidy with a single request
+        results = self.gateway.call_batch(
+            [
+                ("core.tracklist.clear", {}),
+                ("core.tracklist.add", {"uris": ["fake:0", "fake:1"]}),
+                ("core.mixer.set_volume", {"volume": 25}),
+                ("core.mixer.get_volume", {}),
+            ]
+        )
+        self.assertEqual(len(results[1]), 2)
+        self.assertEqual(results[3], 25)
+        self.assertEqual(self.mopidy.http_requests, 1)
+        self.assertEqual(self.mopidy.rpc_requests, 4)
+
+    def test_send(self):
+        # commands of other processes are read from the stream and executed
+        mopidy_gateway.send("core.mixer.set_volume", volume=17)
+        self._poll_volume(17)
+        self.assertEqual(redis.redis_connection.xlen(mopidy_gateway.COMMAND_STREAM), 0)
+
+    def test_stale_commands(self):
+        self.gateway.call("core.mixer.set_volume", volume=30)
+        self.gateway.stop()
+
+        # a command that is sent while no gateway is running is not executed later
+        mopidy_gateway.send("core.mixer.set_volume", volume=80)
+        self.gateway = Gateway("localhost", self.mopidy.port)
+        self.gateway.start()
+        time.sleep(2 * mopidy_gateway.STREAM_TIMEOUT)
+        self.assertEqual(self.gateway.call("core.mixer.get_volume"), 30)
+
+        # commands sent afterwards are still executed
+        mopidy_gateway.send("core.mixer.set_volume", volume=60)
+        self._poll_volume(60)
+
+    def test_latencies(self):
+        self.gateway.call("core.mixer.get_volume")
+        self.gateway.stop()
+        self.assertIn("core.mixer.get_volume", redis.get("mopidy_latency"))
+        self.gateway = Gateway("localhost", self.mopidy.port)
+        self.gateway.start()
+
+
+class PrefetchTests(TransactionTestCase):
+    def setUp(self):
+        redis.start()
+
+    def test_limit(self):
+        storage.set("download_concurrency", 0)
+        storage.set("prefetch_songs", 2)
+        prefetcher = prefetch.Prefetcher()
+        songs = [{"id": key, "external_url": f"fake:{key}"} for key in range(5)]
+        fetched = []
+
+        def upcoming():
+            # a single pass over the queue
+            prefetcher.stopped = True
+            prefetcher.wakeup.set()
+            return songs
+
+        missing = mock.patch.object(prefetch, "_missing", return_value=True)
+        with missing, mock.patch.object(
+            prefetcher, "_upcoming", side_effect=upcoming
+        ), mock.patch.object(prefetcher, "_fetch", side_effect=fetched.append):
+            prefetcher._run()
+            deadline = time.time() + 2
+            while len(fetched) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+        # without a limit on downloads, no more songs are fetched than prefetched
+        self.assertCountEqual(fetched, songs[:2])
+
+
+@override_settings(TESTING=False)
+class PlaybackTests(TransactionTestCase):
+    songs = 4
+    duration = 0.5
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mopidy = FakeMopidy(track_duration=cls.duration)
+        cls.mopidy.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mopidy.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        redis.start()
+        self.mopidy.reset()
+        # outside of tests, the playback receives mopidy's events through its own websocket
+        self.mopidy_settings = override_settings(
+            MOPIDY_HOST="localhost", MOPIDY_PORT=self.mopidy.port
+        )
+        self.mopidy_settings.enable()
+
+    def tearDown(self):
+        self.mopidy_settings.disable()
+
+    def _play(self):
+        # plays all songs and returns the gaps between them
+        redis.set("stop_playback_loop", False)
+        player = playback.Playback()
+        util.enqueue_songs(
+            [f"fake:{position}" for position in range(self.songs)],
+            duration=self.duration,
+        )
+        playback.queue_changed.set()
+        loop = Thread(target=player.loop)
+        loop.start()
+
+        deadline = time.time() + self.songs * (self.duration + 2) + 10
+        while self.mopidy.finished < self.songs and time.time() < deadline:
+            time.sleep(0.1)
+        playback.stop()
+        loop.join(timeout=10)
+        self.assertEqual(self.mopidy.finished, self.songs)
+        self.assertEqual(len(self.mopidy.gaps), self.songs - 1)
+        return self.mopidy.gaps
+
+    def _poll_lookahead(self, player, key, timeout=5):
+        deadline = time.time() + timeout
+        while (player.lookahead or (None,))[0] != key:
+            if time.time() > deadline:
+                self.fail(f"song {key} was not added ahead")
+            time.sleep(0.1)
+
+    def test_song_end(self):
+        storage.set("gapless_playback", False)
+        # the next song is started as soon as mopidy reports the end of the current one,
+        # without waiting for the next check of mopidy's state
+        gaps = self._play()
+        self.assertLess(max(gaps), playback.LIVENESS_INTERVAL / 4)
+
+    def test_gapless(self):
+        storage.set("gapless_playback", True)
+        # the next song is already in mopidy's tracklist and starts without any request
+        gaps = self._play()
+        self.assertLess(max(gaps), 0.01)
+
+    def test_vote(self):
+        storage.set("gapless_playback", True)
+        storage.set("voting_enabled", True)
+        redis.set("stop_playback_loop", False)
+        # the first song plays until the end of the test, mopidy is only polled after an event
+        self.mopidy.track_duration = 60
+        with mock.patch.object(playback, "LIVENESS_INTERVAL", 60):
+            player = playback.Playback()
+            songs = util.enqueue_songs(
+                [f"fake:{position}" for position in range(3)], duration=60
+            )
+            playback.queue_changed.set()
+            loop = Thread(target=player.loop)
+            loop.start()
+            try:
+                self._poll_lookahead(player, songs[1].id)
+                # wait for the events of the started song to be handled
+                time.sleep(0.5)
+                self.mopidy.reset()
+
+                # a vote changes the song that is added ahead without checking mopidy's state
+                live_queue.vote(songs[2].id, 1, -2)
+                self._poll_lookahead(player, songs[2].id)
+                self.assertEqual(self.mopidy.calls["core.playback.get_state"], 0)
+                self.assertEqual(self.mopidy.calls["core.playback.get_current_tlid"], 0)
+            finally:
+                playback.stop()
+                loop.join(timeout=10)
+                self.mopidy.track_duration = self.duration
+                storage.set("voting_enabled", False)
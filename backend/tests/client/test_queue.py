@@ -1,8 +1,15 @@
 import json
 import logging
+from unittest import mock
 
+from django.test import TransactionTestCase
 from django.urls import reverse
 
+from core import redis
+from core.models import QueuedSong
+from core.musiq import live_queue
+from core.musiq.localdrive import LocalSongProvider
+from core.musiq.music_provider import ProviderError
 from core.settings import storage
 from tests import util
 from tests.music_test import MusicTest
@@ -39,6 +46,80 @@ class QueueTests(MusicTest):
         )
         self._poll_musiq_state(lambda state: len(state["musiq"]["songQueue"]) == 5)
 
+    def test_add_in_background(self):
+        suggestion = json.loads(
+            self.client.get(reverse("random-suggestion"), {"playlist": "false"}).content
+        )
+        response = self.client.post(
+            reverse("request-music"),
+            {
+                "key": suggestion["key"],
+                "query": "",
+                "playlist": "false",
+                "platform": "local",
+                "background": "true",
+            },
+        )
+        # the placeholder is queued right away, the song is resolved afterwards
+        self.assertEqual(json.loads(response.content)["message"], "resolving")
+        self._poll_musiq_state(
+            lambda state: len(state["musiq"]["songQueue"]) == 4
+            and all(song["internalUrl"] for song in state["musiq"]["songQueue"])
+        )
+
+    def test_add_playlist_in_background(self):
+        suggestion = json.loads(
+            self.client.get(
+                reverse("offline-suggestions"), {"term": "ogg", "playlist": "true"}
+            ).content
+        )[0]
+        response = self.client.post(
+            reverse("request-music"),
+            {
+                "key": suggestion["key"],
+                "query": "",
+                "playlist": "true",
+                "platform": "local",
+                "background": "true",
+            },
+        )
+        # playlists have no placeholder, there is no song to vote for
+        self.assertNotIn("key", json.loads(response.content))
+        self._poll_musiq_state(lambda state: len(state["musiq"]["songQueue"]) == 5)
+
+    def test_add_rejected(self):
+        storage.set("max_queue_length", 3)
+        suggestion = json.loads(
+            self.client.get(reverse("random-suggestion"), {"playlist": "false"}).content
+        )
+        request = {
+            "key": suggestion["key"],
+            "query": "",
+            "playlist": "false",
+            "platform": "local",
+        }
+        # requests that are not resolved in the background report their errors directly
+        response = self.client.post(reverse("request-music"), request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Queue limit reached")
+        response = self.client.post(
+            reverse("request-music"), {**request, "background": "true"}
+        )
+        self.assertEqual(response.status_code, 400)
+        storage.set("max_queue_length", 0)
+
+    def test_add_unknown_platform(self):
+        storage.set("youtube_enabled", False)
+        response = self.client.post(
+            reverse("request-music"),
+            {"key": "", "query": "test", "playlist": "false", "platform": "unknown"},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.content, b"No backend configured to handle your request."
+        )
+        storage.set("youtube_enabled", True)
+
     def test_remove(self):
         state = json.loads(self.client.get(reverse("musiq-state")).content)
         key = state["musiq"]["songQueue"][1]["id"]
@@ -121,6 +202,48 @@ class QueueTests(MusicTest):
             == [key2, key1, key3]
         )
 
+    def test_dense_indices(self):
+        state = json.loads(self.client.get(reverse("musiq-state")).content)
+        key1 = state["musiq"]["songQueue"][0]["id"]
+        key3 = state["musiq"]["songQueue"][2]["id"]
+
+        # internally, songs are spread out in the queue.
+        # Clients always see consecutive indices, starting from 1
+        self.client.post(reverse("prioritize"), {"key": str(key3)})
+        self.client.post(reverse("remove"), {"key": str(key1)})
+        state = self._poll_musiq_state(
+            lambda state: len(state["musiq"]["songQueue"]) == 2
+            and state["musiq"]["songQueue"][0]["id"] == key3
+        )
+        self.assertEqual(
+            [song["index"] for song in state["musiq"]["songQueue"]], [1, 2]
+        )
+
+    def test_shuffle_tail(self):
+        state = json.loads(self.client.get(reverse("musiq-state")).content)
+        keys = [song["id"] for song in state["musiq"]["songQueue"]]
+
+        # the first song keeps its position, the others are only permuted
+        self.client.post(reverse("shuffle-all"), {"start": "1"})
+        state = self._poll_musiq_state(
+            lambda state: len(state["musiq"]["songQueue"]) == len(keys)
+        )
+        shuffled = [song["id"] for song in state["musiq"]["songQueue"]]
+        self.assertEqual(shuffled[0], keys[0])
+        self.assertCountEqual(shuffled, keys)
+
+    def test_state_snapshot(self):
+        state = json.loads(self.client.get(reverse("musiq-state")).content)
+        self.assertEqual(
+            state, json.loads(self.client.get(reverse("musiq-state")).content)
+        )
+
+        # a cached state is not served after the queue changed
+        key = state["musiq"]["songQueue"][0]["id"]
+        self.client.post(reverse("remove"), {"key": str(key)})
+        state = json.loads(self.client.get(reverse("musiq-state")).content)
+        self.assertNotIn(key, [song["id"] for song in state["musiq"]["songQueue"]])
+
     def test_remove_all(self):
         self.client.post(reverse("remove-all"))
         self._poll_musiq_state(lambda state: len(state["musiq"]["songQueue"]) == 0)
@@ -189,3 +312,144 @@ class QueueVotingTests(MusicTest):
         for _ in range(3):
             self.client.post(reverse("vote"), {"key": str(key), "amount": -1})
         self._poll_musiq_state(lambda state: len(state["musiq"]["songQueue"]) == 2)
+
+
+class LiveQueueTests(TransactionTestCase):
+    def setUp(self):
+        redis.start()
+        # changes are only written to the database when the tests persist them
+        self.persist = mock.patch.object(live_queue._persist, "delay")
+        self.persist.start()
+        songs = util.enqueue_songs([f"local:{position}" for position in range(3)])
+        self.keys = [song.id for song in songs]
+
+    def tearDown(self):
+        self.persist.stop()
+
+    def _ids(self, ranked=False):
+        return [song["id"] for song in live_queue.songs(ranked=ranked, fields=("id",))]
+
+    def test_vote(self):
+        key1, key2, key3 = self.keys
+        live_queue.vote(key2, 1, -2)
+        live_queue.vote(key3, 2, -2)
+        # votes only change the ranked order
+        self.assertEqual(self._ids(ranked=True), [key3, key2, key1])
+        self.assertEqual(self._ids(), [key1, key2, key3])
+        self.assertEqual(live_queue.first(ranked=True), key3)
+
+        # songs with equal votes keep their order
+        live_queue.vote(key1, 2, -2)
+        self.assertEqual(self._ids(ranked=True), [key1, key3, key2])
+
+        # a song that reaches the threshold is removed
+        votes, removed = live_queue.vote(key2, -3, -2)
+        self.assertEqual(votes, -2)
+        self.assertEqual(removed["id"], key2)
+        self.assertFalse(live_queue.contains(key2))
+        self.assertEqual(self._ids(ranked=True), [key1, key3])
+
+    def test_persist(self):
+        key1, key2, _ = self.keys
+        live_queue.vote(key1, -2, -2)
+        live_queue.vote(key2, 1, -2)
+        self.assertEqual(
+            redis.redis_connection.smembers(live_queue.DIRTY_KEY),
+            {str(key1), str(key2)},
+        )
+
+        # the database is only updated when the changes are persisted
+        self.assertTrue(QueuedSong.objects.filter(id=key1).exists())
+        self.assertEqual(QueuedSong.objects.get(id=key2).votes, 0)
+        live_queue.persist()
+        self.assertFalse(QueuedSong.objects.filter(id=key1).exists())
+        self.assertEqual(QueuedSong.objects.get(id=key2).votes, 1)
+        self.assertEqual(redis.redis_connection.scard(live_queue.DIRTY_KEY), 0)
+
+    def test_remove(self):
+        key = self.keys[1]
+        removed = QueuedSong.objects.remove(key)
+        self.assertEqual(removed["id"], key)
+        self.assertEqual(removed["title"], "1")
+        # the row is only deleted by the next persistence
+        self.assertTrue(QueuedSong.objects.filter(id=key).exists())
+        live_queue.persist()
+        self.assertFalse(QueuedSong.objects.filter(id=key).exists())
+
+    def test_removed_placeholder(self):
+        key = self.keys[0]
+        provider = LocalSongProvider(None, None)
+        provider.queued_song = QueuedSong.objects.get(id=key)
+        live_queue.vote(key, -2, -2)
+        live_queue.persist()
+
+        # the row of a removed placeholder is not written, even if it was queued before
+        metadata = {
+            "artist": "test",
+            "title": "found",
+            "duration": 1,
+            "internal_url": "local:found",
+            "external_url": "local:found",
+            "stream_url": None,
+        }
+        with mock.patch.object(
+            live_queue, "contains", return_value=True
+        ), mock.patch.object(provider, "get_metadata", return_value=metadata):
+            self.assertFalse(provider.confirm())
+        with self.assertRaises(ProviderError):
+            provider.enqueue_placeholder(True)
+        self.assertFalse(QueuedSong.objects.filter(id=key).exists())
+
+    def test_restore(self):
+        key1, key2, key3 = self.keys
+        live_queue.vote(key1, 1, -2)
+        live_queue.prioritize(key3)
+        live_queue.persist()
+        songs = live_queue.songs()
+        ranked = live_queue.songs(ranked=True)
+
+        # a restart flushes redis, the queue is rebuilt from the database
+        redis.start()
+        self.assertEqual(live_queue.count(), 0)
+        live_queue.restore()
+        self.assertEqual(live_queue.songs(), songs)
+        self.assertEqual(live_queue.songs(ranked=True), ranked)
+        self.assertEqual(self._ids(), [key3, key1, key2])
+        self.assertEqual(live_queue.first(ranked=True), key1)
+
+    def test_shuffle(self):
+        key3 = self.keys[2]
+        redis.redis_connection.hset(
+            live_queue.SONG_PREFIX + str(key3), "manually_requested", "1"
+        )
+        indices = {song["id"]: song["index"] for song in live_queue.songs()}
+        live_queue.vote(key3, 1, -2)
+
+        # the first song and the manually requested song keep their index
+        live_queue.shuffle(start=1, autoplay_only=True)
+        shuffled = {song["id"]: song["index"] for song in live_queue.songs()}
+        self.assertEqual(shuffled, indices)
+        self.assertEqual(live_queue.first(ranked=True), key3)
+
+        # only the indices of the shuffled songs are permuted, votes are kept
+        live_queue.shuffle()
+        shuffled = {song["id"]: song["index"] for song in live_queue.songs()}
+        self.assertCountEqual(shuffled.values(), indices.values())
+        self.assertEqual(self._ids(), sorted(shuffled, key=shuffled.get))
+        self.assertEqual(live_queue.first(ranked=True), key3)
+
+    def test_shuffle_ranked(self):
+        key1, key2, key3 = self.keys
+        live_queue.vote(key3, 1, -2)
+        index = live_queue.get(key3, ("index",))["index"]
+        indices = {song["id"]: song["index"] for song in live_queue.songs()}
+
+        # the first song in the order by votes keeps its position
+        for _ in range(10):
+            live_queue.shuffle(start=1, ranked=True)
+            self.assertEqual(live_queue.get(key3, ("index",))["index"], index)
+            self.assertEqual(self._ids(ranked=True)[0], key3)
+        shuffled = {song["id"]: song["index"] for song in live_queue.songs()}
+        self.assertCountEqual(
+            [shuffled[key1], shuffled[key2]], [indices[key1], indices[key2]]
+        )
@@ -0,0 +1,68 @@
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from core.musiq import musiq
+from core.musiq.music_provider import ProviderError
+
+
+class RacingTests(SimpleTestCase):
+    def _provider(self, platform, delay, available=True):
+        provider = mock.Mock()
+        provider.type = platform
+        provider.error = f"{platform} error"
+
+        def resolve(cancelled):
+            time.sleep(delay)
+            if not available:
+                raise ProviderError(provider.error)
+            return True
+
+        provider.resolve.side_effect = resolve
+        return provider
+
+    def _race(self, providers):
+        return musiq._race(providers, "", archive=False, manually_requested=True)
+
+    def test_order(self):
+        # the first provider in the given order wins, even if another one was faster
+        first = self._provider("spotify", 0.3)
+        second = self._provider("youtube", 0)
+        self.assertIs(self._race([first, second]), first)
+        first.submit.assert_called_once()
+        second.submit.assert_not_called()
+
+    def test_fallback(self):
+        failing = self._provider("spotify", 0, available=False)
+        second = self._provider("youtube", 0.1)
+        self.assertIs(self._race([failing, second]), second)
+        failing.submit.assert_not_called()
+
+    def test_all_fail(self):
+        first = self._provider("spotify", 0, available=False)
+        second = self._provider("youtube", 0, available=False)
+        with self.assertRaisesRegex(ProviderError, "youtube error"):
+            self._race([first, second])
+
+    def test_timeout(self):
+        # every provider has its own deadline
+        slow = self._provider("spotify", 1)
+        fast = self._provider("youtube", 0.1)
+        with mock.patch.dict(musiq.RACE_TIMEOUTS, {"spotify": 0.2, "youtube": 5}):
+            start = time.time()
+            self.assertIs(self._race([slow, fast]), fast)
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(slow.error, "Search timed out")
+        slow.submit.assert_not_called()
+
+    def test_cancel(self):
+        winner = self._provider("local", 0)
+        loser = self._provider("youtube", 0.2)
+        self.assertIs(self._race([winner, loser]), winner)
+        # the remaining providers are told to stop before they search online
+        deadline = time.time() + 1
+        while not loser.resolve.called and time.time() < deadline:
+            time.sleep(0.05)
+        (cancelled,), _ = loser.resolve.call_args
+        self.assertTrue(cancelled.is_set())
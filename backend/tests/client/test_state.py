@@ -0,0 +1,107 @@
+import json
+import time
+import types
+from unittest import mock
+
+from django.test import TransactionTestCase
+
+from core import redis, state_handler
+from core.musiq import musiq
+from core.settings import storage
+
+
+class StateSnapshotTests(TransactionTestCase):
+    def setUp(self):
+        redis.start()
+        self.page = types.ModuleType("tests.page")
+        self.page.state_dict = mock.Mock(return_value={"value": 1})
+        self.page.volatile_state = lambda built, elapsed: {}
+
+    def _version(self):
+        return int(redis.redis_connection.get(state_handler.VERSION_KEY) or 0)
+
+    def test_build_once(self):
+        for _ in range(3):
+            self.assertEqual(json.loads(state_handler.snapshot(self.page)), {"value": 1})
+        self.page.state_dict.assert_called_once()
+
+        # a change of the state builds it again
+        state_handler.send_state({}, "base")
+        self.page.state_dict.return_value = {"value": 2}
+        self.assertEqual(json.loads(state_handler.snapshot(self.page)), {"value": 2})
+        self.assertEqual(self.page.state_dict.call_count, 2)
+
+    def test_changed_during_build(self):
+        def build():
+            if self.page.state_dict.call_count == 1:
+                state_handler.send_state({}, "base")
+            return {"value": self.page.state_dict.call_count}
+
+        self.page.state_dict.side_effect = build
+        # the state that was built before the change is served, but not stored
+        self.assertEqual(json.loads(state_handler.snapshot(self.page)), {"value": 1})
+        key = state_handler.SNAPSHOT_PREFIX + self.page.__name__
+        self.assertFalse(redis.redis_connection.exists(key))
+        self.assertEqual(json.loads(state_handler.snapshot(self.page)), {"value": 2})
+        self.assertEqual(json.loads(state_handler.snapshot(self.page)), {"value": 2})
+        self.assertEqual(self.page.state_dict.call_count, 2)
+
+    def test_version(self):
+        # every change increments the version once
+        version = self._version()
+        state_handler.broadcast("lights", dict, immediate=True)
+        self.assertEqual(self._version(), version + 1)
+
+        storage.set("broadcast_window", 100)
+        sent = redis.get("broadcasts_sent")
+        state_handler.broadcast("lights", dict)
+        deadline = time.time() + 2
+        while redis.get("broadcasts_sent") == sent and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(redis.get("broadcasts_sent"), sent + 1)
+        self.assertEqual(self._version(), version + 2)
+
+    def test_volatile(self):
+        users = [1]
+        self.page.state_dict.return_value = {"value": 1, "page": {"users": 1}}
+        self.page.volatile_state = lambda built, elapsed: {"page": {"users": users[0]}}
+        self.assertEqual(
+            json.loads(state_handler.snapshot(self.page)),
+            {"value": 1, "page": {"users": 1}},
+        )
+
+        # volatile values are up to date without building the state again
+        users[0] = 5
+        self.assertEqual(
+            json.loads(state_handler.snapshot(self.page)),
+            {"value": 1, "page": {"users": 5}},
+        )
+        self.page.state_dict.assert_called_once()
+
+    def test_advance_progress(self):
+        state = {
+            "musiq": {
+                "currentSong": {"queueKey": 1, "duration": 100},
+                "paused": False,
+                "progress": 10,
+            }
+        }
+        built = musiq.build_volatile(state)
+        with mock.patch.object(musiq.base, "volatile_state", return_value={}):
+            self.assertEqual(musiq.volatile_state(built, 5)["musiq"]["progress"], 15)
+
+            # the progress of a paused song does not change
+            state["musiq"]["paused"] = True
+            built = musiq.build_volatile(state)
+            self.assertEqual(musiq.volatile_state(built, 5)["musiq"]["progress"], 10)
+
+    def test_latest_build(self):
+        storage.set("broadcast_window", 100)
+        with mock.patch.object(state_handler, "_send") as send:
+            state_handler.broadcast("lights", lambda: {"value": 1})
+            state_handler.broadcast("lights", lambda: {"value": 2})
+            deadline = time.time() + 2
+            while not send.called and time.time() < deadline:
+                time.sleep(0.05)
+        # the combined broadcast sends the state of the latest update
+        send.assert_called_once_with({"value": 2}, "lights")
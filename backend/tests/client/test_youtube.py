@@ -1,11 +1,24 @@
 import os
+import pathlib
+import pickle
+import queue
+import tempfile
+import time
+from contextlib import ExitStack
+from unittest import mock
 
+import requests
 import yt_dlp
 from django.conf import settings
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 
-from core.musiq.youtube import Youtube
+from core import redis
+from core.models import ArchivedQuery, ArchivedSong, PlayLog, QueuedSong
+from core.musiq import downloads, live_queue, musiq, song_cache, youtube
+from core.musiq.youtube import Youtube, YoutubeSongProvider
 from core.settings import storage
+from tests import util
 from tests.music_test import MusicTest
 
 
@@ -195,3 +208,349 @@ class YoutubeTests(MusicTest):
             and all(song["internalUrl"] for song in state["musiq"]["songQueue"]),
             timeout=60,
         )
+
+
+class YoutubeInfoCacheTests(TestCase):
+    video_id = "nofilesize0"
+
+    def tearDown(self):
+        try:
+            os.remove(youtube._info_path(self.video_id))
+        except FileNotFoundError:
+            pass
+
+    def test_cached_info_without_filesize(self):
+        # yt-dlp does not know the size of every format, e.g. of livestreams
+        youtube.store_info(
+            {
+                "id": self.video_id,
+                "title": "No Filesize",
+                "filesize": None,
+                "url": "https://example.com/audio.m4a",
+            }
+        )
+        storage.set("max_download_size", 1)
+        provider = YoutubeSongProvider(
+            f"https://www.youtube.com/watch?v={self.video_id}", None
+        )
+        self.assertTrue(provider.check_available())
+
+    def test_old_entries_removed(self):
+        old_path = youtube._info_path("oldentry000")
+        pathlib.Path(youtube.INFO_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        pathlib.Path(old_path).touch()
+        two_days_ago = time.time() - 2 * 24 * 60 * 60
+        os.utime(old_path, (two_days_ago, two_days_ago))
+        info = {"id": self.video_id, "url": "https://example.com/audio.m4a"}
+
+        # old entries are not looked for on every store
+        redis.redis_connection.set(youtube.INFO_CLEANUP_KEY, 1)
+        youtube.store_info(info)
+        self.assertTrue(os.path.exists(old_path))
+
+        redis.redis_connection.delete(youtube.INFO_CLEANUP_KEY)
+        youtube.store_info(info)
+        self.assertFalse(os.path.exists(old_path))
+
+
+class YoutubeSessionTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.patches = [
+            mock.patch.object(
+                youtube, "_load_cookies", requests.cookies.RequestsCookieJar
+            ),
+            mock.patch.object(
+                youtube,
+                "COOKIES_FILE",
+                os.path.join(self.directory.name, "cookies.pickle"),
+            ),
+            mock.patch.object(youtube, "COOKIES_SAVE_DELAY", 0.2),
+            mock.patch.object(youtube, "_cookies", None),
+            mock.patch.object(youtube, "_idle_sessions", queue.LifoQueue()),
+            mock.patch.object(youtube.atexit, "register"),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        timer = youtube._cookies_save_timer
+        if timer is not None:
+            timer.cancel()
+        youtube._cookies_save_timer = None
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.directory.cleanup()
+
+    def test_pool(self):
+        with youtube.youtube_session() as session:
+            pass
+        # an idle session is reused
+        with youtube.youtube_session() as reused:
+            self.assertIs(reused, session)
+            with youtube.youtube_session() as other:
+                self.assertIsNot(other, session)
+
+        # only a limited number of idle sessions is kept
+        with ExitStack() as stack:
+            for _ in range(youtube.SESSION_POOL_SIZE + 1):
+                stack.enter_context(youtube.youtube_session())
+        self.assertEqual(youtube._idle_sessions.qsize(), youtube.SESSION_POOL_SIZE)
+
+    def test_shared_cookies(self):
+        with youtube.youtube_session() as first:
+            with youtube.youtube_session() as second:
+                first.cookies.set("consent", "yes", domain=".youtube.com")
+                # the cookies of a session in use are only shared when it is returned
+                self.assertIsNone(second.cookies.get("consent"))
+        with ExitStack() as stack:
+            sessions = [
+                stack.enter_context(youtube.youtube_session()) for _ in range(3)
+            ]
+            for session in sessions:
+                self.assertEqual(session.cookies.get("consent"), "yes")
+
+    def test_save_delay(self):
+        with youtube.youtube_session() as session:
+            session.cookies.set("consent", "yes", domain=".youtube.com")
+        # the cookies are not written right away
+        self.assertFalse(os.path.exists(youtube.COOKIES_FILE))
+        deadline = time.time() + 2
+        while not os.path.exists(youtube.COOKIES_FILE) and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.1)
+        with open(youtube.COOKIES_FILE, "rb") as f:
+            cookies = pickle.load(f)
+        self.assertEqual(cookies.get("consent"), "yes")
+
+
+class ArchivedQueryTests(TestCase):
+    def setUp(self):
+        self.song = ArchivedSong.objects.create(
+            url="https://www.youtube.com/watch?v=archived000",
+            artist="Artist",
+            title="Title",
+            duration=100,
+            counter=1,
+            cached=False,
+        )
+        ArchivedQuery.objects.create(song=self.song, query="Artist Title")
+
+    def test_hit(self):
+        # case and whitespace do not matter
+        self.assertEqual(
+            musiq._archived_song_key("  artist   TITLE", "youtube"), self.song.id
+        )
+
+    def test_miss(self):
+        self.assertIsNone(musiq._archived_song_key("Artist Other Title", "youtube"))
+        # only songs from the requested platform are used
+        self.assertIsNone(musiq._archived_song_key("Artist Title", "spotify"))
+        # urls are never looked up
+        self.assertIsNone(
+            musiq._archived_song_key(
+                "https://www.youtube.com/watch?v=archived000", "youtube"
+            )
+        )
+
+
+class SongCacheTests(TestCase):
+    def setUp(self):
+        redis.start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = override_settings(SONGS_CACHE_DIR=self.directory.name)
+        self.cache_dir.enable()
+        storage.set("max_cache_size", 1)
+
+    def tearDown(self):
+        storage.set("max_cache_size", 0)
+        self.cache_dir.disable()
+        self.directory.cleanup()
+
+    def _cache_song(self, video_id, age, counter=1):
+        # creates a downloaded song of 600 KB, two of them exceed the cache size
+        path = os.path.join(self.directory.name, video_id + ".m4a")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 600 * 1024)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        ArchivedSong.objects.create(
+            url="https://www.youtube.com/watch?v=" + video_id,
+            artist="Artist",
+            title=video_id,
+            duration=100,
+            counter=counter,
+            cached=True,
+        )
+        return path
+
+    def _cached(self, path):
+        video_id = os.path.splitext(os.path.basename(path))[0]
+        song = ArchivedSong.objects.get(
+            url="https://www.youtube.com/watch?v=" + video_id
+        )
+        self.assertEqual(song.cached, os.path.exists(path))
+        return song.cached
+
+    def test_least_recently_used(self):
+        old = self._cache_song("oldsong0000", 3 * 24 * 60 * 60)
+        new = self._cache_song("newsong0000", 2 * 24 * 60 * 60)
+        song_cache._evict()
+        self.assertFalse(self._cached(old))
+        self.assertTrue(self._cached(new))
+        self.assertEqual(redis.get("song_cache_size"), 600 * 1024)
+
+    def test_recently_played(self):
+        played = self._cache_song("played00000", 3 * 24 * 60 * 60)
+        other = self._cache_song("other000000", 2 * 24 * 60 * 60)
+        PlayLog.objects.create(
+            song=ArchivedSong.objects.get(title="played00000"),
+            manually_requested=True,
+        )
+        song_cache._evict()
+        self.assertTrue(self._cached(played))
+        self.assertFalse(self._cached(other))
+
+    def test_popular(self):
+        # a song that was played often outlives a slightly newer one
+        popular = self._cache_song("popular0000", 3 * 24 * 60 * 60, counter=100)
+        other = self._cache_song("other000000", 2 * 24 * 60 * 60)
+        song_cache._evict()
+        self.assertTrue(self._cached(popular))
+        self.assertFalse(self._cached(other))
+
+    def test_grace_period(self):
+        # recent downloads might be about to be enqueued
+        old = self._cache_song("oldsong0000", 3 * 24 * 60 * 60)
+        recent = self._cache_song("recent00000", 0)
+        song_cache._evict()
+        self.assertFalse(self._cached(old))
+        self.assertTrue(self._cached(recent))
+
+        other = self._cache_song("other000000", 0)
+        song_cache._evict()
+        self.assertTrue(self._cached(recent))
+        self.assertTrue(self._cached(other))
+
+    def test_protected(self):
+        queued = self._cache_song("queued00000", 3 * 24 * 60 * 60)
+        other = self._cache_song("other000000", 2 * 24 * 60 * 60)
+        util.enqueue_songs(["file://" + queued])
+        song_cache._evict()
+        self.assertTrue(self._cached(queued))
+        self.assertFalse(self._cached(other))
+
+    def test_protected_non_canonical(self):
+        relative = self._cache_song("relative000", 4 * 24 * 60 * 60)
+        dotted = self._cache_song("dotted00000", 3 * 24 * 60 * 60)
+        other = self._cache_song("other000000", 2 * 24 * 60 * 60)
+        # the urls of queued songs do not need to match the paths in the cache directory
+        urls = [
+            "file://" + os.path.basename(relative),
+            "file://"
+            + os.path.join(
+                self.directory.name,
+                "..",
+                os.path.basename(self.directory.name),
+                ".",
+                os.path.basename(dotted),
+            ),
+        ]
+        util.enqueue_songs(urls)
+        song_cache._evict()
+        self.assertTrue(self._cached(relative))
+        self.assertTrue(self._cached(dotted))
+        self.assertFalse(self._cached(other))
+
+
+class DownloadTests(TestCase):
+    def setUp(self):
+        redis.start()
+        self.downloads = 0
+
+    def tearDown(self):
+        storage.set("download_concurrency", 2)
+
+    def _download(self):
+        self.downloads += 1
+        return True
+
+    def test_deduplication(self):
+        def download():
+            # the same song is requested again while it is downloaded
+            with self.assertRaises(downloads.DownloadDeferred):
+                downloads.singleflight("song0000000", self._download)
+            return self._download()
+
+        self.assertTrue(downloads.singleflight("song0000000", download))
+        # requests that waited use the result instead of downloading again
+        self.assertTrue(downloads.singleflight("song0000000", self._download))
+        self.assertEqual(self.downloads, 1)
+        self.assertEqual(redis.redis_connection.get("downloads_deduplicated"), "1")
+
+    def test_concurrency(self):
+        storage.set("download_concurrency", 1)
+
+        def download():
+            # no slot is free for other songs
+            with self.assertRaises(downloads.DownloadDeferred):
+                downloads.singleflight("later000000", self._download, lambda: 1)
+            # except for the song that is played next
+            self.assertTrue(
+                downloads.singleflight("next0000000", self._download, lambda: 0)
+            )
+            return self._download()
+
+        self.assertTrue(downloads.singleflight("first000000", download))
+        self.assertEqual(self.downloads, 2)
+        # the deferred download starts once a slot is free
+        self.assertTrue(
+            downloads.singleflight("later000000", self._download, lambda: 1)
+        )
+        self.assertEqual(self.downloads, 3)
+
+
+class StreamFirstTests(TransactionTestCase):
+    video_id = "streamed000"
+
+    def setUp(self):
+        redis.start()
+        self.provider = YoutubeSongProvider(
+            f"https://www.youtube.com/watch?v={self.video_id}", None
+        )
+
+    def tearDown(self):
+        try:
+            os.remove(self.provider._get_path())
+        except FileNotFoundError:
+            pass
+
+    def test_replace_stream(self):
+        provider = self.provider
+        provider.streaming = True
+        provider.queued_song = util.enqueue_songs(
+            ["https://example.com/audio.m4a"],
+            external_urls=[provider.get_external_url()],
+            streamed=True,
+        )[0]
+        # the download finished in the meantime
+        pathlib.Path(provider._get_path()).touch()
+
+        youtube.replace_stream(provider)
+        # the song is played from the file instead of its stream
+        song = live_queue.get(provider.queued_song.id)
+        self.assertEqual(song["internal_url"], provider.get_internal_url())
+        self.assertIsNone(song["stream_url"])
+        song = QueuedSong.objects.get(id=provider.queued_song.id)
+        self.assertEqual(song.internal_url, provider.get_internal_url())
+        self.assertIsNone(song.stream_url)
+
+    def test_persist_streamed(self):
+        stream_url = "https://rr1.googlevideo.com/videoplayback?expire=0"
+        self.provider.streaming = True
+        self.provider.info_dict = {"id": self.video_id, "url": stream_url}
+        self.provider.persist("", archive=True)
+        # the expiring stream url is never archived
+        archived_song = ArchivedSong.objects.get()
+        self.assertEqual(archived_song.url, self.provider.get_external_url())
+        self.assertEqual(archived_song.title, self.provider.get_external_url())
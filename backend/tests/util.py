@@ -6,6 +6,8 @@ import urllib.error
 from django.conf import settings
 from django.contrib.auth.models import User
 
+from core.models import QueuedSong
+
 
 def admin_login(client):
     if not User.objects.filter(username="admin").exists():
@@ -13,6 +15,30 @@ def admin_login(client):
     client.login(username="admin", password="admin")
 
 
+def enqueue_songs(internal_urls, duration=1, external_urls=None, streamed=False):
+    """Enqueues a song for every internal url and returns them.
+    The external urls default to the internal urls.
+    If streamed is set, the songs are played from their internal url as a stream."""
+    if external_urls is None:
+        external_urls = internal_urls
+    return QueuedSong.objects.enqueue_many(
+        [
+            {
+                "artist": "test",
+                "title": str(position),
+                "duration": duration,
+                "internal_url": internal_url,
+                "external_url": external_url,
+                "stream_url": internal_url if streamed else None,
+            }
+            for position, (internal_url, external_url) in enumerate(
+                zip(internal_urls, external_urls)
+            )
+        ],
+        False,
+    )
+
+
 def download_test_library():
     test_library = os.path.join(settings.TEST_CACHE_DIR, "test_library")
     pathlib.Path(test_library).mkdir(parents=True, exist_ok=True)
@@ -68,6 +68,37 @@ test('key retrieval of songs', () => {
   });
 });
 
+test('queue patches', () => {
+  update.updateState({
+    'musiq': {
+      'currentSong': null,
+      'queueVersion': 3,
+      'songQueue': [
+        {'id': 1, 'order': 10, 'votes': 0, 'duration': 60},
+        {'id': 2, 'order': 20, 'votes': 0, 'duration': 60},
+      ],
+    },
+  });
+  update.applyQueuePatch({
+    'version': 4,
+    'ops': [
+      {'op': 'insert', 'song': {'id': 3, 'order': 5, 'votes': 0, 'duration': 60}},
+      {'op': 'remove', 'id': 2},
+    ],
+  });
+  expect(update.state.songQueue.map((song) => song.id)).toEqual([3, 1]);
+  expect(update.state.songQueue.map((song) => song.index)).toEqual([1, 2]);
+  expect(update.state.totalTimeFormatted).toEqual('02:00');
+  expect(update.state.queueVersion).toEqual(4);
+
+  // a missed patch causes the whole state to be requested
+  const get = jest.fn().mockReturnValue($.Deferred());
+  $.get = get;
+  update.applyQueuePatch({'version': 6, 'ops': [{'op': 'remove', 'id': 1}]});
+  expect(get).toHaveBeenCalled();
+  expect(update.state.songQueue.length).toEqual(2);
+});
+
 test('request random archived song', (done) => {
   buttons.onReady();
 
@@ -200,10 +200,36 @@ export function registerSpecificState(f) {
   specificStates.push(f);
 }
 
+const patchHandlers = [];
+
+/** Adds a new function that is called with every received queue patch.
+ * @param {callback} f function that should be called on every queue patch
+ */
+export function registerPatchHandler(f) {
+  patchHandlers.push(f);
+}
+
 /** This function is called everytime a new state is received from the server.
  * @param {Object} newState the state that was received
  */
 export function updateState(newState) {
+  if ('requestResult' in newState) {
+    // the outcome of a music request of this client
+    const result = newState.requestResult;
+    if (result.successful) {
+      successToast(result.message, '"' + result.query + '"');
+    } else {
+      errorToast(result.message, '"' + result.query + '"');
+    }
+    return;
+  }
+  if ('queuePatch' in newState) {
+    // patches only contain changes to the song queue
+    for (const patchHandler of patchHandlers) {
+      patchHandler(newState.queuePatch);
+    }
+    return;
+  }
   updateBaseState(newState);
 
   for (const specificState of specificStates) {
@@ -1,7 +1,9 @@
 import ReconnectingWebSocket from 'reconnecting-websocket';
 import {updateState, reconnect} from './base.js';
 
-let socketUrl = window.location.host + '/state/';
+// only receive the updates of the current page, e.g. /musiq/ -> musiq
+const page = window.location.pathname.split('/').filter(Boolean)[0] || 'base';
+let socketUrl = window.location.host + '/state/' + page + '/';
 if (window.location.protocol == 'https:') {
   socketUrl = 'wss://' + socketUrl;
 } else {
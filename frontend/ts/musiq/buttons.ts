@@ -71,9 +71,13 @@ export function requestArchivedMusic(key, query,
         query: query,
         playlist: playlistEnabled(),
         platform: platform,
+        background: true,
       }).done(function(response) {
-    successToast(response.message, '"' + query + '"');
-    localStorageSet('vote-' + response.key, '+', 7);
+    // the result of the request is sent over the websocket
+    // playlists have no placeholder that could be voted for
+    if (response.key !== undefined) {
+      localStorageSet('vote-' + response.key, '+', 7);
+    }
   }).fail(function(response) {
     errorToast(response.responseText, '"' + query + '"');
   });
@@ -92,9 +96,13 @@ export function requestNewMusic(query, platform = localStorageGet('platform')) {
         query: query,
         playlist: playlistEnabled(),
         platform: platform,
+        background: true,
       }).done(function(response) {
-    successToast(response.message, '"' + query + '"');
-    localStorageSet('vote-' + response.key, '+', 7);
+    // the result of the request is sent over the websocket
+    // playlists have no placeholder that could be voted for
+    if (response.key !== undefined) {
+      localStorageSet('vote-' + response.key, '+', 7);
+    }
   }).fail(function(response) {
     errorToast(response.responseText, '"' + query + '"');
   });
@@ -1,4 +1,9 @@
-import {localStorageGet, registerSpecificState} from '../base';
+import {
+  localStorageGet,
+  registerSpecificState,
+  registerPatchHandler,
+  getState,
+} from '../base';
 import {showPlayButton, showPauseButton} from './buttons';
 import {syncAudioStream} from './audio';
 
@@ -32,6 +37,22 @@ export function updateState(newState) {
     oldState = jQuery.extend(true, {}, state);
   }
 
+  if (!('songQueue' in newState.musiq)) {
+    // the queue is only contained in full snapshots,
+    // otherwise it is kept up to date by applying patches
+    if (oldState == null) {
+      getState();
+      return;
+    }
+    if (newState.musiq.queueVersion > oldState.queueVersion) {
+      // a patch was lost, resynchronize
+      getState();
+    }
+    newState.musiq.songQueue = oldState.songQueue;
+    newState.musiq.queueVersion = oldState.queueVersion;
+    newState.musiq.totalTimeFormatted = oldState.totalTimeFormatted;
+  }
+
   if (newState.playbackError) {
     $('#current-song-title').css('color', 'var(--red)');
   } else {
@@ -178,6 +199,84 @@ export function updateState(newState) {
   syncAudioStream();
 }
 
+/** Formats seconds as [hh:]mm:ss, like the server does.
+ * @param {number} seconds the duration to format
+ * @return {string} the formatted duration
+ */
+function formatSeconds(seconds) {
+  if (seconds < 0) {
+    return '--:--';
+  }
+  const hours = Math.floor(seconds / 3600);
+  const minutes = Math.floor(seconds % 3600 / 60);
+  const remaining = Math.floor(seconds % 60);
+  let formatted = '';
+  if (hours > 0) {
+    formatted += hours + ':';
+  }
+  formatted += ('0' + minutes).slice(-2) + ':' + ('0' + remaining).slice(-2);
+  return formatted;
+}
+
+/** Applies a patch to the song queue.
+ * Every change to the queue is sent as a patch with an increasing version.
+ * If a version is skipped, the whole state is requested instead.
+ * @param {Object} patch the version of the patch and a list of operations
+ */
+export function applyQueuePatch(patch) {
+  if (state == null || patch.version <= state.queueVersion) {
+    // the patch is already contained in the current state
+    return;
+  }
+  if (patch.version != state.queueVersion + 1) {
+    getState();
+    return;
+  }
+  const oldState = jQuery.extend(true, {}, state);
+  const songQueue = state.songQueue;
+  for (const op of patch.ops) {
+    const id = op.op == 'insert' ? op.song.id : op.id;
+    const position = songQueue.findIndex((song) => song.id == id);
+    // all operations are idempotent, a patch may be applied twice
+    if (op.op == 'insert') {
+      if (position == -1) {
+        songQueue.push(op.song);
+      } else {
+        songQueue[position] = op.song;
+      }
+    } else if (position == -1) {
+      continue;
+    } else if (op.op == 'remove') {
+      songQueue.splice(position, 1);
+    } else if (op.op == 'update') {
+      Object.assign(songQueue[position], op.song);
+    } else if (op.op == 'move') {
+      songQueue[position].order = op.order;
+    } else if (op.op == 'votes') {
+      songQueue[position].votes = op.votes;
+    }
+  }
+  songQueue.sort((a, b) => {
+    if (VOTING_ENABLED && a.votes != b.votes) {
+      return b.votes - a.votes;
+    }
+    return a.order - b.order;
+  });
+  let totalTime = 0;
+  $.each(songQueue, function(index, song) {
+    song.index = index + 1;
+    if (song.duration >= 0) {
+      // skip duration of placeholders
+      totalTime += song.duration;
+    }
+  });
+  state.totalTimeFormatted = formatSeconds(totalTime);
+  state.queueVersion = patch.version;
+
+  $('#total-time').text(state.totalTimeFormatted);
+  applyQueueChange(oldState, state);
+}
+
 /** Inserts the displayname of a song into an element.
  * @param {HTMLElement} element the div the displayname should be inserted into
  * @param {Object} song the song the info is taken from
@@ -398,4 +497,5 @@ $(document).ready(() => {
     return;
   }
   registerSpecificState(updateState);
+  registerPatchHandler(applyQueuePatch);
 });